@@ -19,7 +19,7 @@ import gzip
 import sys
 import subprocess 
 from google.cloud.exceptions import NotFound
-from common_etl.support import confirm_google_vm
+from common_etl.support import confirm_google_vm, instrument_steps, profiler_pool_kwargs, step_cache
 
 
 def add_labels_and_descriptions(project, 
@@ -773,6 +773,9 @@ def main(args):
     if params is None:
         print("Bad YAML load")
         return
+
+    steps = instrument_steps(steps, params['RUN_LOG'] if 'RUN_LOG' in params else None,
+                             profile_dir=params['PROFILE_DIR'] if 'PROFILE_DIR' in params else None)
     
     
     if 'extract_metadata_table' in steps:
@@ -807,7 +810,7 @@ def main(args):
             pass 
         
 
-        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, **profiler_pool_kwargs()) as executor:
             add_header = True 
             futures = []
             start_process(
@@ -879,14 +882,21 @@ def main(args):
             
     if 'create_new_columns' in steps:
         print('* Creating New Columns!')
-        create_new_columns(variant_call_file_csv,
-                           format_column_split_csv)
+        cache = step_cache(params, 'create_new_columns', [variant_call_file_csv], [format_column_split_csv])
+        if not cache.restore():
+            create_new_columns(variant_call_file_csv,
+                               format_column_split_csv)
+            cache.save()
         
     if 'merge_csv_files' in steps:
         print('* Merging CSV Files!')
-        merge_csv_files(variant_call_file_csv,
-                        format_column_split_csv,
-                        final_merged_csv)
+        cache = step_cache(params, 'merge_csv_files', [variant_call_file_csv, format_column_split_csv],
+                           [final_merged_csv])
+        if not cache.restore():
+            merge_csv_files(variant_call_file_csv,
+                            format_column_split_csv,
+                            final_merged_csv)
+            cache.save()
         
     if 'build_a_simple_schema' in steps:
         print('* Generating a Simple Schema! ')
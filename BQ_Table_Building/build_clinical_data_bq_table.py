@@ -51,6 +51,7 @@ def request_data_from_gdc_api(curr_index):
 
         # retrieve and parse a "page" (batch) of case objects
         res = requests.post(url=API_PARAMS['ENDPOINT'], data=request_params)
+        count_event('api_calls')
 
         # return response body if request was successful
         if res.status_code == requests.codes.ok:
@@ -241,6 +242,9 @@ def main(args):
     jsonl_output_file = build_jsonl_output_filename(BQ_PARAMS)
     scratch_fp = get_scratch_fp(BQ_PARAMS, jsonl_output_file)
 
+    steps = instrument_steps(steps, BQ_PARAMS['RUN_LOG'] if 'RUN_LOG' in BQ_PARAMS else None,
+                             profile_dir=BQ_PARAMS['PROFILE_DIR'] if 'PROFILE_DIR' in BQ_PARAMS else None)
+
     if 'retrieve_cases_and_write_to_jsonl' in steps:
         # Hits the GDC api endpoint, outputs data to jsonl file (format required by bq)
         console_out('Starting GDC API calls!')
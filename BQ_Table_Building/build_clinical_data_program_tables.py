@@ -1347,6 +1347,9 @@ def main(args):
     # programs = ['GENIE', 'HCMI', 'NCICCR']
     programs = sorted(programs)
 
+    steps = instrument_steps(steps, BQ_PARAMS['RUN_LOG'] if 'RUN_LOG' in BQ_PARAMS else None,
+                             profile_dir=BQ_PARAMS['PROFILE_DIR'] if 'PROFILE_DIR' in BQ_PARAMS else None)
+
     if 'get_field_groups_per_program' in steps:
         field_groups = API_PARAMS['FG_CONFIG']['order']
         program_fgs = dict()
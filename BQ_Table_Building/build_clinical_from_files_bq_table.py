@@ -30,13 +30,12 @@ import io
 import pandas as pd
 from git import Repo
 from json import loads as json_loads
-from createSchemaP3 import build_schema
 
 from common_etl.support import get_the_bq_manifest, confirm_google_vm, create_clean_target, \
                                generic_bq_harness, build_file_list, upload_to_bucket, csv_to_bq, \
                                build_pull_list_with_bq_public, BucketPuller, build_combined_schema, \
-                               delete_table_bq_job, install_labels_and_desc, update_schema_with_dict, \
-                               generate_table_detail_files, publish_table
+                               typing_tups_for, delete_table_bq_job, install_labels_and_desc, \
+                               update_schema_with_dict, generate_table_detail_files, publish_table, instrument_steps
 
 
 '''
@@ -257,6 +256,9 @@ def main(args):
     for val in na_values:
         na_set.add("[{}]".format(val))
 
+    steps = instrument_steps(steps, params['RUN_LOG'] if 'RUN_LOG' in params else None,
+                             profile_dir=params['PROFILE_DIR'] if 'PROFILE_DIR' in params else None)
+
     if 'clear_target_directory' in steps:
         print('clear_target_directory')
         create_clean_target(local_files_dir)
@@ -270,11 +272,12 @@ def main(args):
         print('build_manifest_from_filters')
         max_files = params['MAX_FILES'] if 'MAX_FILES' in params else None
 
+        use_storage_api = params['USE_BQ_STORAGE_API'] if 'USE_BQ_STORAGE_API' in params else False
         manifest_success = get_the_bq_manifest(params['FILE_TABLE'], bq_filters, max_files,
                                                params['WORKING_PROJECT'], params['TARGET_DATASET'],
                                                params['BQ_MANIFEST_TABLE'], params['WORKING_BUCKET'],
                                                params['BUCKET_MANIFEST_TSV'], manifest_file,
-                                               params['BQ_AS_BATCH'])
+                                               params['BQ_AS_BATCH'], use_storage_api=use_storage_api)
         if not manifest_success:
             print("Failure generating manifest")
             return
@@ -291,12 +294,13 @@ def main(args):
         full_manifest = '{}.{}.{}'.format(params['WORKING_PROJECT'],
                                           params['TARGET_DATASET'],
                                           params['BQ_MANIFEST_TABLE'])
+        use_storage_api = params['USE_BQ_STORAGE_API'] if 'USE_BQ_STORAGE_API' in params else False
         success = build_pull_list_with_bq_public(full_manifest, params['INDEXD_BQ_TABLE'],
                                           params['WORKING_PROJECT'], params['TARGET_DATASET'],
                                           params['BQ_PULL_LIST_TABLE'],
                                           params['WORKING_BUCKET'],
                                           params['BUCKET_PULL_LIST'],
-                                          local_pull_list, params['BQ_AS_BATCH'])
+                                          local_pull_list, params['BQ_AS_BATCH'], use_storage_api=use_storage_api)
 
         if not success:
             print("Build pull list failed")
@@ -366,7 +370,7 @@ def main(args):
     if 'analyze_the_schema' in steps:
         print('analyze_the_schema')
         for k in group_dict:
-            typing_tups = build_schema(one_big_tsv.format(k), params['SCHEMA_SAMPLE_SKIPS'])
+            typing_tups = typing_tups_for(params, one_big_tsv.format(k))
             #full_file_prefix = "{}/{}".format(params['PROX_DESC_PREFIX'], params['FINAL_TARGET_TABLE'])
             #schema_dict_loc = "{}_schema.json".format(full_file_prefix)
             hold_schema_dict_for_group = hold_schema_dict.format(k)
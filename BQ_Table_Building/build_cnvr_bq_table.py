@@ -28,13 +28,13 @@ import yaml
 import io
 from git import Repo
 from json import loads as json_loads
-from createSchemaP3 import build_schema
 
 from common_etl.support import get_the_bq_manifest, confirm_google_vm, create_clean_target, \
                                generic_bq_harness, build_file_list, upload_to_bucket, csv_to_bq, \
-                               build_pull_list_with_bq, BucketPuller, build_combined_schema, \
+                               build_pull_list_with_bq, BucketPuller, build_combined_schema, typing_tups_for, \
                                delete_table_bq_job, install_labels_and_desc, update_schema_with_dict, \
-                               generate_table_detail_files, publish_table
+                               generate_table_detail_files, publish_table, instrument_steps, step_cache, \
+                               manifest_checksums, schema_scan_config
 
 
 '''
@@ -173,6 +173,9 @@ def main(args):
     hold_schema_dict = "{}/{}".format(home, params['HOLD_SCHEMA_DICT'])
     hold_schema_list = "{}/{}".format(home, params['HOLD_SCHEMA_LIST'])
 
+    steps = instrument_steps(steps, params['RUN_LOG'] if 'RUN_LOG' in params else None,
+                             profile_dir=params['PROFILE_DIR'] if 'PROFILE_DIR' in params else None)
+
     if 'clear_target_directory' in steps:
         print('clear_target_directory')
         create_clean_target(local_files_dir)
@@ -186,11 +189,12 @@ def main(args):
         print('build_manifest_from_filters')
         max_files = params['MAX_FILES'] if 'MAX_FILES' in params else None
 
+        use_storage_api = params['USE_BQ_STORAGE_API'] if 'USE_BQ_STORAGE_API' in params else False
         manifest_success = get_the_bq_manifest(params['FILE_TABLE'], bq_filters, max_files,
                                                params['WORKING_PROJECT'], params['TARGET_DATASET'],
                                                params['BQ_MANIFEST_TABLE'], params['WORKING_BUCKET'],
                                                params['BUCKET_MANIFEST_TSV'], manifest_file,
-                                               params['BQ_AS_BATCH'])
+                                               params['BQ_AS_BATCH'], use_storage_api=use_storage_api)
         if not manifest_success:
             print("Failure generating manifest")
             return
@@ -207,12 +211,13 @@ def main(args):
         full_manifest = '{}.{}.{}'.format(params['WORKING_PROJECT'],
                                           params['TARGET_DATASET'],
                                           params['BQ_MANIFEST_TABLE'])
+        use_storage_api = params['USE_BQ_STORAGE_API'] if 'USE_BQ_STORAGE_API' in params else False
         success = build_pull_list_with_bq(full_manifest, params['INDEXD_BQ_TABLE'],
                                           params['WORKING_PROJECT'], params['TARGET_DATASET'],
                                           params['BQ_PULL_LIST_TABLE'],
                                           params['WORKING_BUCKET'],
                                           params['BUCKET_PULL_LIST'],
-                                          local_pull_list, params['BQ_AS_BATCH'])
+                                          local_pull_list, params['BQ_AS_BATCH'], use_storage_api=use_storage_api)
 
         if not success:
             print("Build pull list failed")
@@ -240,7 +245,11 @@ def main(args):
         print('concat_all_files')
         with open(file_traversal_list, mode='r') as traversal_list_file:
             all_files = traversal_list_file.read().splitlines()
-        concat_all_files(all_files, one_big_tsv)
+        checksums = manifest_checksums(manifest_file) if os.path.isfile(manifest_file) else None
+        cache = step_cache(params, 'concat_all_files', all_files, [one_big_tsv], None, checksums)
+        if not cache.restore():
+            concat_all_files(all_files, one_big_tsv)
+            cache.save()
 
     #
     # Schemas and table descriptions are maintained in the github repo:
@@ -269,11 +278,16 @@ def main(args):
 
     if 'analyze_the_schema' in steps:
         print('analyze_the_schema')
-        typing_tups = build_schema(one_big_tsv, params['SCHEMA_SAMPLE_SKIPS'])
         full_file_prefix = "{}/{}".format(params['PROX_DESC_PREFIX'], params['FINAL_TARGET_TABLE'])
         schema_dict_loc = "{}_schema.json".format(full_file_prefix)
-        build_combined_schema(None, schema_dict_loc,
-                              typing_tups, hold_schema_list, hold_schema_dict)
+        cache = step_cache(params, 'analyze_the_schema', [one_big_tsv, schema_dict_loc],
+                           [hold_schema_list, hold_schema_dict],
+                           schema_scan_config(params))
+        if not cache.restore():
+            typing_tups = typing_tups_for(params, one_big_tsv)
+            build_combined_schema(None, schema_dict_loc,
+                                  typing_tups, hold_schema_list, hold_schema_dict)
+            cache.save()
 
     bucket_target_blob = '{}/{}'.format(params['WORKING_BUCKET_DIR'], params['BUCKET_TSV'])
 
@@ -37,7 +37,7 @@ from json import loads as json_loads
 from createSchemaP3 import build_schema
 
 from common_etl.support import confirm_google_vm, create_clean_target, bucket_to_local, build_file_list,\
-                                generate_table_detail_files, upload_to_bucket, build_combined_schema
+                                generate_table_detail_files, upload_to_bucket, build_combined_schema, instrument_steps
 
 '''
 ----------------------------------------------------------------------------------------------
@@ -206,6 +206,9 @@ def main(args):
     hold_schema_dict = "{}/{}".format(home, params['HOLD_SCHEMA_DICT'])
     hold_schema_list = "{}/{}".format(home, params['HOLD_SCHEMA_LIST'])
 
+    steps = instrument_steps(steps, params['RUN_LOG'] if 'RUN_LOG' in params else None,
+                             profile_dir=params['PROFILE_DIR'] if 'PROFILE_DIR' in params else None)
+
     if 'clear_target_directory' in steps:
         print('clear_target_directory')
         create_clean_target(local_files_dir)
@@ -30,16 +30,19 @@ limitations under the License.
 
 import sys
 import os
+import shutil
+import zlib
 import yaml
 import io
 import requests
 from json import loads as json_loads
-from createSchemaP3 import build_schema
 from common_etl.support import build_manifest_filter, get_the_manifest, create_clean_target, \
     pull_from_buckets, build_file_list, generic_bq_harness, confirm_google_vm,    \
-    upload_to_bucket, csv_to_bq, concat_all_files, delete_table_bq_job,    \
+    upload_to_bucket, csv_to_bq, concat_all_files, concat_all_files_parallel, delete_table_bq_job,    \
     build_pull_list_with_indexd, build_pull_list_with_bq, update_schema,   \
-    update_description, build_combined_schema, get_the_bq_manifest, BucketPuller
+    update_description, build_combined_schema, typing_tups_for, get_the_bq_manifest, BucketPuller, \
+    upload_to_bucket_in_parts, bucket_parts_uri, instrument_steps, step_cache, \
+    manifest_checksums, stream_manifest
 
 
 # ### The Configuration Reader
@@ -164,103 +167,47 @@ def file_info(aFile, program_prefix):
     return [ platform_name, aliquot_barcode, fileUUID ]
 
 
-# ### Concatenate only selected columns of all the files
-
-def concat_all_files_selected_cols(all_files, one_big_tsv, program_prefix, retain_cols, 
-                                   extra_cols, file_info_func, split_more_func, check_col, drop_val):
-    """
-    Concatenate all Files
-    Gather up all files and glue them into one big one. The file name and path often include features
-    that we want to add into the table. The provided file_info_func returns a list of elements from
-    the file path, and the extra_cols list maps these to extra column names. Note if file is zipped,
-    we unzip it, concat it, then toss the unzipped version.
-    THIS VERSION OF THE FUNCTION USES THE FIRST LINE OF THE FIRST FILE TO BUILD THE HEADER LINE!
-    """
-    print("building {}".format(one_big_tsv))
-    first = True
-    header_id = None
-    hdr_line = []
-    keep_cols = []
-    use_line = []
-    check_index = None
-    with open(one_big_tsv, 'w') as outfile:
-        for filename in all_files:
-            toss_zip = False
-            if filename.endswith('.zip'):
-                dir_name = os.path.dirname(filename)
-                print("Unzipping {}".format(filename))
-                with zipfile.ZipFile(filename, "r") as zip_ref:
-                    zip_ref.extractall(dir_name)
-                use_file_name = filename[:-4]
-                toss_zip = True
-            elif filename.endswith('.gz'):
-                dir_name = os.path.dirname(filename)
-                use_file_name = filename[:-3]
-                print("Uncompressing {}".format(filename))
-                with gzip.open(filename, "rb") as gzip_in:
-                    with open(use_file_name, "wb") as uncomp_out:
-                        shutil.copyfileobj(gzip_in, uncomp_out)
-                toss_zip = True
-            else:
-                use_file_name = filename
-            if os.path.isfile(use_file_name):
-                with open(use_file_name, 'r') as readfile:
-                    file_info_list = file_info_func(use_file_name, program_prefix)
-                    for line in readfile:
-                        if line.startswith('#'):
-                            continue
-                        split_line = line.rstrip('\n').split("\t")
-                        if first:
-                            for col in extra_cols:
-                                split_line.append(col)
-                            header_id = split_line[0]
-                            for i in range(0, len(split_line)):
-                                if split_line[i] in retain_cols or split_line[i] in extra_cols:
-                                    keep_cols.append(i)
-                                    hdr_line.append(split_line[i])
-                                if check_col is not None and split_line[i] == check_col:
-                                    print("check_col {} split_line {} indx {}".format(check_col, split_line[i], i))
-                                    check_index = i
-                            print("Header starts with {}".format(header_id))
-                            print("Keeping columns {}".format(str(keep_cols)))
-                        else:
-                            for i in range(len(extra_cols)):
-                                split_line.append(file_info_list[i])
-                        use_line.clear()
-                        for i in keep_cols:
-                            use_line.append(split_line[i]) 
-                        if not line.startswith(header_id) or first:
-                            if check_index is not None and use_line[check_index] == drop_val:
-                                continue
-                            if split_more_func is not None:
-                                use_line = split_more_func(use_line, hdr_line, first)
-                            outfile.write('\t'.join(use_line))
-                            outfile.write('\n')
-                        first = False
-            else:
-                print('{} was not found'.format(use_file_name))
-
-            if toss_zip and os.path.isfile(use_file_name):
-                os.remove(use_file_name)
-
-    return
-
-
 # ### Reduce file to distinct lines
 
-def set_from_file(in_file, distinct_file):
+def set_from_file(in_file, distinct_file, num_partitions=64):
     """
     Take a file and only keep distinct rows
+    Rather than holding every line in one set, lines are first hashed out into num_partitions
+    scratch files. Duplicates always land in the same partition, so each partition can then be
+    reduced on its own with a set only 1/num_partitions the size. The header line stays on top;
+    within a partition the first occurrence of a line is kept.
     """
     print("building {}".format(distinct_file))
-    seen_lines = set()
-    with open(distinct_file, 'w') as outfile:
-        with open(in_file, 'r') as readfile:
-            for line in readfile:
-                if line in seen_lines:
-                    continue
-                seen_lines.add(line)
-                outfile.write(line)
+    parts_dir = "{}.parts".format(distinct_file)
+    os.makedirs(parts_dir, exist_ok=True)
+    part_names = [os.path.join(parts_dir, "part-{:04d}.tsv".format(i)) for i in range(num_partitions)]
+    try:
+        header = None
+        part_files = [open(part_name, 'w') for part_name in part_names]
+        try:
+            with open(in_file, 'r') as readfile:
+                header = readfile.readline()
+                for line in readfile:
+                    part_files[zlib.crc32(line.encode('utf-8')) % num_partitions].write(line)
+        finally:
+            for part_file in part_files:
+                part_file.close()
+
+        with open(distinct_file, 'w') as outfile:
+            if header:
+                outfile.write(header)
+            for part_name in part_names:
+                seen_lines = set()
+                if header:
+                    seen_lines.add(header)
+                with open(part_name, 'r') as readfile:
+                    for line in readfile:
+                        if line in seen_lines:
+                            continue
+                        seen_lines.add(line)
+                        outfile.write(line)
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
     return
 
 
@@ -285,23 +232,44 @@ def main():
         print("Bad YAML load")
         return
 
+    steps = instrument_steps(steps, params['RUN_LOG'] if 'RUN_LOG' in params else None,
+                             profile_dir=params['PROFILE_DIR'] if 'PROFILE_DIR' in params else None)
+
     #
     # Use the filter set to get a manifest from GDC using their API. Note that if a pull list is
     # provided, these steps can be omitted:
     #
     
+    # With PULL_LIST_WITH_MANIFEST, IndexD lookups for the pull list run while the manifest streams in:
+    pull_with_manifest = params['PULL_LIST_WITH_MANIFEST'] if 'PULL_LIST_WITH_MANIFEST' in params else False
+    pull_with_manifest = pull_with_manifest and params['USE_GDC_API_FOR_MANIFEST'] and params['USE_INDEXD_FOR_PULL']
+    pull_list_built = False
+
     if 'build_manifest_from_filters' in steps:
         max_files = params['MAX_FILES'] if 'MAX_FILES' in params else None
-        if params['USE_GDC_API_FOR_MANIFEST']:  
+        if params['USE_GDC_API_FOR_MANIFEST'] and pull_with_manifest:
+            manifest_filter = build_manifest_filter(filters)
+            records = stream_manifest(manifest_filter, params['API_URL'], params['MANIFEST_FILE'], max_files)
+            try:
+                build_pull_list_with_indexd(params['MANIFEST_FILE'],
+                                            params['INDEXD_IDS_PER_CALL'],
+                                            params['INDEXD_URL'], params['LOCAL_PULL_LIST'], records)
+                manifest_success = True
+                pull_list_built = True
+            except Exception as ex:
+                print("Problem building manifest and pull list: {}".format(str(ex)))
+                manifest_success = False
+        elif params['USE_GDC_API_FOR_MANIFEST']:  
             manifest_filter = build_manifest_filter(filters)
             manifest_success = get_the_manifest(manifest_filter, params['API_URL'], 
                                                 params['MANIFEST_FILE'], max_files)
         else:    
+            use_storage_api = params['USE_BQ_STORAGE_API'] if 'USE_BQ_STORAGE_API' in params else False
             manifest_success = get_the_bq_manifest(params['FILE_TABLE'], bq_filters, max_files, 
                                                    params['WORKING_PROJECT'], params['TARGET_DATASET'], 
                                                    params['BQ_MANIFEST_TABLE'], params['WORKING_BUCKET'], 
                                                    params['BUCKET_MANIFEST_TSV'], params['MANIFEST_FILE'], 
-                                                   params['BQ_AS_BATCH'])
+                                                   params['BQ_AS_BATCH'], use_storage_api=use_storage_api)
         if not manifest_success:
             print("Failure generating manifest")
             return
@@ -322,7 +290,9 @@ def main():
     
     if 'build_pull_list' in steps:
         
-        if params['USE_INDEXD_FOR_PULL']: 
+        if pull_list_built:
+            print("Pull list was built along with the manifest")
+        elif params['USE_INDEXD_FOR_PULL']: 
             build_pull_list_with_indexd(params['MANIFEST_FILE'], 
                                         params['INDEXD_IDS_PER_CALL'],  
                                         params['INDEXD_URL'], params['LOCAL_PULL_LIST'])
@@ -331,12 +301,13 @@ def main():
                                               params['TARGET_DATASET'], 
                                               params['BQ_MANIFEST_TABLE'])
     
+            use_storage_api = params['USE_BQ_STORAGE_API'] if 'USE_BQ_STORAGE_API' in params else False
             build_pull_list_with_bq(full_manifest, params['INDEXD_BQ_TABLE'], 
                                     params['WORKING_PROJECT'], params['TARGET_DATASET'],  
                                     params['BQ_PULL_LIST_TABLE'], 
                                     params['WORKING_BUCKET'], 
                                     params['BUCKET_PULL_LIST'],
-                                    params['LOCAL_PULL_LIST'], params['BQ_AS_BATCH'])
+                                    params['LOCAL_PULL_LIST'], params['BQ_AS_BATCH'], use_storage_api=use_storage_api)
  
     #
     # Now hitting GDC cloud buckets, not "downloading". Get the files in the pull list:
@@ -364,12 +335,23 @@ def main():
     #
     
     print("fix me have to toss out NA rows!")
+
+    # Concat runs files across processes (default is all cores); dedup spreads lines over partitions:
+    concat_procs = params['CONCAT_PROCESSES'] if 'CONCAT_PROCESSES' in params else None
+    dedup_partitions = params['DEDUP_PARTITIONS'] if 'DEDUP_PARTITIONS' in params else 64
+
     if 'concat_all_files' in steps:       
         with open(params['FILE_TRAVERSAL_LIST'], mode='r') as traversal_list_file:
             all_files = traversal_list_file.read().splitlines()  
-        concat_all_files_selected_cols(all_files, params['ONE_BIG_TSV'], 
-                                       params['PROGRAM_PREFIX'], retain_cols, extra_cols, 
-                                       file_info, None, "Beta_value", "NA")
+        checksums = manifest_checksums(params['MANIFEST_FILE']) if os.path.isfile(params['MANIFEST_FILE']) else None
+        cache = step_cache(params, 'concat_all_files', all_files, [params['ONE_BIG_TSV']],
+                           {'program_prefix': params['PROGRAM_PREFIX'], 'retain_cols': retain_cols,
+                            'extra_cols': extra_cols}, checksums)
+        if not cache.restore():
+            concat_all_files_parallel(all_files, params['ONE_BIG_TSV'], params['PROGRAM_PREFIX'], extra_cols,
+                                      file_info, None, concat_procs, retain_cols=retain_cols,
+                                      check_col="Beta_value", drop_val="NA")
+            cache.save()
 
     #
     # Build the platform reference table
@@ -378,10 +360,9 @@ def main():
     if 'build_plat_ref' in steps:       
         with open(params['FILE_TRAVERSAL_LIST'], mode='r') as traversal_list_file:
             all_files = traversal_list_file.read().splitlines()  
-        concat_all_files_selected_cols(all_files, params['ONE_BIG_REF_TSV'], 
-                                       params['PROGRAM_PREFIX'], retain_platform_ref_fields, [], 
-                                       file_info, None, None, None)  
-        set_from_file(params['ONE_BIG_REF_TSV'], params['ONE_BIG_DISTINCT_REF_TSV'])    
+        concat_all_files_parallel(all_files, params['ONE_BIG_REF_TSV'], params['PROGRAM_PREFIX'], [],
+                                  file_info, None, concat_procs, retain_cols=retain_platform_ref_fields)
+        set_from_file(params['ONE_BIG_REF_TSV'], params['ONE_BIG_DISTINCT_REF_TSV'], dedup_partitions)
             
     #
     # For the legacy table, the descriptions had lots of analysis tidbits. Very nice, but hard to maintain.
@@ -389,7 +370,7 @@ def main():
     #
     
     if 'build_the_schema' in steps:
-        typing_tups = build_schema(params['ONE_BIG_TSV'], params['SCHEMA_SAMPLE_SKIPS'])
+        typing_tups = typing_tups_for(params, params['ONE_BIG_TSV'])
         build_combined_schema(None, params['AUGMENTED_SCHEMA_FILE'], 
                               typing_tups, params['HOLD_SCHEMA_LIST'], params['HOLD_SCHEMA_DICT'])
          
@@ -397,15 +378,31 @@ def main():
     # Upload the giant TSV into a cloud bucket:
     #
     
+    upload_parts = params['UPLOAD_PARTS'] if 'UPLOAD_PARTS' in params else None
+    upload_compose = not params['UPLOAD_AS_WILDCARD'] if 'UPLOAD_AS_WILDCARD' in params else True
+    upload_gzip = params['UPLOAD_GZIP'] if 'UPLOAD_GZIP' in params else False
+
     if 'upload_to_bucket' in steps:
-        upload_to_bucket(params['WORKING_BUCKET'], params['BUCKET_SKEL_TSV'], params['ONE_BIG_TSV'])
+        if upload_parts is None:
+            upload_to_bucket(params['WORKING_BUCKET'], params['BUCKET_SKEL_TSV'], params['ONE_BIG_TSV'])
+        else:
+            uploaded_uri = upload_to_bucket_in_parts(params['WORKING_BUCKET'], params['BUCKET_SKEL_TSV'],
+                                                     params['ONE_BIG_TSV'], upload_parts,
+                                                     upload_compose, upload_gzip)
+            if uploaded_uri is None:
+                print("upload_to_bucket failed")
+                return
 
     #
     # Create the BQ table from the TSV:
     #
         
     if 'create_bq_from_tsv' in steps:
-        bucket_src_url = 'gs://{}/{}'.format(params['WORKING_BUCKET'], params['BUCKET_SKEL_TSV'])
+        if upload_parts is None:
+            bucket_src_url = 'gs://{}/{}'.format(params['WORKING_BUCKET'], params['BUCKET_SKEL_TSV'])
+        else:
+            bucket_src_url = bucket_parts_uri(params['WORKING_BUCKET'], params['BUCKET_SKEL_TSV'],
+                                              upload_compose, upload_gzip)
         with open(params['HOLD_SCHEMA_LIST'], mode='r') as schema_hold_dict:
             typed_schema = json_loads(schema_hold_dict.read())
         csv_to_bq(typed_schema, bucket_src_url, params['TARGET_DATASET'], params['SKELETON_TABLE'], params['BQ_AS_BATCH'])
@@ -29,13 +29,13 @@ import io
 from git import Repo
 from json import loads as json_loads
 from os.path import expanduser
-from createSchemaP3 import build_schema
 from common_etl.support import create_clean_target, build_file_list, generic_bq_harness, confirm_google_vm, \
                                upload_to_bucket, csv_to_bq, concat_all_files, delete_table_bq_job, \
                                build_pull_list_with_bq, update_schema, \
-                               update_description, build_combined_schema, get_the_bq_manifest, BucketPuller, \
-                               generate_table_detail_files, update_schema_with_dict, install_labels_and_desc, \
-                               publish_table
+                               update_description, build_combined_schema, typing_tups_for, get_the_bq_manifest, \
+                               BucketPuller, generate_table_detail_files, update_schema_with_dict, \
+                               install_labels_and_desc, publish_table, instrument_steps, step_cache, \
+                               manifest_checksums, schema_scan_config
 
 '''
 ----------------------------------------------------------------------------------------------
@@ -220,6 +220,9 @@ def main(args):
     hold_schema_dict = "{}/{}".format(home, params['HOLD_SCHEMA_DICT'])
     hold_schema_list = "{}/{}".format(home, params['HOLD_SCHEMA_LIST'])
 
+    steps = instrument_steps(steps, params['RUN_LOG'] if 'RUN_LOG' in params else None,
+                             profile_dir=params['PROFILE_DIR'] if 'PROFILE_DIR' in params else None)
+
     #
     # Best practice is to clear out the directory where the files are going. Don't want anything left over.
     # Also creates the destination directory
@@ -235,11 +238,12 @@ def main(args):
     
     if 'build_manifest_from_filters' in steps:
         max_files = params['MAX_FILES'] if 'MAX_FILES' in params else None
+        use_storage_api = params['USE_BQ_STORAGE_API'] if 'USE_BQ_STORAGE_API' in params else False
         manifest_success = get_the_bq_manifest(params['FILE_TABLE'], bq_filters, max_files,
                                                params['WORKING_PROJECT'], params['TARGET_DATASET'],
                                                params['BQ_MANIFEST_TABLE'], params['WORKING_BUCKET'],
                                                params['BUCKET_MANIFEST_TSV'], manifest_file,
-                                               params['BQ_AS_BATCH'])
+                                               params['BQ_AS_BATCH'], use_storage_api=use_storage_api)
         if not manifest_success:
             print("Failure generating manifest")
             return
@@ -253,12 +257,13 @@ def main(args):
                                           params['TARGET_DATASET'],
                                           params['BQ_MANIFEST_TABLE'])
 
+        use_storage_api = params['USE_BQ_STORAGE_API'] if 'USE_BQ_STORAGE_API' in params else False
         build_pull_list_with_bq(full_manifest, params['INDEXD_BQ_TABLE'],
                                 params['WORKING_PROJECT'], params['TARGET_DATASET'],
                                 params['BQ_PULL_LIST_TABLE'],
                                 params['WORKING_BUCKET'],
                                 params['BUCKET_PULL_LIST'],
-                                local_pull_list, params['BQ_AS_BATCH'])
+                                local_pull_list, params['BQ_AS_BATCH'], use_storage_api=use_storage_api)
  
     #
     # Now hitting GDC cloud buckets, not "downloading". Get the files in the pull list:
@@ -288,8 +293,13 @@ def main(args):
     if 'concat_all_files' in steps:       
         with open(file_traversal_list, mode='r') as traversal_list_file:
             all_files = traversal_list_file.read().splitlines()  
-        concat_all_files(all_files, one_big_tsv,
-                         params['PROGRAM_PREFIX'], extra_cols, file_info, None)
+        checksums = manifest_checksums(manifest_file) if os.path.isfile(manifest_file) else None
+        cache = step_cache(params, 'concat_all_files', all_files, [one_big_tsv],
+                           {'program_prefix': params['PROGRAM_PREFIX'], 'extra_cols': extra_cols}, checksums)
+        if not cache.restore():
+            concat_all_files(all_files, one_big_tsv,
+                             params['PROGRAM_PREFIX'], extra_cols, file_info, None)
+            cache.save()
 
     #
     # For the legacy table, the descriptions had lots of analysis tidbits. Very nice, but hard to maintain.
@@ -297,7 +307,7 @@ def main(args):
     #
 
     if 'build_the_schema' in steps:
-        typing_tups = build_schema(one_big_tsv, params['SCHEMA_SAMPLE_SKIPS'])
+        typing_tups = typing_tups_for(params, one_big_tsv)
         build_combined_schema(None, AUGMENTED_SCHEMA_FILE,
                               typing_tups, hold_schema_list, hold_schema_dict)
 
@@ -387,11 +397,16 @@ def main(args):
 
     if 'analyze_the_schema' in steps:
         print('analyze_the_schema')
-        typing_tups = build_schema(one_big_tsv, params['SCHEMA_SAMPLE_SKIPS'])
         full_file_prefix = "{}/{}".format(params['PROX_DESC_PREFIX'], params['FINAL_TARGET_TABLE'])
         schema_dict_loc = "{}_schema.json".format(full_file_prefix)
-        build_combined_schema(None, schema_dict_loc,
-                                typing_tups, hold_schema_list, hold_schema_dict)
+        cache = step_cache(params, 'analyze_the_schema', [one_big_tsv, schema_dict_loc],
+                           [hold_schema_list, hold_schema_dict],
+                           schema_scan_config(params))
+        if not cache.restore():
+            typing_tups = typing_tups_for(params, one_big_tsv)
+            build_combined_schema(None, schema_dict_loc,
+                                  typing_tups, hold_schema_list, hold_schema_dict)
+            cache.save()
 
     #
     # Update the per-field descriptions:
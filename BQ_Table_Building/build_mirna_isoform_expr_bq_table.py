@@ -22,14 +22,16 @@ Make sure the Notebook VM has BigQuery and Storage Read/Write permissions!
 
 import sys
 import os
+import re
 import yaml
 import io
 from json import loads as json_loads
 from os.path import expanduser
-from createSchemaP3 import build_schema
 from common_etl.support import create_clean_target, build_file_list, generic_bq_harness, \
-    upload_to_bucket, csv_to_bq, concat_all_files, delete_table_bq_job, build_pull_list_with_bq, update_schema, \
-    update_description, build_combined_schema, get_the_bq_manifest, BucketPuller, confirm_google_vm
+    upload_to_bucket, csv_to_bq, concat_all_files_parallel, delete_table_bq_job, build_pull_list_with_bq, update_schema, \
+    update_description, build_combined_schema, typing_tups_for, get_the_bq_manifest, BucketPuller, \
+    confirm_google_vm, instrument_steps, step_cache, manifest_checksums, pull_and_concat_all_files, \
+    build_schema_from_concat_stats, concat_stats_file, parquet_to_bq
 
 '''
 ----------------------------------------------------------------------------------------------
@@ -56,61 +58,69 @@ Function to split column data
 Some columns in the data coming in from GDC need to be split before being concatenated into the "one big TSV".
 '''
 
-def split_col_func(col_data, orig_cols, is_first):
-    #
-    # The following columns in the input need to be split apart in the output:
-    # isoform_coords -> chromosome, start_pos, end_pos, strand
-    # miRNA_region-> mirna_transcript, mirna_accession
-    #
-    
+#
+# An example of an isoform_coords entry:
+# "hg38:chr9:94175962-94175983:+"
+# Examples of miRNA_region entries:
+# precursor
+# mature,MIMAT0000062
+#
+
+ISOFORM_COORDS_RE = re.compile(r'hg38:([^:]*):([^:-]*)-([^:-]*):([^:]*)$')
+
+
+class SplitColFunc(object):
+    """
+    The following columns in the input need to be split apart in the output:
+    isoform_coords -> chromosome, start_pos, end_pos, strand
+    miRNA_region-> mirna_transcript, mirna_accession
+    Called by concat_all_files like a split_more_func. The header row (is_first) is used to work out
+    where the two columns sit, so each data row is just a couple of slices, one regex match and one
+    partition instead of a per-column loop of string compares.
+    """
+
     col_map = {
-        'isoform_coords' : ['chromosome', 'start_pos', 'end_pos', 'strand'],
-        'miRNA_region' : ['mirna_transcript', 'mirna_accession'] 
+        'isoform_coords': ['chromosome', 'start_pos', 'end_pos', 'strand'],
+        'miRNA_region': ['mirna_transcript', 'mirna_accession']
     }
-    
-    # An example of an isoform_coords entry:
-    # "hg38:chr9:94175962-94175983:+"
-    # Examples of miRNA_region entries:
-    # precursor
-    # mature,MIMAT0000062
-    
-    
-    ret_data = []
-    if is_first:
-        for elem in col_data:
-            if elem in col_map:
-                ret_data += col_map[elem]
-            else:
-                ret_data.append(elem)
-    else:
-        count = 0
-        for elem in col_data:
-            if orig_cols[count] == 'isoform_coords':
-                elems = elem.split(':')
-                if elems[0] != 'hg38':
-                    raise Exception()
-                ret_data.append(elems[1])
-                st_end = elems[2].split('-')
-                ret_data.append(st_end[0])
-                ret_data.append(st_end[1])
-                ret_data.append(elems[3])
-            elif orig_cols[count] == 'miRNA_region':
-                if ',' in elem:
-                    elems = elem.split(',')
-                    if len(elems) != 2:
-                        print(elem)
-                        raise Exception()  
-                    ret_data.append(elems[0])
-                    ret_data.append(elems[1])  
+
+    def __init__(self):
+        self._coords_idx = None
+        self._region_idx = None
+
+    def __str__(self):
+        return "SplitColFunc"
+
+    def _compile(self, orig_cols):
+        self._coords_idx = orig_cols.index('isoform_coords')
+        self._region_idx = orig_cols.index('miRNA_region')
+        if self._coords_idx > self._region_idx:
+            raise Exception("isoform_coords expected before miRNA_region")
+
+    def __call__(self, col_data, orig_cols, is_first):
+        if is_first:
+            self._compile(orig_cols)
+            ret_data = []
+            for elem in col_data:
+                if elem in self.col_map:
+                    ret_data += self.col_map[elem]
                 else:
                     ret_data.append(elem)
-                    ret_data.append('')
-            else:
-                ret_data.append(elem)
-            count += 1
-  
-    return ret_data
-  
+            return ret_data
+
+        ci = self._coords_idx
+        ri = self._region_idx
+        coords = ISOFORM_COORDS_RE.match(col_data[ci])
+        if coords is None:
+            raise Exception("Unexpected isoform_coords: {}".format(col_data[ci]))
+        transcript, comma, accession = col_data[ri].partition(',')
+        if ',' in accession:
+            print(col_data[ri])
+            raise Exception()
+        return col_data[:ci] + list(coords.groups()) + col_data[ci + 1:ri] + \
+            [transcript, accession] + col_data[ri + 1:]
+
+
 
 '''
 ----------------------------------------------------------------------------------------------
@@ -281,6 +291,16 @@ def main(args):
     hold_schema_dict = "{}/{}".format(home, params['HOLD_SCHEMA_DICT'])
     hold_schema_list = "{}/{}".format(home, params['HOLD_SCHEMA_LIST'])
 
+    #
+    # If ONE_BIG_PARQUET is given, the concat writes a typed Parquet file instead of one_big_tsv. The
+    # schema then comes from the column stats gathered during the concat, and BQ loads the Parquet:
+    #
+
+    one_big_parquet = "{}/{}".format(home, params['ONE_BIG_PARQUET']) if 'ONE_BIG_PARQUET' in params else None
+
+    steps = instrument_steps(steps, params['RUN_LOG'] if 'RUN_LOG' in params else None,
+                             profile_dir=params['PROFILE_DIR'] if 'PROFILE_DIR' in params else None)
+
     #
     # Use the filter set to get a manifest from GDC using their API. Note that is a pull list is
     # provided, these steps can be omitted:
@@ -288,11 +308,12 @@ def main(args):
     
     if 'build_manifest_from_filters' in steps:
         max_files = params['MAX_FILES'] if 'MAX_FILES' in params else None
+        use_storage_api = params['USE_BQ_STORAGE_API'] if 'USE_BQ_STORAGE_API' in params else False
         manifest_success = get_the_bq_manifest(params['FILE_TABLE'], bq_filters, max_files,
                                                params['WORKING_PROJECT'], params['TARGET_DATASET'],
                                                params['BQ_MANIFEST_TABLE'], params['WORKING_BUCKET'],
                                                params['BUCKET_MANIFEST_TSV'], manifest_file,
-                                               params['BQ_AS_BATCH'])
+                                               params['BQ_AS_BATCH'], use_storage_api=use_storage_api)
         if not manifest_success:
             print("Failure generating manifest")
             return
@@ -316,15 +337,40 @@ def main(args):
                                           params['TARGET_DATASET'],
                                           params['BQ_MANIFEST_TABLE'])
 
+        use_storage_api = params['USE_BQ_STORAGE_API'] if 'USE_BQ_STORAGE_API' in params else False
         build_pull_list_with_bq(full_manifest, params['INDEXD_BQ_TABLE'],
                                 params['WORKING_PROJECT'], params['TARGET_DATASET'],
                                 params['BQ_PULL_LIST_TABLE'],
                                 params['WORKING_BUCKET'],
                                 params['BUCKET_PULL_LIST'],
-                                local_pull_list, params['BQ_AS_BATCH'])
+                                local_pull_list, params['BQ_AS_BATCH'], use_storage_api=use_storage_api)
  
     #
-    # Now hitting GDC cloud buckets. Get the files in the pull list:
+    # Now hitting GDC cloud buckets. This does download_from_gdc, build_traversal_list and concat_all_files
+    # as one pipeline, concatenating each file as soon as it lands. Only PIPELINE_WINDOW files are on disk
+    # at a time, and they are deleted once used unless KEEP_RAW_FILES. The file traversal list is only
+    # written if the files are kept, as a later concat_all_files step could not read them otherwise:
+    #
+
+    if 'download_and_concat' in steps:
+        with open(local_pull_list, mode='r') as pull_list_file:
+            pull_list = pull_list_file.read().splitlines()
+        concat_procs = params['CONCAT_PROCESSES'] if 'CONCAT_PROCESSES' in params else None
+        window = params['PIPELINE_WINDOW'] if 'PIPELINE_WINDOW' in params else None
+        keep_raw = params['KEEP_RAW_FILES'] if 'KEEP_RAW_FILES' in params else False
+        all_files = pull_and_concat_all_files(pull_list, local_files_dir, one_big_tsv, params['PROGRAM_PREFIX'],
+                                              extra_cols, file_info, SplitColFunc(), num_threads=10,
+                                              num_procs=concat_procs, window=window, toss_raw=not keep_raw,
+                                              parquet_file=one_big_parquet)
+        if keep_raw:
+            with open(file_traversal_list, mode='w') as traversal_list:
+                for line in all_files:
+                    traversal_list.write("{}\n".format(line))
+        elif os.path.exists(file_traversal_list):
+            os.remove(file_traversal_list)
+
+    #
+    # Or step by step. Get the files in the pull list:
     #
 
     if 'download_from_gdc' in steps:       
@@ -351,8 +397,16 @@ def main(args):
     if 'concat_all_files' in steps:       
         with open(file_traversal_list, mode='r') as traversal_list_file:
             all_files = traversal_list_file.read().splitlines()  
-        concat_all_files(all_files, one_big_tsv,
-                         params['PROGRAM_PREFIX'], extra_cols, file_info, split_col_func)
+        concat_procs = params['CONCAT_PROCESSES'] if 'CONCAT_PROCESSES' in params else None
+        checksums = manifest_checksums(manifest_file) if os.path.isfile(manifest_file) else None
+        concat_outputs = [one_big_tsv] if one_big_parquet is None else \
+            [one_big_parquet, concat_stats_file(one_big_parquet)]
+        cache = step_cache(params, 'concat_all_files', all_files, concat_outputs,
+                           {'program_prefix': params['PROGRAM_PREFIX'], 'extra_cols': extra_cols}, checksums)
+        if not cache.restore():
+            concat_all_files_parallel(all_files, one_big_tsv, params['PROGRAM_PREFIX'], extra_cols,
+                                      file_info, SplitColFunc(), concat_procs, parquet_file=one_big_parquet)
+            cache.save()
             
     #
     # For the legacy table, the descriptions had lots of analysis tidbits. Very nice, but hard to maintain.
@@ -360,7 +414,10 @@ def main(args):
     #
     
     if 'build_the_schema' in steps:
-        typing_tups = build_schema(one_big_tsv, params['SCHEMA_SAMPLE_SKIPS'])
+        if one_big_parquet is not None:
+            typing_tups = build_schema_from_concat_stats(one_big_parquet)
+        else:
+            typing_tups = typing_tups_for(params, one_big_tsv)
         build_combined_schema(None, AUGMENTED_SCHEMA_FILE,
                               typing_tups, hold_schema_list, hold_schema_dict)
          
@@ -369,17 +426,26 @@ def main(args):
     #
     
     if 'upload_to_bucket' in steps:
-        upload_to_bucket(params['WORKING_BUCKET'], params['BUCKET_SKEL_TSV'], one_big_tsv)
+        if one_big_parquet is not None:
+            upload_to_bucket(params['WORKING_BUCKET'], params['BUCKET_SKEL_PARQUET'], one_big_parquet)
+        else:
+            upload_to_bucket(params['WORKING_BUCKET'], params['BUCKET_SKEL_TSV'], one_big_tsv)
 
     #
     # Create the BQ table from the TSV:
     #
         
     if 'create_bq_from_tsv' in steps:
-        bucket_src_url = 'gs://{}/{}'.format(params['WORKING_BUCKET'], params['BUCKET_SKEL_TSV'])
         with open(hold_schema_list, mode='r') as schema_hold_dict:
             typed_schema = json_loads(schema_hold_dict.read())
-        csv_to_bq(typed_schema, bucket_src_url, params['TARGET_DATASET'], params['SKELETON_TABLE'], params['BQ_AS_BATCH'])
+        if one_big_parquet is not None:
+            bucket_src_url = 'gs://{}/{}'.format(params['WORKING_BUCKET'], params['BUCKET_SKEL_PARQUET'])
+            parquet_to_bq(typed_schema, bucket_src_url, params['TARGET_DATASET'], params['SKELETON_TABLE'],
+                          params['BQ_AS_BATCH'])
+        else:
+            bucket_src_url = 'gs://{}/{}'.format(params['WORKING_BUCKET'], params['BUCKET_SKEL_TSV'])
+            csv_to_bq(typed_schema, bucket_src_url, params['TARGET_DATASET'], params['SKELETON_TABLE'],
+                      params['BQ_AS_BATCH'])
 
     #
     # Need to merge in aliquot and sample barcodes from other tables:
@@ -33,18 +33,19 @@ import zipfile
 import io
 from git import Repo
 import re
+import itertools
 from json import loads as json_loads
 from os.path import expanduser
-from createSchemaP3 import build_schema
 from datetime import date
 import gzip
 
 from common_etl.support import create_clean_target, pull_from_buckets, build_file_list, generic_bq_harness, \
                                upload_to_bucket, csv_to_bq, delete_table_bq_job, \
                                build_pull_list_with_bq, update_schema, \
-                               build_combined_schema, get_the_bq_manifest, confirm_google_vm, \
+                               build_combined_schema, typing_tups_for, get_the_bq_manifest, confirm_google_vm, \
                                generate_table_detail_files, customize_labels_and_desc, install_labels_and_desc, \
-                               publish_table, update_status_tag, compare_two_tables
+                               publish_table, update_status_tag, compare_two_tables_summary, instrument_steps, \
+                               step_cache, manifest_checksums, schema_scan_config
 
 '''
 ----------------------------------------------------------------------------------------------
@@ -334,18 +335,40 @@ Concatenate all Files
 '''
 
 
-def concat_all_files(all_files, one_big_tsv, program, callers, fields_to_fix):
+def caller_columns_lookup(callers):
+    """
+    The callers column only ever holds a few distinct combinations of caller names, so rather than
+    expanding it row by row, each distinct value is run through process_callers once and the
+    finished tab-separated Yes/Yes*/No columns are cached.
+    """
+    cache = {}
+
+    def caller_columns(callers_str):
+        cols = cache.get(callers_str)
+        if cols is None:
+            caller_data = process_callers(callers_str, callers)
+            cols = '\t'.join([caller_data[caller] for caller in callers])
+            cache[callers_str] = cols
+        return cols
+
+    return caller_columns
+
+
+def concat_all_files(all_files, one_big_tsv, program, callers, fields_to_fix, caller_col=124, chunk_rows=100000):
     """
     Concatenate all Files
     Gather up all files and glue them into one big one. The file name and path often include features
     that we want to add into the table. The provided file_info_func returns a list of elements from
     the file path. Note if file is zipped,
     we unzip it, concat it, then toss the unzipped version.
+    Rows are handled in chunks of chunk_rows: the callers column is pulled out with a split that stops
+    at caller_col, expanded through a cached lookup, and the whole chunk is written at once.
     THIS VERSION OF THE FUNCTION USES THE FIRST LINE OF THE FIRST FILE TO BUILD THE HEADER LINE!
     """
     print("building {}".format(one_big_tsv))
     first = True
     header_id = None
+    caller_columns = caller_columns_lookup(callers)
     with open(one_big_tsv, 'w') as outfile:
         for filename in all_files:
             toss_zip = False
@@ -368,39 +391,37 @@ def concat_all_files(all_files, one_big_tsv, program, callers, fields_to_fix):
                 use_file_name = filename
             with open(use_file_name, 'r') as readfile:
                 callerName, fileUUID = file_info(use_file_name, program)
-                for line in readfile:
-                    # Seeing comments in MAF files.
-                    if not line.startswith('#'):
+                if program == "TCGA":
+                    row_suffix = '\t{}\t{}\n'.format(fileUUID, callerName)
+                else:
+                    row_suffix = '\t{}\t'.format(fileUUID)
+                while True:
+                    chunk = list(itertools.islice(readfile, chunk_rows))
+                    if not chunk:
+                        break
+                    out_rows = []
+                    for line in chunk:
+                        # Seeing comments in MAF files.
+                        if line.startswith('#'):
+                            continue
                         if first:
                             header_id = line.split('\t')[0]
                             header_names = clean_header_names(line, fields_to_fix, program)
-                            header_line = '\t'.join(header_names)
-                            outfile.write(header_line.rstrip('\n'))
-                            outfile.write('\t')
-                            outfile.write('file_gdc_id')
+                            header_line = '\t'.join(header_names).rstrip('\n')
                             if program == "TCGA":
-                                outfile.write('\t')
-                                outfile.write('caller')
+                                header_line += '\tfile_gdc_id\tcaller'
                             else:
-                                for field in callers:
-                                    outfile.write('\t')
-                                    outfile.write(field)
-                            outfile.write('\n')
+                                header_line += '\tfile_gdc_id\t' + '\t'.join(callers)
+                            out_rows.append(header_line + '\n')
                             first = False
-                        if not line.startswith(header_id):
-                            outfile.write(line.rstrip('\n'))
-                            outfile.write('\t')
-                            outfile.write(fileUUID)
-                            if program == "TCGA":
-                                outfile.write('\t')
-                                outfile.write(callerName)
-                            else:
-                                caller_field = line.split('\t')[124]
-                                caller_data = process_callers(caller_field, callers)
-                                for caller in callers:
-                                    outfile.write('\t')
-                                    outfile.write(caller_data[caller])
-                            outfile.write('\n')
+                        if line.startswith(header_id):
+                            continue
+                        if program == "TCGA":
+                            out_rows.append(line.rstrip('\n') + row_suffix)
+                        else:
+                            caller_field = line.split('\t', caller_col + 1)[caller_col]
+                            out_rows.append(line.rstrip('\n') + row_suffix + caller_columns(caller_field) + '\n')
+                    outfile.writelines(out_rows)
                 if toss_zip:
                     os.remove(use_file_name)
 
@@ -468,15 +489,19 @@ def main(args):
 
     metadata_rel = "".join(["r", str(params['METADATA_REL'])]) if 'METADATA_REL' in params else release
 
+    steps = instrument_steps(steps, params['RUN_LOG'] if 'RUN_LOG' in params else None,
+                             profile_dir=params['PROFILE_DIR'] if 'PROFILE_DIR' in params else None)
+
     if 'build_manifest_from_filters' in steps:
 
         max_files = params['MAX_FILES'] if 'MAX_FILES' in params else None
+        use_storage_api = params['USE_BQ_STORAGE_API'] if 'USE_BQ_STORAGE_API' in params else False
         manifest_success = get_the_bq_manifest(params['FILE_TABLE'].format(metadata_rel),
                                                bq_filters, max_files,
                                                params['WORKING_PROJECT'], params['SCRATCH_DATASET'],
                                                manifest_table, params['WORKING_BUCKET'],
                                                params['BUCKET_MANIFEST_TSV'], manifest_file,
-                                               params['BQ_AS_BATCH'])
+                                               params['BQ_AS_BATCH'], use_storage_api=use_storage_api)
         if not manifest_success:
             print("Failure generating manifest")
             return
@@ -497,13 +522,14 @@ def main(args):
 
     if 'build_pull_list' in steps:
 
+        use_storage_api = params['USE_BQ_STORAGE_API'] if 'USE_BQ_STORAGE_API' in params else False
         build_pull_list_with_bq("{}.{}.{}".format(params['WORKING_PROJECT'], params['SCRATCH_DATASET'], manifest_table),
                                 params['INDEXD_BQ_TABLE'].format(metadata_rel),
                                 params['WORKING_PROJECT'], params['SCRATCH_DATASET'],
                                 "_".join([params['PROGRAM'], params['DATA_TYPE'], 'pull', 'list']),
                                 params['WORKING_BUCKET'],
                                 params['BUCKET_PULL_LIST'],
-                                local_pull_list, params['BQ_AS_BATCH'])
+                                local_pull_list, params['BQ_AS_BATCH'], use_storage_api=use_storage_api)
 
     #
     # Now hitting GDC cloud buckets, not "downloading". Get the files in the pull list:
@@ -527,7 +553,13 @@ def main(args):
     if 'concat_all_files' in steps:
         with open(file_traversal_list, mode='r') as traversal_list_file:
             all_files = traversal_list_file.read().splitlines()
+        checksums = manifest_checksums(manifest_file) if os.path.isfile(manifest_file) else None
+        cache = step_cache(params, 'concat_all_files', all_files, [one_big_tsv],
+                           {'program': params['PROGRAM'], 'callers': callers,
+                            'fields_to_fix': params['FIELDS_TO_FIX']}, checksums)
+        if not cache.restore():
             concat_all_files(all_files, one_big_tsv, params['PROGRAM'], callers, params['FIELDS_TO_FIX'])
+            cache.save()
     #
     # Schemas and table descriptions are maintained in the github repo:
     #
@@ -600,11 +632,16 @@ def main(args):
 
         if 'analyze_the_schema' in steps:
             print('analyze_the_schema')
-            typing_tups = build_schema(one_big_tsv, params['SCHEMA_SAMPLE_SKIPS'])
             full_file_prefix = "{}/{}".format(params['PROX_DESC_PREFIX'], draft_table.format(schema_release))
             schema_dict_loc = "{}_schema.json".format(full_file_prefix)
-            build_combined_schema(None, schema_dict_loc,
-                                  typing_tups, hold_schema_list, hold_schema_dict)
+            cache = step_cache(params, 'analyze_the_schema', [one_big_tsv, schema_dict_loc],
+                               [hold_schema_list, hold_schema_dict],
+                               schema_scan_config(params))
+            if not cache.restore():
+                typing_tups = typing_tups_for(params, one_big_tsv)
+                build_combined_schema(None, schema_dict_loc,
+                                      typing_tups, hold_schema_list, hold_schema_dict)
+                cache.save()
 
     bucket_target_blob = '{}/{}-{}-{}.tsv'.format(params['WORKING_BUCKET_DIR'], params['DATE'], params['PROGRAM'],
                                                   params['DATA_TYPE'])
@@ -738,20 +775,26 @@ def main(args):
 
         print('Compare {} to {}'.format(old_current_table, previous_ver_table))
 
-        compare = compare_two_tables(old_current_table, previous_ver_table, params['BQ_AS_BATCH'])
+        # Fingerprint both tables; with a bucket key, only mismatching buckets get a row-level diff:
+        compare_key = params['COMPARE_BUCKET_KEY'] if 'COMPARE_BUCKET_KEY' in params else None
+        compare = compare_two_tables_summary(old_current_table, previous_ver_table, params['BQ_AS_BATCH'],
+                                             bucket_key=compare_key)
 
-        num_rows = compare.total_rows
+        if not compare:
+            print('compare_tables failed')
+            return
 
-        if num_rows == 0:
+        if compare['same']:
             print('the tables are the same')
         else:
-            print('the tables are NOT the same and differ by {} rows'.format(num_rows))
+            print('the tables are NOT the same: {} vs {} rows, changed columns {}, '
+                  'mismatched buckets {}, differing rows {}'.format(compare['old_rows'], compare['new_rows'],
+                                                                    compare['changed_columns'],
+                                                                    compare['mismatched_buckets'],
+                                                                    compare['diff_rows']))
 
-        if not compare:
-            print('compare_tables failed')
-            return
         # move old table to a temporary location
-        elif compare and num_rows == 0:
+        if compare['same']:
             print('Move old table to temp location')
             table_moved = publish_table(old_current_table, table_temp)
 
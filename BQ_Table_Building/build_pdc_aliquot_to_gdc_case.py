@@ -31,7 +31,7 @@ from json import loads as json_loads
 from common_etl.support import confirm_google_vm, create_clean_target, \
                                generic_bq_harness, \
                                delete_table_bq_job, install_labels_and_desc, update_schema_with_dict, \
-                               generate_table_detail_files, publish_table
+                               generate_table_detail_files, publish_table, instrument_steps
 
 '''
 ----------------------------------------------------------------------------------------------
@@ -131,6 +131,9 @@ def main(args):
     with open(args[1], mode='r') as yaml_file:
         params, steps = load_config(yaml_file.read())
 
+    steps = instrument_steps(steps, params['RUN_LOG'] if 'RUN_LOG' in params else None,
+                             profile_dir=params['PROFILE_DIR'] if 'PROFILE_DIR' in params else None)
+
     #
     # Schemas and table descriptions are maintained in the github repo:
     #
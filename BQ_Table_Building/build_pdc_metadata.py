@@ -29,13 +29,12 @@ import requests
 import io
 from git import Repo
 from json import loads as json_loads
-from createSchemaP3 import build_schema
 
 from common_etl.support import get_the_bq_manifest, confirm_google_vm, create_clean_target, \
                                generic_bq_harness, build_file_list, upload_to_bucket, csv_to_bq, \
-                               build_pull_list_with_bq, BucketPuller, build_combined_schema, \
+                               build_pull_list_with_bq, BucketPuller, build_combined_schema, typing_tups_for, \
                                delete_table_bq_job, install_labels_and_desc, update_schema_with_dict, \
-                               generate_table_detail_files, publish_table
+                               generate_table_detail_files, publish_table, instrument_steps
 
 
 '''
@@ -353,6 +352,9 @@ def main(args):
     hold_schema_dict_aliquot = "{}/{}".format(home, params['HOLD_SCHEMA_DICT_ALIQUOT'])
     hold_schema_list_aliquot = "{}/{}".format(home, params['HOLD_SCHEMA_LIST_ALIQUOT'])
 
+    steps = instrument_steps(steps, params['RUN_LOG'] if 'RUN_LOG' in params else None,
+                             profile_dir=params['PROFILE_DIR'] if 'PROFILE_DIR' in params else None)
+
     if 'clear_target_directory' in steps:
         print('clear_target_directory')
         create_clean_target(local_files_dir)
@@ -403,22 +405,22 @@ def main(args):
 
     if 'analyze_the_schema' in steps:
         print('analyze_the_schema')
-        typing_tups = build_schema(prog_tsv, params['SCHEMA_SAMPLE_SKIPS'])
+        typing_tups = typing_tups_for(params, prog_tsv)
         full_file_prefix = "{}/{}".format(params['PROX_DESC_PREFIX'], params['TARGET_TABLE_PROG'])
         schema_dict_loc = "{}_schema.json".format(full_file_prefix)
         build_combined_schema(None, None,
                               typing_tups, hold_schema_list_prog, hold_schema_dict_prog)
-        typing_tups = build_schema(case_tsv, params['SCHEMA_SAMPLE_SKIPS'])
+        typing_tups = typing_tups_for(params, case_tsv)
         full_file_prefix = "{}/{}".format(params['PROX_DESC_PREFIX'], params['FINAL_TARGET_CASE_TABLE'])
         schema_dict_loc = "{}_schema.json".format(full_file_prefix)
         build_combined_schema(None, None,
                               typing_tups, hold_schema_list_case, hold_schema_dict_case)
-        typing_tups = build_schema(sample_tsv, params['SCHEMA_SAMPLE_SKIPS'])
+        typing_tups = typing_tups_for(params, sample_tsv)
         full_file_prefix = "{}/{}".format(params['PROX_DESC_PREFIX'], params['TARGET_TABLE_SAMPLE'])
         schema_dict_loc = "{}_schema.json".format(full_file_prefix)
         build_combined_schema(None, None,
                               typing_tups, hold_schema_list_sample, hold_schema_dict_sample)
-        typing_tups = build_schema(aliquot_tsv, params['SCHEMA_SAMPLE_SKIPS'])
+        typing_tups = typing_tups_for(params, aliquot_tsv)
         full_file_prefix = "{}/{}".format(params['PROX_DESC_PREFIX'], params['TARGET_TABLE_ALIQUOT'])
         schema_dict_loc = "{}_schema.json".format(full_file_prefix)
         build_combined_schema(None, None,
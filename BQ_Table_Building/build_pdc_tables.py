@@ -1260,6 +1260,9 @@ def main(args):
     except ValueError as err:
         has_fatal_error(str(err), ValueError)
 
+    steps = instrument_steps(steps, BQ_PARAMS['RUN_LOG'] if 'RUN_LOG' in BQ_PARAMS else None,
+                             profile_dir=BQ_PARAMS['PROFILE_DIR'] if 'PROFILE_DIR' in BQ_PARAMS else None)
+
     if 'delete_tables' in steps:
         for table_id in BQ_PARAMS['DELETE_TABLES']:
             delete_bq_table(table_id)
@@ -1438,7 +1441,11 @@ def main(args):
         jsonl_start = time.time()
 
         csa_jsonl_fp = get_scratch_fp(BQ_PARAMS, get_table_name(BQ_PARAMS['CASE_ALIQUOT_TABLE']) + '.jsonl')
-        build_cases_aliquots_jsonl(csa_jsonl_fp)
+        cache = step_cache(BQ_PARAMS, 'build_cases_aliquots_jsonl', outputs=[csa_jsonl_fp],
+                           config={'release': BQ_PARAMS['RELEASE'], 'limit': API_PARAMS['CSA_LIMIT']})
+        if not cache.restore():
+            build_cases_aliquots_jsonl(csa_jsonl_fp)
+            cache.save()
         upload_to_bucket(BQ_PARAMS, csa_jsonl_fp)
 
         jsonl_end = time.time() - jsonl_start
@@ -1559,7 +1566,14 @@ def main(args):
     if 'build_uniprot_tsv' in steps:
         uniprot_dest_file = BQ_PARAMS['UNIPROT_MAPPING_TABLE'] + '.tsv'
         uniprot_dest_fp = get_scratch_fp(BQ_PARAMS, uniprot_dest_file)
-        build_uniprot_tsv(uniprot_dest_fp)
+        cache = step_cache(BQ_PARAMS, 'build_uniprot_tsv', outputs=[uniprot_dest_fp],
+                           config={'mapping_file': API_PARAMS['UNIPROT_MAPPING_FILE'],
+                                   'mapping_version': bucket_file_fingerprint(BQ_PARAMS,
+                                                                              API_PARAMS['UNIPROT_MAPPING_FILE']),
+                                   'mapping_keys': API_PARAMS['UNIPROT_MAPPING_KEYS']})
+        if not cache.restore():
+            build_uniprot_tsv(uniprot_dest_fp)
+            cache.save()
         upload_to_bucket(BQ_PARAMS, uniprot_dest_fp)
 
     if 'build_uniprot_table' in steps:
@@ -239,6 +239,9 @@ def main(args):
     except ValueError as err:
         has_fatal_error(str(err), ValueError)
 
+    steps = instrument_steps(steps, BQ_PARAMS['RUN_LOG'] if 'RUN_LOG' in BQ_PARAMS else None,
+                             profile_dir=BQ_PARAMS['PROFILE_DIR'] if 'PROFILE_DIR' in BQ_PARAMS else None)
+
     if 'build_studies_table' in steps:
         console_out("Building studies table...")
         studies_start = time.time()
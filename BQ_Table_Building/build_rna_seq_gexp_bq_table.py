@@ -30,15 +30,23 @@ import zipfile
 import gzip
 from os.path import expanduser
 from json import loads as json_loads
-from createSchemaP3 import build_schema
 from datetime import date
 import re
 from common_etl.support import create_clean_target, generic_bq_harness, upload_to_bucket, \
                                csv_to_bq_write_depo, delete_table_bq_job, confirm_google_vm, \
                                build_file_list, get_the_bq_manifest, BucketPuller, build_pull_list_with_bq, \
-                               build_combined_schema, generic_bq_harness_write_depo, \
+                               build_combined_schema, typing_tups_for, generic_bq_harness_write_depo, \
                                install_labels_and_desc, update_schema, generate_table_detail_files, publish_table, \
-                               customize_labels_and_desc, update_status_tag, compare_two_tables
+                               customize_labels_and_desc, update_status_tag, compare_two_tables_summary, \
+                               upload_to_bucket_in_parts, bucket_parts_uri, instrument_steps, \
+                               bq_preflight_steps, step_cache, manifest_checksums, schema_scan_config
+
+'''
+----------------------------------------------------------------------------------------------
+The steps that only run SQL, which are the ones a BQ_DRY_RUN preflight estimates
+'''
+BQ_SQL_STEPS = ('attach_ids_to_files', 'extract_platform', 'attach_barcodes_to_ids', 'merge_counts_and_metadata',
+                'merge_all', 'glue_gene_names')
 
 '''
 ----------------------------------------------------------------------------------------------
@@ -472,6 +480,11 @@ def main(args):
 
     metadata_rel = "".join(["r", str(params['METADATA_REL'])]) if 'METADATA_REL' in params else release
 
+    if 'BQ_DRY_RUN' in params and params['BQ_DRY_RUN']:
+        steps = bq_preflight_steps(steps, BQ_SQL_STEPS)
+    steps = instrument_steps(steps, params['RUN_LOG'] if 'RUN_LOG' in params else None, program=params['PROGRAM'],
+                             profile_dir=params['PROFILE_DIR'] if 'PROFILE_DIR' in params else None)
+
 
     if 'clear_target_directory' in steps:
         for file_set in file_sets:
@@ -485,11 +498,12 @@ def main(args):
             table_for_count = manifest_table.format(count_name)
             tsv_for_count = params['BUCKET_MANIFEST_TSV'].format(count_name)
             max_files = params['MAX_FILES'] if 'MAX_FILES' in params else None
+            use_storage_api = params['USE_BQ_STORAGE_API'] if 'USE_BQ_STORAGE_API' in params else False
             manifest_success = get_the_bq_manifest(params['FILE_TABLE'].format(metadata_rel), count_dict['filters'], max_files,
                                                    params['WORKING_PROJECT'], params['SCRATCH_DATASET'],
                                                    table_for_count, params['WORKING_BUCKET'],
                                                    tsv_for_count, mani_for_count,
-                                                   params['BQ_AS_BATCH'])
+                                                   params['BQ_AS_BATCH'], use_storage_api=use_storage_api)
             if not manifest_success:
                 print("Failure generating manifest")
                 return
@@ -511,12 +525,13 @@ def main(args):
             full_manifest = '{}.{}.{}'.format(params['WORKING_PROJECT'],
                                               params['SCRATCH_DATASET'],
                                               table_for_count)
+            use_storage_api = params['USE_BQ_STORAGE_API'] if 'USE_BQ_STORAGE_API' in params else False
             build_pull_list_with_bq(full_manifest, params['INDEXD_BQ_TABLE'].format(metadata_rel),
                                     params['WORKING_PROJECT'], params['SCRATCH_DATASET'],
                                     pull_table_for_count,
                                     params['WORKING_BUCKET'],
                                     bucket_pull_list_for_count,
-                                    local_pull_for_count, params['BQ_AS_BATCH'])
+                                    local_pull_for_count, params['BQ_AS_BATCH'], use_storage_api=use_storage_api)
     #
     # Now hitting GDC cloud buckets. Get the files in the pull list:
     #
@@ -549,7 +564,13 @@ def main(args):
             file_traversal_list_for_count = file_traversal_list.format(count_name)
             with open(file_traversal_list_for_count, mode='r') as traversal_list_file:
                 all_files = traversal_list_file.read().splitlines()
+            mani_for_count = manifest_file.format(count_name)
+            checksums = manifest_checksums(mani_for_count) if os.path.isfile(mani_for_count) else None
+            cache = step_cache(params, 'concat_all_files', all_files, [one_big_tsv.format(count_name)],
+                               {'header': header}, checksums)
+            if not cache.restore():
                 concat_all_files(all_files, one_big_tsv.format(count_name), header)
+                cache.save()
 
     #
     # Schemas and table descriptions are maintained in the github repo:
@@ -625,11 +646,17 @@ def main(args):
             print('analyze_the_schema')
             for file_set in file_sets:
                 count_name, _ = next(iter(file_set.items()))
-                typing_tups = build_schema(one_big_tsv.format(count_name), params['SCHEMA_SAMPLE_SKIPS'])
                 full_file_prefix = "{}/{}".format(params['PROX_DESC_PREFIX'], draft_table.format(schema_release))
                 schema_dict_loc = "{}_schema.json".format(full_file_prefix)
+                cache = step_cache(params, 'analyze_the_schema', [one_big_tsv.format(count_name), schema_dict_loc],
+                                   [hold_schema_list.format(count_name), hold_schema_dict.format(count_name)],
+                                   schema_scan_config(params))
+                if cache.restore():
+                    continue
+                typing_tups = typing_tups_for(params, one_big_tsv.format(count_name))
                 build_combined_schema(None, schema_dict_loc,
                                       typing_tups, hold_schema_list.format(count_name), hold_schema_dict.format(count_name))
+                cache.save()
 
     bucket_target_blob_sets = {}
     for file_set in file_sets:
@@ -638,12 +665,30 @@ def main(args):
                                                                           params['PROGRAM'], params['DATA_TYPE'],
                                                                           count_name)
 
+    #
+    # Big TSVs can optionally go up as UPLOAD_PARTS concurrent pieces. Unless UPLOAD_AS_WILDCARD is set,
+    # the pieces are composed back into a single bucket file:
+    #
+
+    upload_parts = params['UPLOAD_PARTS'] if 'UPLOAD_PARTS' in params else None
+    upload_compose = not params['UPLOAD_AS_WILDCARD'] if 'UPLOAD_AS_WILDCARD' in params else True
+    upload_gzip = params['UPLOAD_GZIP'] if 'UPLOAD_GZIP' in params else False
+
     if 'upload_to_bucket' in steps:
         for file_set in file_sets:
             count_name, _ = next(iter(file_set.items()))
-            upload_to_bucket(params['WORKING_BUCKET'], 
-                             bucket_target_blob_sets[count_name],
-                             one_big_tsv.format(count_name))
+            if upload_parts is None:
+                upload_to_bucket(params['WORKING_BUCKET'],
+                                 bucket_target_blob_sets[count_name],
+                                 one_big_tsv.format(count_name))
+            else:
+                uploaded_uri = upload_to_bucket_in_parts(params['WORKING_BUCKET'],
+                                                         bucket_target_blob_sets[count_name],
+                                                         one_big_tsv.format(count_name), upload_parts,
+                                                         upload_compose, upload_gzip)
+                if uploaded_uri is None:
+                    print("upload_to_bucket failed")
+                    return
             
     if 'delete_all_bq' in steps:
         table_cleaner(params, file_sets, True)
@@ -651,7 +696,11 @@ def main(args):
     if 'create_bq_from_tsv' in steps:
         for file_set in file_sets:
             count_name, _ = next(iter(file_set.items()))
-            bucket_src_url = 'gs://{}/{}'.format(params['WORKING_BUCKET'], bucket_target_blob_sets[count_name])
+            if upload_parts is None:
+                bucket_src_url = 'gs://{}/{}'.format(params['WORKING_BUCKET'], bucket_target_blob_sets[count_name])
+            else:
+                bucket_src_url = bucket_parts_uri(params['WORKING_BUCKET'], bucket_target_blob_sets[count_name],
+                                                  upload_compose, upload_gzip)
             hold_schema_list_for_count = hold_schema_list.format(count_name)
             with open(hold_schema_list_for_count, mode='r') as schema_hold_dict:
                 typed_schema = json_loads(schema_hold_dict.read())
@@ -850,20 +899,26 @@ def main(args):
 
         print('Compare {} to {}'.format(old_current_table, previous_ver_table))
 
-        compare = compare_two_tables(old_current_table, previous_ver_table, params['BQ_AS_BATCH'])
+        # Fingerprint both tables; with a bucket key, only mismatching buckets get a row-level diff:
+        compare_key = params['COMPARE_BUCKET_KEY'] if 'COMPARE_BUCKET_KEY' in params else None
+        compare = compare_two_tables_summary(old_current_table, previous_ver_table, params['BQ_AS_BATCH'],
+                                             bucket_key=compare_key)
 
-        num_rows = compare.total_rows
+        if not compare:
+            print('compare_tables failed')
+            return
 
-        if num_rows == 0:
+        if compare['same']:
             print('the tables are the same')
         else:
-            print('the tables are NOT the same and differ by {} rows'.format(num_rows))
+            print('the tables are NOT the same: {} vs {} rows, changed columns {}, '
+                  'mismatched buckets {}, differing rows {}'.format(compare['old_rows'], compare['new_rows'],
+                                                                    compare['changed_columns'],
+                                                                    compare['mismatched_buckets'],
+                                                                    compare['diff_rows']))
 
-        if not compare:
-            print('compare_tables failed')
-            return
         # move old table to a temporary location
-        elif compare and num_rows == 0:
+        if compare['same']:
             print('Move old table to temp location')
             table_moved = publish_table(old_current_table, table_temp)
 
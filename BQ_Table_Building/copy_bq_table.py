@@ -28,7 +28,7 @@ import yaml
 import io
 from json import loads as json_loads
 
-from common_etl.support import confirm_google_vm, publish_table
+from common_etl.support import confirm_google_vm, publish_table, instrument_steps
 
 
 '''
@@ -77,6 +77,9 @@ def main(args):
     with open(args[1], mode='r') as yaml_file:
         params, steps = load_config(yaml_file.read())
 
+    steps = instrument_steps(steps, params['RUN_LOG'] if 'RUN_LOG' in params else None,
+                             profile_dir=params['PROFILE_DIR'] if 'PROFILE_DIR' in params else None)
+
     #
     # publish table:
     #
@@ -20,7 +20,7 @@ import sys
 import yaml
 import io
 from git import Repo
-from common_etl.support import create_clean_target, generate_dataset_desc_file, create_bq_dataset
+from common_etl.support import create_clean_target, generate_dataset_desc_file, create_bq_dataset, instrument_steps
 
 '''
 ----------------------------------------------------------------------------------------------
@@ -66,6 +66,9 @@ def main(args):
         print("Bad YAML load")
         return
 
+    steps = instrument_steps(steps, params['RUN_LOG'] if 'RUN_LOG' in params else None,
+                             profile_dir=params['PROFILE_DIR'] if 'PROFILE_DIR' in params else None)
+
     #
     # Dataset descriptions are maintained in the github repo:
     #
@@ -22,7 +22,8 @@ import io
 from git import Repo
 from json import loads as json_loads
 from common_etl.support import install_labels_and_desc, update_schema_with_dict, \
-                               create_clean_target, generate_table_detail_files
+                               create_clean_target, generate_table_detail_files, table_state_from_files, \
+                               sync_table_metadata, instrument_steps
 
 '''
 ----------------------------------------------------------------------------------------------
@@ -68,6 +69,9 @@ def main(args):
         print("Bad YAML load")
         return
 
+    steps = instrument_steps(steps, params['RUN_LOG'] if 'RUN_LOG' in params else None,
+                             profile_dir=params['PROFILE_DIR'] if 'PROFILE_DIR' in params else None)
+
     #
     # Schemas and table descriptions are maintained in the github repo:
     #
@@ -131,6 +135,25 @@ def main(args):
 
         print('job completed')
 
+    #
+    # Alternative to update_field_descriptions + update_table_description: bring every table in the
+    # fix list up to date in one concurrent pass, touching only the fields that actually differ:
+    #
+
+    if 'sync_table_metadata' in steps:
+        print('sync_table_metadata')
+        desired_states = {}
+        for dict in params['FIX_LIST']:
+            table, repo_file = next(iter(dict.items()))
+            full_file_prefix = "{}/{}".format(params['PROX_DESC_PREFIX'], table)
+            desired_states[table] = table_state_from_files(full_file_prefix)
+        num_workers = params['SYNC_WORKERS'] if 'SYNC_WORKERS' in params else 8
+        results = sync_table_metadata(desired_states, project=params['TARGET_PROJECT'], num_workers=num_workers)
+        if results is None:
+            print("sync_table_metadata failed")
+            return
+        print('job completed')
+
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -19,9 +19,12 @@ limitations under the License.
 import sys
 import yaml
 import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from google.cloud import bigquery
-from common_etl.support import bq_harness_with_result, confirm_google_vm
+from common_etl.support import confirm_google_vm, view_row_counts, cached_view_row_counts, instrument_steps
 
 '''
 ----------------------------------------------------------------------------------------------
@@ -87,105 +90,156 @@ def shadow_datasets(source_client, shadow_client, shadow_project, skip_datasets,
 
     return True
 
+'''
+----------------------------------------------------------------------------------------------
+Spaces out table creation calls across the worker threads, so a parallel run does not trip the
+BigQuery API rate limits
+'''
+
+class CreateRateLimiter(object):
+    def __init__(self, creates_per_second):
+        self._interval = 1.0 / creates_per_second if creates_per_second else 0.0
+        self._lock = threading.Lock()
+        self._next_time = time.monotonic()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self._interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+'''
+----------------------------------------------------------------------------------------------
+Build and create one shadow table or view
+'''
+
+def create_shadow_table(shadow_client, tbl_obj, table_id, use_query, use_row_count, shadow_prefix, rate_limiter):
+
+    print(table_id)
+
+    #
+    # Make a completely new copy of the source schema. Do we have to? Probably not. Paranoid.
+    #
+    targ_schema = []
+    for sf in tbl_obj.schema:
+        name = sf.name
+        field_type = sf.field_type
+        mode = sf.mode
+        desc = sf.description
+        fields = tuple(sf.fields)
+        # no "copy constructor"?
+        targ_schema.append(bigquery.SchemaField(name, field_type, mode, desc, fields))
+
+    #
+    # Not supposed to submit a schema for a view! But we need to update it later to get the
+    # descriptions brought across
+    #
+
+    if use_query is None:
+        targ_table = bigquery.Table(table_id, schema=targ_schema)
+    else:
+        targ_table = bigquery.Table(table_id)
+
+    targ_table.friendly_name = tbl_obj.friendly_name
+    print("Table {} FN: {}".format(table_id, tbl_obj.friendly_name))
+    targ_table.description = tbl_obj.description
+
+    if tbl_obj.labels is not None:
+        targ_table.labels = tbl_obj.labels.copy()
+    else:
+        targ_table.labels = {}
+
+    #
+    # The way a table turns into a view is by setting the view_query property:
+    #
+
+    if use_query is not None:
+        targ_table.view_query = use_query
+
+        #
+        # "Number of rows" in a shadow empty table is provided through a private tag label.
+        #
+
+        num_row_tag = "{}_{}".format(shadow_prefix, "num_rows")
+        targ_table.labels[num_row_tag] = use_row_count
+
+    rate_limiter.wait()
+    shadow_table = shadow_client.create_table(targ_table)
+
+    #
+    # If we created a view, update the schema after creation.
+    #
+
+    if use_query is not None:
+        rate_limiter.wait()
+        shadow_table.schema = targ_schema
+        shadow_client.update_table(shadow_table, ["schema"])
+
+    return table_id
+
 '''
 ----------------------------------------------------------------------------------------------
 Create all empty shadow tables
+Table metadata is fetched and shadow tables are created by a pool of worker threads. The row
+counts for the views of each dataset are gathered with batched UNION ALL queries, and if a
+view_count_cache file is given, views whose definition has not changed reuse the cached count.
 '''
 
 def create_all_shadow_tables(source_client, shadow_client, source_project, target_project,
-                             do_batch, shadow_prefix, skip_datasets, do_tables):
+                             do_batch, shadow_prefix, skip_datasets, do_tables, num_workers=8,
+                             creates_per_second=5, max_views_per_query=100, view_count_cache=None):
 
+    rate_limiter = CreateRateLimiter(creates_per_second)
     dataset_list = source_client.list_datasets()
 
-    for dataset in dataset_list:
-        # Some datasets (security logs) should be ignored outright:
-        if dataset.dataset_id in skip_datasets:
-            continue
-        table_list = list(source_client.list_tables(dataset.dataset_id))
-        for tbl in table_list:
-            tbl_obj = source_client.get_table(tbl)
-            use_row_count = tbl_obj.num_rows
-            use_query = None
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        create_futures = []
+        for dataset in dataset_list:
+            # Some datasets (security logs) should be ignored outright:
+            if dataset.dataset_id in skip_datasets:
+                continue
+            table_list = list(source_client.list_tables(dataset.dataset_id))
+            tbl_objs = list(executor.map(source_client.get_table, table_list))
 
             #
             # If we have a view, then we need to extract the row count through a query:
             #
 
-            if tbl_obj.view_query is not None:
-                if do_tables:
-                    continue
-                src_tab_id = '{}.{}.{}'.format(source_project, dataset.dataset_id, tbl.table_id)
-                sql = 'SELECT COUNT(*) as count FROM `{}`'.format(src_tab_id)
-                results = bq_harness_with_result(sql, do_batch)
-                for row in results:
-                    use_row_count = row.count
-                    break
-                use_query = tbl_obj.view_query.replace(source_project, target_project)
-
-            if do_tables or (use_query is not None):
-
-                table_id = '{}.{}.{}'.format(target_project, dataset.dataset_id, tbl.table_id)
-                print(table_id)
-
-                #
-                # Make a completely new copy of the source schema. Do we have to? Probably not. Paranoid.
-                #
-                targ_schema = []
-                for sf in tbl_obj.schema:
-                    name = sf.name
-                    field_type = sf.field_type
-                    mode = sf.mode
-                    desc = sf.description
-                    fields = tuple(sf.fields)
-                    # no "copy constructor"?
-                    targ_schema.append(bigquery.SchemaField(name, field_type, mode, desc, fields))
-
-                #
-                # Not supposed to submit a schema for a view! But we need to update it later to get the
-                # descriptions brought across
-                #
-
-                if use_query is None:
-                    targ_table = bigquery.Table(table_id, schema=targ_schema)
-                else:
-                    targ_table = bigquery.Table(table_id)
-
-                targ_table.friendly_name = tbl_obj.friendly_name
-                print("Table {} FN: {}".format(table_id, tbl_obj.friendly_name))
-                targ_table.description = tbl_obj.description
-
-                if tbl_obj.labels is not None:
-                    targ_table.labels = tbl_obj.labels.copy()
-                else:
-                    targ_table.labels = {}
-
-                #
-                # The way a table turns into a view is by setting the view_query property:
-                #
-
-                if use_query is not None:
-                    targ_table.view_query = use_query
-
-                    #
-                    # "Number of rows" in a shadow empty table is provided through a private tag label.
-                    #
-
-                    num_row_tag = "{}_{}".format(shadow_prefix, "num_rows")
-                    targ_table.labels[num_row_tag] = use_row_count
-
-                shadow_table = shadow_client.create_table(targ_table)
-
-                #
-                # If we created a view, update the schema after creation.
-                #
-
-                if use_query is not None:
-                    shadow_table.schema = targ_schema
-                    shadow_client.update_table(shadow_table, ["schema"])
+            view_counts = {}
+            if not do_tables:
+                view_queries = {tbl_obj.table_id: tbl_obj.view_query for tbl_obj in tbl_objs
+                                if tbl_obj.view_query is not None}
+                if view_queries and view_count_cache is not None:
+                    view_counts = cached_view_row_counts(source_project, dataset.dataset_id, view_queries,
+                                                         do_batch, view_count_cache, max_views_per_query)
+                elif view_queries:
+                    view_counts = view_row_counts(source_project, dataset.dataset_id, list(view_queries),
+                                                  do_batch, max_views_per_query)
+                if view_counts is None:
+                    print("View row count query failed for {}".format(dataset.dataset_id))
+                    return False
+
+            for tbl_obj in tbl_objs:
+                use_row_count = tbl_obj.num_rows
+                use_query = None
+                if tbl_obj.view_query is not None:
+                    if do_tables:
+                        continue
+                    use_row_count = view_counts[tbl_obj.table_id]
+                    use_query = tbl_obj.view_query.replace(source_project, target_project)
+
+                if do_tables or (use_query is not None):
+                    table_id = '{}.{}.{}'.format(target_project, dataset.dataset_id, tbl_obj.table_id)
+                    create_futures.append(executor.submit(create_shadow_table, shadow_client, tbl_obj, table_id,
+                                                          use_query, use_row_count, shadow_prefix, rate_limiter))
+
+        for future in as_completed(create_futures):
+            future.result()
 
     return True
 
-
 '''
 ----------------------------------------------------------------------------------------------
 Friendly names for views to not appear in the console. Dump them out to check what is there
@@ -281,10 +335,16 @@ def main(args):
     skip_tables = params['SKIP_TABLES']
     shadow_prefix = params['PRIVATE_METADATA_PREFIX']
     skip_datasets = params['SKIP_DATASETS']
+    num_workers = params['SHADOW_WORKERS'] if 'SHADOW_WORKERS' in params else 8
+    creates_per_second = params['SHADOW_CREATES_PER_SECOND'] if 'SHADOW_CREATES_PER_SECOND' in params else 5
+    view_count_cache = params['VIEW_COUNT_CACHE'] if 'VIEW_COUNT_CACHE' in params else None
 
     source_client = bigquery.Client(project=source_project)
     shadow_client = bigquery.Client(project=shadow_project)
 
+    steps = instrument_steps(steps, params['RUN_LOG'] if 'RUN_LOG' in params else None,
+                             profile_dir=params['PROFILE_DIR'] if 'PROFILE_DIR' in params else None)
+
     if 'show_friendly_names' in steps:
         success = dumpViewFriendlyNames(source_client, source_project, skip_datasets)
         if not success:
@@ -317,7 +377,8 @@ def main(args):
     if 'create_all_shadow_tables' in steps:
         # Create just tables:
         success = create_all_shadow_tables(source_client, shadow_client, source_project,
-                                           shadow_project, do_batch, shadow_prefix, skip_datasets, True)
+                                           shadow_project, do_batch, shadow_prefix, skip_datasets, True,
+                                           num_workers, creates_per_second)
         if not success:
             print("create_all_shadow_tables failed")
             return
@@ -325,7 +386,8 @@ def main(args):
     if 'create_all_shadow_views' in steps:
         # Create just views:
         success = create_all_shadow_tables(source_client, shadow_client, source_project,
-                                           shadow_project, do_batch, shadow_prefix, skip_datasets, False)
+                                           shadow_project, do_batch, shadow_prefix, skip_datasets, False,
+                                           num_workers, creates_per_second, view_count_cache=view_count_cache)
         if not success:
             print("create_all_shadow_views failed")
             return
@@ -34,7 +34,7 @@ from common_etl.support import generic_bq_harness, confirm_google_vm, \
                                bq_harness_with_result, delete_table_bq_job, \
                                bq_table_exists, bq_table_is_empty, create_clean_target, \
                                generate_table_detail_files, customize_labels_and_desc, \
-                               update_schema_with_dict, install_labels_and_desc, publish_table
+                               update_schema_with_dict, install_labels_and_desc, publish_table, instrument_steps
 
 '''
 ----------------------------------------------------------------------------------------------
@@ -85,6 +85,9 @@ def main(args):
         print("Bad YAML load")
         return
 
+    steps = instrument_steps(steps, params['RUN_LOG'] if 'RUN_LOG' in params else None,
+                             profile_dir=params['PROFILE_DIR'] if 'PROFILE_DIR' in params else None)
+
     #
     # Schemas and table descriptions are maintained in the github repo. Only do this once:
     #
@@ -34,7 +34,16 @@ from common_etl.support import generic_bq_harness, confirm_google_vm, \
                                bq_harness_with_result, delete_table_bq_job, \
                                bq_table_exists, bq_table_is_empty, create_clean_target, \
                                generate_table_detail_files, customize_labels_and_desc, \
-                               update_schema_with_dict, install_labels_and_desc, publish_table
+                               update_schema_with_dict, install_labels_and_desc, publish_table, \
+                               instrument_steps, timed_step, bq_preflight_steps, bq_dry_run_enabled
+
+'''
+----------------------------------------------------------------------------------------------
+The steps that only run SQL, which are the ones a BQ_DRY_RUN preflight estimates
+'''
+BQ_SQL_STEPS = ('count_aliquots', 'pull_slides', 'repair_slides', 'pull_aliquot', 'expand_aliquots',
+                'pull_case', 'slide_barcodes', 'aliquot_barcodes', 'case_barcodes', 'union_tables',
+                'create_final_table')
 
 '''
 ----------------------------------------------------------------------------------------------
@@ -825,7 +834,7 @@ def do_dataset_and_build(steps, build, build_tag, path_tag, dataset_tuple,
             print("{} {} pull_slides job failed".format(dataset_tuple[0], build))
             return False
 
-        if bq_table_is_empty(params['TARGET_DATASET'], step_zero_table):
+        if not bq_dry_run_enabled() and bq_table_is_empty(params['TARGET_DATASET'], step_zero_table):
             delete_table_bq_job(params['TARGET_DATASET'], step_zero_table)
             print("{} pull_slide table result was empty: table deleted".format(params['SLIDE_STEP_0_TABLE']))
 
@@ -851,7 +860,7 @@ def do_dataset_and_build(steps, build, build_tag, path_tag, dataset_tuple,
             print("{} {} pull_aliquot job failed".format(dataset_tuple[0], build))
             return False
 
-        if bq_table_is_empty(params['TARGET_DATASET'], step_zero_table):
+        if not bq_dry_run_enabled() and bq_table_is_empty(params['TARGET_DATASET'], step_zero_table):
             delete_table_bq_job(params['TARGET_DATASET'], step_zero_table)
             print("{} pull_aliquot table result was empty: table deleted".format(params['ALIQUOT_STEP_0_TABLE']))
 
@@ -878,7 +887,7 @@ def do_dataset_and_build(steps, build, build_tag, path_tag, dataset_tuple,
             print("{} {} pull_clinbio job failed".format(dataset_tuple[0], build))
             return False
 
-        if bq_table_is_empty(params['TARGET_DATASET'], step_one_table):
+        if not bq_dry_run_enabled() and bq_table_is_empty(params['TARGET_DATASET'], step_one_table):
             delete_table_bq_job(params['TARGET_DATASET'], step_one_table)
             print("{} pull_case table result was empty: table deleted".format(params['CASE_STEP_1_TABLE']))
 
@@ -1126,6 +1135,11 @@ def main(args):
         print("Bad YAML load")
         return
 
+    if 'BQ_DRY_RUN' in params and params['BQ_DRY_RUN']:
+        steps = bq_preflight_steps(steps, BQ_SQL_STEPS)
+    steps = instrument_steps(steps, params['RUN_LOG'] if 'RUN_LOG' in params else None,
+                             profile_dir=params['PROFILE_DIR'] if 'PROFILE_DIR' in params else None)
+
     #
     # Schemas and table descriptions are maintained in the github repo. Only do this once:
     #
@@ -1162,6 +1176,7 @@ def main(args):
             print("count_aliquots failed: {}".format(str(ex)))
             return
 
+    steps.finish()
     for build, build_tag, path_tag in zip(builds, build_tags, path_tags):
         file_table = "{}_{}".format(params['FILE_TABLE'], build_tag)
         do_programs = extract_program_names(file_table, params['BQ_AS_BATCH']) if programs is None else programs
@@ -1171,8 +1186,10 @@ def main(args):
         print(dataset_tuples)
         for dataset_tuple in dataset_tuples:
             print ("Processing build {} ({}) for program {}".format(build, build_tag, dataset_tuple[0]))
-            ok = do_dataset_and_build(steps, build, build_tag, path_tag, dataset_tuple,
-                                      aliquot_map_programs, params, schema_tags)
+            with timed_step("{}_{}".format(dataset_tuple[1], build), program=dataset_tuple[0]):
+                ok = do_dataset_and_build(steps, build, build_tag, path_tag, dataset_tuple,
+                                          aliquot_map_programs, params, schema_tags)
+                steps.finish()
             if not ok:
                 return
             
@@ -47,6 +47,7 @@ source ${HOME}/setEnvVarsGDCMetadata.sh
 #BUILD_NORM_TSVS=run
 #COMPARE_TO_LAST=run
 #DETAILED_DIFFS=run
+#RELEASE_DIFFS=run
 #RAW_SCHEMA_CHECK=run
 #OUTPUT_LOOK_FILES=run
 #COPY_ANNOT_SCHEMA=run
@@ -78,6 +79,7 @@ if [ "${QC_CHECK}" == "run" ] || \
    [ "${BUILD_NORM_TSVS}" == "run" ] || \
    [ "${COMPARE_TO_LAST}" == "run" ] || \
    [ "${DETAILED_DIFFS}" == "run" ] || \
+   [ "${RELEASE_DIFFS}" == "run" ] || \
    [ "${COPY_ANNOT_SCHEMA}" == "run" ] || \
    [ "${LOAD_BQ}" == "run" ] || \
    [ "${DESC_AND_LABELS}" == "run" ] || \
@@ -106,7 +108,8 @@ fi
 
 #
 # Query the GDC APIs. This takes a **long** time, and should be done separately and allowed to complete before
-# doing phase II operations:
+# doing phase II operations. The case crawl checkpoints as it goes, so if it dies just set the API_PULL
+# flag and run again; it picks up where it left off:
 #
 
 if [ "${API_PULL_LEGACY}" == "run" ]; then
@@ -523,6 +526,40 @@ if [ "${DETAILED_DIFFS}" == "run" ]; then
     deactivate
 fi
 
+#
+# Same questions as COMPARE_TO_LAST plus DETAILED_DIFFS, answered in one streaming pass per table: both
+# releases are sorted by id on disk and merge-joined, so neither has to fit in memory:
+#
+
+if [ "${RELEASE_DIFFS}" == "run" ]; then
+    echo "Running RELEASE_DIFFS"
+    cd ${REL_ROOT}
+    source ~/pyVenvForThree/bin/activate
+    OLD_PATH=${PREV_RELNAME}norm-forBQ
+    NEW_PATH=${RELNAME}norm-forBQ
+
+    echo "##### ALIQUOT RELEASE DIFFS ######"
+    python3 scripts/releaseDiff.py ${OLD_PATH}/aliqMap.merge.t1 ${NEW_PATH}/aliqMap.merge.t1 aliquot_gdc_id \
+            -g project_id,sample_type -o scratch/reldiff_aliquot_ -d scratch
+
+    echo "##### SLIDE RELEASE DIFFS ######"
+    python3 scripts/releaseDiff.py ${OLD_PATH}/slidMap.merge.t1 ${NEW_PATH}/slidMap.merge.t1 slide_gdc_id \
+            -g project_id,sample_type -o scratch/reldiff_slide_ -d scratch
+
+    echo "##### CASE RELEASE DIFFS ######"
+    python3 scripts/releaseDiff.py ${OLD_PATH}/caseData.merge.t1 ${NEW_PATH}/caseData.merge.t1 case_id \
+            -g project_id -o scratch/reldiff_caseData_ -d scratch
+
+    echo "##### CURRENT FILE RELEASE DIFFS ######"
+    python3 scripts/releaseDiff.py ${OLD_PATH}/fileData.current.t1 ${NEW_PATH}/fileData.current.t1 file_id \
+            -g cases__project__project_id,data_format -o scratch/reldiff_currentFiles_ -d scratch
+
+    echo "##### LEGACY FILE RELEASE DIFFS ######"
+    python3 scripts/releaseDiff.py ${OLD_PATH}/fileData.legacy.t1 ${NEW_PATH}/fileData.legacy.t1 file_id \
+            -g cases__project__project_id,data_format -o scratch/reldiff_legacyFiles_ -d scratch
+    deactivate
+fi
+
 #
 # If the raw schemas are all good, we can swap in the prepared schemas, descriptions, and labels from our BQEcosystem repo:
 #
@@ -1045,21 +1045,19 @@ def examineFilesInfo(fileID_dict):
 ## -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 
 def mergeStrings(aVec, nMax):
-    mStr = ''
+    ## dedup through a set: the old list membership test was quadratic
+    uSet = set()
     uVec = []
-    for ii in range(len(aVec)):
-        if (aVec[ii] not in uVec): uVec += [aVec[ii]]
-
-    if (len(uVec) > nMax): return ("multi")
+    for aVal in aVec:
+        if (aVal not in uSet):
+            uSet.add(aVal)
+            uVec += [aVal]
+            if (len(uVec) > nMax): return ("multi")
 
     ## 04/05/2019 -- removing the SORT call here
     ## uVec.sort()
 
-    for ii in range(len(uVec)):
-        mStr += '%s' % uVec[ii]
-        if (ii < len(uVec) - 1): mStr += ';'
-
-    return (mStr)
+    return (';'.join(['%s' % aVal for aVal in uVec]))
 
 
 ## -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
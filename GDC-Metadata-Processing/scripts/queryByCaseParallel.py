@@ -0,0 +1,523 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+----------------------------------------------------------------------------------------------
+Python 3 replacement for the per-case loop in queryByCase.py. That script asks the GDC for one
+case, then for that case's files, then moves on to the next case, so a full pull takes days. Here
+a bounded pool of worker threads crawls the cases concurrently, each thread holding its own
+keep-alive session. Results are handed back to a single writer in case_id order.
+
+Every finished case is appended as one JSON line to caseCrawl.<hex>.jsonl. That file is the
+checkpoint: if the run dies, start it again with "--resume <hex>" and the cases already in the
+file are skipped. While a crawl is unfinished its hex sits in caseCrawl.inProgress, which is only
+removed once the outputs are written, so the run scripts know which crawl (if any) to resume. Once every case is in, the final caseData/fileData/aliqMap/slidMap TSVs are
+written with the same names and layout that queryByCase.py produces, so the downstream steps in
+master_etl.sh do not care which crawler was used.
+'''
+
+IN_PROGRESS_FILE = "caseCrawl.inProgress"
+
+GDC_ENDPOINTS = {
+    'legacy': {'cases': "https://api.gdc.cancer.gov/legacy/cases",
+               'files': "https://api.gdc.cancer.gov/legacy/files"},
+    'active': {'cases': "https://api.gdc.cancer.gov/cases",
+               'files': "https://api.gdc.cancer.gov/files"}
+}
+
+CASE_FIELDS_LIST = ','.join([
+    'case_id', 'sample_ids', 'state', 'primary_site', 'submitter_id', 'submitter_sample_ids',
+    'files.file_id',
+    'samples.sample_id', 'samples.submitter_id', 'samples.sample_type', 'samples.sample_type_id',
+    'samples.tumor_code', 'samples.preservation_method', 'samples.is_ffpe',
+    'samples.pathology_report_uuid',
+    'samples.portions.analytes.aliquots.aliquot_id',
+    'samples.portions.analytes.aliquots.submitter_id',
+    'samples.portions.analytes.analyte_id', 'samples.portions.analytes.submitter_id',
+    'samples.portions.portion_id', 'samples.portions.submitter_id',
+    'samples.portions.slides.slide_id', 'samples.portions.slides.submitter_id',
+    'project.dbgap_accession_number', 'project.disease_type', 'project.name', 'project.project_id',
+    'project.program.dbgap_accession_number', 'project.program.name',
+    'summary.file_count'])
+
+FILE_FIELDS_LIST = ','.join([
+    'access', 'acl', 'created_datetime', 'data_category', 'data_format',
+    'cases.case_id',
+    'data_type', 'error_type', 'experimental_strategy', 'file_id',
+    'file_name', 'file_size', 'file_state', 'md5sum', 'origin', 'platform',
+    'revision', 'state', 'state_comment', 'submitter_id', 'tags', 'type',
+    'updated_datetime',
+    'index_files.file_id', 'index_files.file_name', 'index_files.file_size',
+    'metadata_files.file_id', 'metadata_files.file_name', 'metadata_files.file_size', 'metadata_files.type',
+    'analysis.workflow_type', 'analysis.workflow_link',
+    'analysis.input_files.file_id',
+    'associated_entities.case_id', 'associated_entities.entity_id',
+    'associated_entities.entity_submitter_id',
+    'associated_entities.entity_type',
+    'center.center_type', 'center.code', 'center.name', 'center.short_name',
+    'downstream_analyses.workflow_type', 'downstream_analyses.workflow_link',
+    'downstream_analyses.output_files.file_id',
+    'cases.project.dbgap_accession_number', 'cases.project.disease_type', 'cases.project.name',
+    'cases.project.project_id',
+    'cases.project.program.dbgap_accession_number', 'cases.project.program.name',
+    'archive.archive_id', 'archive.revision', 'archive.state', 'archive.submitter_id'])
+
+MAX_FILES_PER_CASE = 1500
+MAX_TRIES = 11
+MAX_SLEEP = 600
+
+_thread_state = threading.local()
+
+
+def _session():
+    """
+    One keep-alive session per worker thread; requests.Session is not safe to share across threads
+    """
+    if not hasattr(_thread_state, 'session'):
+        _thread_state.session = requests.Session()
+    return _thread_state.session
+
+
+def _get_with_backoff(endpt, params, handle_json, what):
+    """
+    Same retry schedule as queryByCase.py: start with a 1 second wait and double it each time, up
+    to 10 minutes, for 11 tries. handle_json gets the parsed response and either returns the answer
+    or raises to ask for another try.
+    """
+    sleep_time = 1
+    for i_try in range(MAX_TRIES):
+        if i_try > 0:
+            print(" >>>> trying again ... {} {} {}".format(i_try + 1, sleep_time, what))
+            time.sleep(sleep_time)
+            sleep_time = min(sleep_time * 2, MAX_SLEEP)
+        try:
+            response = _session().get(endpt, params=params, timeout=60.0)
+        except Exception as ex:
+            print(" ERROR !!! requests.get() call FAILED ??? {} {}".format(what, str(ex)))
+            continue
+        if response.status_code != 200:
+            print(" --> BAD status_code returned !!! {} {}".format(response.status_code, what))
+            continue
+        try:
+            return handle_json(response.json())
+        except Exception as ex:
+            print(" ERROR parsing response for {} : {}".format(what, str(ex)))
+
+    print(" HOLY COW WHAT IS GOING ON ??? !!! Giving up on {}".format(what))
+    return None
+
+
+def get_all_case_ids(cases_endpt, endpoint_name, uuid_str):
+    """
+    Page through the cases endpoint for every case_id/submitter_id pair, and write out the
+    caseIDmap file just like queryByCase.py does
+    """
+    page_size = 1000
+    from_start = 0
+    case_id_map = {}
+
+    while True:
+        params = {'fields': 'submitter_id,case_id',
+                  'sort': 'case_id:asc',
+                  'from': from_start,
+                  'size': page_size}
+        rj = _get_with_backoff(cases_endpt, params, lambda x: x, "case id page {}".format(from_start))
+        if rj is None:
+            print(" ERROR: could not page through all the cases")
+            sys.exit(-1)
+        count = rj['data']['pagination']['count']
+        if count == 0:
+            break
+        from_start += count
+        for hit in rj['data']['hits']:
+            case_id_map.setdefault(hit['case_id'], hit['submitter_id'])
+
+    with open("caseIDmap.{}.{}.tsv".format(endpoint_name, uuid_str), 'w') as fh:
+        for case_id in sorted(case_id_map.keys()):
+            fh.write('{}\t{}\n'.format(case_id, case_id_map[case_id]))
+
+    return case_id_map
+
+
+def strip_blanks(in_dict):
+    out_dict = {}
+    for key, vals in in_dict.items():
+        out_dict[key.strip()] = [val.strip() if isinstance(val, str) else val for val in vals]
+    return out_dict
+
+
+def flatten_json(in_json):
+    """
+    Same flattening as queryByCase.flattenJSON: nested keys joined with "__", leaves collected in lists
+    """
+    out_json = {}
+
+    def flatten(x, name=''):
+        if type(x) is dict:
+            for a in x:
+                flatten(x[a], name + a + '__')
+        elif type(x) is list:
+            for a in x:
+                flatten(a, name)
+        elif x is not None:
+            out_json.setdefault(name[:-2], []).append(x)
+
+    flatten(in_json)
+    return out_json
+
+
+def get_case_tree(case_info):
+    """
+    Port of queryByCase.getCaseTree. Instead of writing to the global aliquot and slide file
+    handles, hand the rows back so the writer thread can emit them in order.
+    """
+    aliq_rows = []
+    slide_rows = []
+
+    program_name = case_info['project']['program']['name']
+    project_id = case_info['project']['project_id']
+    case_gdc_id = case_info['case_id'].strip()
+    case_barcode = case_info['submitter_id'].strip()
+
+    if 'sample_ids' not in case_info:
+        print("     --> this case has no samples, it seems ... {} {}".format(case_gdc_id, case_barcode))
+        return aliq_rows, slide_rows
+
+    for samp in case_info["samples"]:
+        sample_gdc_id = samp['sample_id'].strip()
+        sample_barcode = samp['submitter_id'].strip()
+        sample_type = samp['sample_type'].strip()
+        sample_type_id = str(samp['sample_type_id']) if 'sample_type_id' in samp else ''
+        sample_is_ffpe = str(samp['is_ffpe']) if 'is_ffpe' in samp else ''
+        sample_preservation_method = \
+            samp['preservation_method'].strip() if 'preservation_method' in samp \
+                                                   and samp['preservation_method'] is not None \
+                                                else ''
+        sample_cols = [program_name, project_id, case_gdc_id, case_barcode,
+                       sample_gdc_id, sample_barcode, sample_type_id, sample_type]
+
+        for port in samp.get('portions', []):
+            portion_gdc_id = port['portion_id'].strip() if 'portion_id' in port else "NA"
+            portion_barcode = port['submitter_id'].strip() if 'submitter_id' in port else "NA"
+            aliq_cols = sample_cols + [sample_is_ffpe, sample_preservation_method,
+                                       portion_gdc_id, portion_barcode]
+
+            if 'slides' in port:
+                if len(port['slides']) == 0:
+                    print(" hmmmm no slides for this portion ? case {}".format(case_gdc_id))
+                    slide_rows.append(sample_cols + [portion_gdc_id, portion_barcode, "NA", "NA"])
+                for slide in port['slides']:
+                    slide_rows.append(sample_cols + [portion_gdc_id, portion_barcode,
+                                                     slide['slide_id'].strip(), slide['submitter_id'].strip()])
+
+            if 'analytes' in port:
+                if len(port['analytes']) == 0:
+                    print(" hmmmm no analytes for this portion ? case {} proj {}".format(case_gdc_id, project_id))
+                    aliq_rows.append(aliq_cols + ["NA", "NA", "NA", "NA"])
+                for anal in port['analytes']:
+                    analyte_gdc_id = anal['analyte_id'].strip() if 'analyte_id' in anal else "NA"
+                    analyte_barcode = anal['submitter_id'].strip() if 'submitter_id' in anal else "NA"
+                    aliquots = anal.get('aliquots', [])
+                    if len(aliquots) == 0:
+                        print(" hmmmm no aliquots for this analyte ? case {} analyte {} proj {}".format(
+                            case_gdc_id, analyte_gdc_id, project_id))
+                        aliq_rows.append(aliq_cols + [analyte_gdc_id, analyte_barcode, "NA", "NA"])
+                    for aliq in aliquots:
+                        aliq_rows.append(aliq_cols + [analyte_gdc_id, analyte_barcode,
+                                                      aliq['aliquot_id'].strip(), aliq['submitter_id'].strip()])
+
+            elif 'slides' not in port:
+                print(" hmmmm no analytes or slides for this portion ? case {} proj {}".format(case_gdc_id, project_id))
+                aliq_rows.append(aliq_cols + ["NA", "NA", "NA", "NA"])
+
+    return aliq_rows, slide_rows
+
+
+def get_case_info(cases_endpt, case_id):
+    """
+    Returns the flattened case plus its aliquot and slide rows, or empty results if the API never
+    gave us an answer
+    """
+    filt = {'op': '=',
+            'content': {
+                'field': 'case_id',
+                'value': [case_id]}}
+    params = {'fields': CASE_FIELDS_LIST,
+              'filters': json.dumps(filt)}
+
+    def handle(rj):
+        hits = rj['data']['hits']
+        if len(hits) > 1:
+            print(" HOW DID THIS HAPPEN ??? more than one case ??? !!! {} {}".format(len(hits), case_id))
+        case_info = hits[0]
+        try:
+            aliq_rows, slide_rows = get_case_tree(case_info)
+        except Exception as ex:
+            print(" WARNING !!! failed in getCaseTree !!! case: {}".format(case_id))
+            print(str(ex))
+            aliq_rows, slide_rows = [], []
+        return strip_blanks(flatten_json(case_info)), aliq_rows, slide_rows
+
+    result = _get_with_backoff(cases_endpt, params, handle, "case {}".format(case_id))
+    return result if result is not None else ({}, [], [])
+
+
+def get_file_info_by_case(files_endpt, case_id, num_expected):
+    filt = {'op': '=',
+            'content': {
+                'field': 'cases.case_id',
+                'value': [case_id]}}
+    params = {'fields': FILE_FIELDS_LIST,
+              'filters': json.dumps(filt),
+              'sort': 'file_id:asc',
+              'from': 0,
+              'size': MAX_FILES_PER_CASE}
+
+    def handle(rj):
+        hits = rj['data']['hits']
+        num_files = len(hits)
+        if num_files >= MAX_FILES_PER_CASE:
+            raise SystemExit(" ERROR ??? need to increase MAX_FILES_PER_CASE limit !!! ??? {} ".format(case_id))
+        if num_files < num_expected:
+            raise SystemExit(" ERROR ??? did not get back all of the files we were expecting ??? !!! "
+                             "{} expecting {} got back {}".format(case_id, num_expected, num_files))
+        if num_files != num_expected:
+            print(" ERROR ??? number of files does not match expected number ??? ({},{}) case {}".format(
+                num_files, num_expected, case_id))
+        return [strip_blanks(flatten_json(hit)) for hit in hits]
+
+    result = _get_with_backoff(files_endpt, params, handle, "files for case {}".format(case_id))
+    if result is None:
+        print(" --> returning EMPTY HANDED from get_file_info_by_case ??? ERROR ??? {} {}".format(case_id, num_expected))
+        return []
+    return result
+
+
+def crawl_one_case(cases_endpt, files_endpt, case_id):
+    """
+    Worker task: everything we need to know about one case. Like queryByCase.py, keep asking for
+    the case until the file count in the summary matches the file ids we got back.
+    """
+    while True:
+        case_info, aliq_rows, slide_rows = get_case_info(cases_endpt, case_id)
+        file_count = case_info["summary__file_count"][0] if "summary__file_count" in case_info else 0
+        file_ids = case_info.get("files__file_id", [])
+        if len(file_ids) == file_count:
+            break
+        print(" WARNING ??? !!! the number of file IDs returned is not as expected ??? {} {} {}".format(
+            case_id, file_count, len(file_ids)))
+
+    file_infos = get_file_info_by_case(files_endpt, case_id, len(file_ids))
+    for file_info in file_infos:
+        if len(file_info.get('file_id', [])) != 1:
+            raise SystemExit(" FATAL ERROR: no file_id or too many for case {}: {}".format(case_id, file_info))
+
+    return {'case_id': case_id, 'case': case_info, 'files': file_infos,
+            'aliquots': aliq_rows, 'slides': slide_rows}
+
+
+def read_checkpoint(crawl_file):
+    """
+    Case ids already finished in an earlier run. A line that was cut off by a crash is dropped,
+    and the file is truncated back to the last good line so we can keep appending.
+    """
+    done = set()
+    if not os.path.exists(crawl_file):
+        return done
+    good_bytes = 0
+    with open(crawl_file, 'rb') as fh:
+        for line in fh:
+            try:
+                done.add(json.loads(line.decode('utf-8'))['case_id'])
+            except (ValueError, KeyError):
+                break
+            good_bytes += len(line)
+    with open(crawl_file, 'r+b') as fh:
+        fh.truncate(good_bytes)
+    return done
+
+
+def crawl_cases(cases_endpt, files_endpt, all_cases, crawl_file, num_workers, verbose):
+    """
+    Run the cases through the pool with at most a few jobs per worker outstanding, and append the
+    results to the checkpoint file in case_id order.
+    """
+    done = read_checkpoint(crawl_file)
+    todo = iter([case_id for case_id in sorted(all_cases) if case_id not in done])
+    print(" {} cases already done, {} to go".format(len(done), len(all_cases) - len(done)))
+
+    window = num_workers * 4
+    num_cases = len(done)
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=num_workers) as pool, open(crawl_file, 'a') as out:
+        for case_id in itertools.islice(todo, window):
+            pending.append(pool.submit(crawl_one_case, cases_endpt, files_endpt, case_id))
+        try:
+            while pending:
+                record = pending.popleft().result()
+                out.write(json.dumps(record) + '\n')
+                out.flush()
+                num_cases += 1
+                if verbose >= 1 and num_cases % 100 == 0:
+                    print("     working ... in crawl_cases ... {}".format(num_cases))
+                next_case = next(todo, None)
+                if next_case is not None:
+                    pending.append(pool.submit(crawl_one_case, cases_endpt, files_endpt, next_case))
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+
+    return
+
+
+def merge_strings(vals, max_vals):
+    """
+    Order-preserving dedup of a field's values, joined with ";". Membership goes through a set, so
+    this stays linear in the number of values.
+    """
+    seen = set()
+    uniq = []
+    for val in vals:
+        if val not in seen:
+            seen.add(val)
+            uniq.append(val)
+            if len(uniq) > max_vals:
+                return "multi"
+    return ';'.join(str(val) for val in uniq)
+
+
+def _read_crawl(crawl_file):
+    with open(crawl_file, 'r') as fh:
+        for line in fh:
+            yield json.loads(line)
+
+
+def _unique_files(crawl_file):
+    """
+    Files hang off every case they belong to; keep the first one we see, as in queryByCase.py. Only
+    the ids are held in memory.
+    """
+    seen = set()
+    for record in _read_crawl(crawl_file):
+        for file_info in record['files']:
+            file_id = file_info['file_id'][0]
+            if file_id not in seen:
+                seen.add(file_id)
+                yield file_id, file_info
+
+
+def write_table_4_bq(fh, db_name, id_field, fields, records):
+    out_fields = [field for field in fields if field != id_field]
+    fh.write('\t'.join(['dbName', id_field] + out_fields) + '\n')
+    num_rows = 0
+    for item_id, info in records:
+        out_line = [db_name, item_id]
+        for field in out_fields:
+            vals = info.get(field)
+            out_line.append(merge_strings(vals, 8) if vals else '')
+        fh.write('\t'.join(out_line) + '\n')
+        num_rows += 1
+    return num_rows
+
+
+def write_outputs(crawl_file, db_name, uuid_str):
+    """
+    Build the final TSVs from the checkpoint file in two streaming passes. The first collects the
+    case and file field names (the TSV columns) and writes the aliquot and slide maps; the second
+    writes the case and file rows. Nothing but field names and file ids is held in memory.
+    """
+    cases_fields = set()
+    files_fields = set()
+
+    with open("aliqMap.bq.{}.tsv".format(uuid_str), 'w') as fh_q, \
+         open("slidMap.bq.{}.tsv".format(uuid_str), 'w') as fh_s:
+        for record in _read_crawl(crawl_file):
+            cases_fields.update(record['case'].keys())
+            for file_info in record['files']:
+                files_fields.update(file_info.keys())
+            fh_q.writelines('\t'.join(row) + '\n' for row in record['aliquots'])
+            fh_s.writelines('\t'.join(row) + '\n' for row in record['slides'])
+
+    with open("caseData.bq.{}.tsv".format(uuid_str), 'w') as fh:
+        num_cases = write_table_4_bq(fh, db_name, 'case_id', sorted(cases_fields),
+                                     ((record['case_id'], record['case']) for record in _read_crawl(crawl_file)))
+    with open("fileData.bq.{}.tsv".format(uuid_str), 'w') as fh:
+        num_files = write_table_4_bq(fh, db_name, 'file_id', sorted(files_fields), _unique_files(crawl_file))
+
+    print(" DONE processing {} database: {} cases and {} files".format(db_name, num_cases, num_files))
+
+    return
+
+
+def main(args):
+
+    endpoint = args.endpoint.lower()
+    if endpoint.find("leg") >= 0:
+        db_name = 'legacy'
+    elif endpoint.find("act") >= 0:
+        db_name = 'active'
+    else:
+        print(" invalid endpoint flag : {}".format(args.endpoint))
+        print(" should be either legacy or active ")
+        sys.exit(-1)
+
+    uuid_str = args.resume if args.resume is not None else uuid.uuid1().hex[:8]
+    print(" RUNNING ... {}".format(uuid_str))
+    crawl_file = "caseCrawl.{}.jsonl".format(uuid_str)
+    with open(IN_PROGRESS_FILE, 'w') as fh:
+        fh.write("{}\n".format(uuid_str))
+    verbose = args.verbosity if args.verbosity is not None else 0
+
+    if args.case_ids is not None:
+        with open(args.case_ids) as f:
+            all_cases = [line.rstrip() for line in f]
+    elif args.case_id is not None:
+        all_cases = [args.case_id]
+    else:
+        all_cases = list(get_all_case_ids(GDC_ENDPOINTS[db_name]['cases'], db_name, uuid_str).keys())
+
+    crawl_cases(GDC_ENDPOINTS[db_name]['cases'], GDC_ENDPOINTS[db_name]['files'],
+                all_cases, crawl_file, args.workers, verbose)
+
+    write_outputs(crawl_file, db_name, uuid_str)
+    os.remove(IN_PROGRESS_FILE)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Concurrently query the GDC endpoints for case and file metadata")
+    parser.add_argument("-v", "--verbosity", type=int, help="Verbosity (0 to 999)")
+    parser.add_argument("-e", "--endpoint", type=str, help="either legacy or active", required=True)
+    parser.add_argument("-i", "--case_id", type=str, help="single case GUID")
+    parser.add_argument("-s", "--case_ids", type=str, help="file with multiple case GUIDs")
+    parser.add_argument("-w", "--workers", type=int, default=16, help="number of concurrent case requests")
+    parser.add_argument("-r", "--resume", type=str, help="hex tag of an interrupted run to pick up again")
+    main(parser.parse_args())
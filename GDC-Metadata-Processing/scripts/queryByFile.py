@@ -5,6 +5,7 @@ import sys
 import time
 import uuid
 
+from multiprocessing.pool import ThreadPool
 from pandas.io.json import json_normalize
 
 
@@ -51,6 +52,33 @@ uuidStr = uuid.uuid1().hex[:8]
 
 numFiles = 0
 
+## 3/29/19: removing file_state from list below:
+FILE_FIELDS_LIST = 'access,acl,created_datetime,data_category,data_format,' \
+                   + 'cases.case_id,' \
+                   + 'data_type,error_type,experimental_strategy,file_id,' \
+                   + 'file_name,file_size,md5sum,origin,platform,' \
+                   + 'revision,state,state_comment,submitter_id,tags,type,' \
+                   + 'updated_datetime,' \
+                   + 'index_files.file_id,index_files.file_name,index_files.file_size,' \
+                   + 'metadata_files.file_id,metadata_files.file_name,metadata_files.file_size,metadata_files.type,' \
+                   + 'analysis.workflow_type,analysis.workflow_link,' \
+                   + 'analysis.input_files.file_id,' \
+                   + 'associated_entities.case_id,associated_entities.entity_id,' \
+                   + 'associated_entities.entity_submitter_id,' \
+                   + 'associated_entities.entity_type,' \
+                   + 'center.center_type,center.code,center.name,center.short_name,' \
+                   + 'downstream_analyses.workflow_type,downstream_analyses.workflow_link,' \
+                   + 'downstream_analyses.output_files.file_id,' \
+                   + 'cases.project.dbgap_accession_number,cases.project.disease_type,cases.project.name,cases.project.project_id,' \
+                   + 'cases.project.program.dbgap_accession_number,cases.project.program.name,' \
+                   + 'archive.archive_id,archive.revision,archive.state,archive.submitter_id'
+
+## how many file ids go into one 'in' filter request when batching
+defaultBatchSize = 100
+
+## how many batched requests are in flight at once
+defaultWorkers = 8
+
 
 ## -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 
@@ -171,29 +199,26 @@ def get_all_file_ids(files_endpt):
 
 ## -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 
-def getFileInfo(fileID_list, files_endpt, dbName, file_fh2):
+def getFileInfo(fileID_list, files_endpt, dbName, file_fh2, crawl_fh, batchSize=defaultBatchSize,
+                numWorkers=defaultWorkers):
     global numFiles
 
     if (verboseFlag >= 1):
         print " "
-        print " >>> in getFileInfo ... ", len(fileID_list), files_endpt
+        print " >>> in getFileInfo ... ", len(fileID_list), files_endpt, batchSize, numWorkers
         print " "
 
     allFiles = fileID_list.keys()
     allFiles.sort()
 
-    fileID_dict = {}
-
-    ## outer loop is over ALL files ...
-    for file_id in allFiles:
+    ## phase 1 of the output: every new file goes out to crawl_fh as one JSON line
+    ## as soon as we have it, and files_fields collects the field names. Only the
+    ## ids are kept around, so memory does not grow with the size of the GDC
+    fileID_seen = set()
 
-        if (verboseFlag >= 1):
-            print " "
-            print " "
-            print " in getFileInfo ... looping over allFiles ... ", file_id
+    def writeFileInfoVec(fileInfoVec):
+        global numFiles
 
-        ## get file info for this one file ...
-        fileInfoVec = get_file_info(files_endpt, file_id)
         numFiles2 = len(fileInfoVec)
         if (verboseFlag >= 1):
             print " --> got back INFORMATION for %d files " % numFiles2
@@ -212,16 +237,13 @@ def getFileInfo(fileID_list, files_endpt, dbName, file_fh2):
                 sys.exit(-1)
 
             file_id = fileInfo['file_id'][0]
-            ## print file_id
-            ## print fileID_dict
 
-            if (file_id not in fileID_dict):
-                fileID_dict[file_id] = [fileInfo]
+            if (file_id not in fileID_seen):
+                fileID_seen.add(file_id)
+                crawl_fh.write("%s\n" % json.dumps([file_id, fileInfo]))
                 writeOneFile4BQ(file_fh2, dbName, file_id, fileInfo)
                 if (verboseFlag >= 3):
-                    print file_id
-                    print " creating fileID_dict entry for this file ", file_id
-                    print fileID_dict[file_id]
+                    print " wrote record for this file ", file_id
             else:
 
                 if (verboseFlag >= 3):
@@ -231,12 +253,59 @@ def getFileInfo(fileID_list, files_endpt, dbName, file_fh2):
             if (numFiles % 100 == 0):
                 print "     working ... in getFileInfo ... %d " % (numFiles)
 
+    if (batchSize <= 1):
+        ## one request per file, in order
+        for file_id in allFiles:
+            if (verboseFlag >= 1):
+                print " "
+                print " in getFileInfo ... looping over allFiles ... ", file_id
+            writeFileInfoVec(get_file_info(files_endpt, file_id))
+
+    else:
+        ## ask for batchSize files at a time, with numWorkers requests in flight.
+        ## imap hands the batches back in order as they come in, and each one is
+        ## written out right away. Any id that does not come back in its batch is
+        ## asked for on its own, in its place, with the one-at-a-time query, which
+        ## insists on exactly one hit and bails out otherwise
+        fileID_batches = [allFiles[iStart:iStart + batchSize] for iStart in range(0, len(allFiles), batchSize)]
+        numRequeued = 0
+        pool = ThreadPool(numWorkers)
+        try:
+            for (fileID_batch, fileInfo_map) in pool.imap(lambda aBatch: (aBatch, get_file_info_batch(files_endpt, aBatch)),
+                                                          fileID_batches):
+                for file_id in fileID_batch:
+                    fileInfoVec = fileInfo_map.get(file_id, [])
+                    for fileInfo in fileInfoVec:
+                        mergeFileFields(fileInfo)
+                    if (len(fileInfoVec) != 1):
+                        numRequeued += 1
+                        fileInfoVec = get_file_info(files_endpt, file_id)
+                    writeFileInfoVec(fileInfoVec)
+                if (verboseFlag >= 1):
+                    print "     working ... in getFileInfo ... %d written, %d asked for one at a time " % \
+                          (len(fileID_seen), numRequeued)
+        finally:
+            pool.close()
+            pool.join()
+        if (numRequeued > 0):
+            print " %d file ids did not come back from batched queries; asked one at a time " % numRequeued
+
     if (verboseFlag >= 1):
         print " "
-        print " returning dict with %d files " % (len(fileID_dict))
+        print " wrote records for %d files " % (len(fileID_seen))
         print " "
 
-    return (fileID_dict)
+    return (len(fileID_seen))
+
+
+## -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+## phase 2 reads the records written by getFileInfo back one at a time
+
+def readFileRecords(fName):
+    with open(fName, 'r') as fh:
+        for aLine in fh:
+            (file_id, fileInfo) = json.loads(aLine)
+            yield (file_id, fileInfo)
 
 
 ## -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
@@ -314,26 +383,7 @@ def get_file_info(files_endpt, file_id):
                 'field': 'file_id',
                 'value': [file_id]}}
 
-    ## 3/29/19: removing file_state from list below:
-    fieldsList = 'access,acl,created_datetime,data_category,data_format,' \
-                 + 'cases.case_id,' \
-                 + 'data_type,error_type,experimental_strategy,file_id,' \
-                 + 'file_name,file_size,md5sum,origin,platform,' \
-                 + 'revision,state,state_comment,submitter_id,tags,type,' \
-                 + 'updated_datetime,' \
-                 + 'index_files.file_id,index_files.file_name,index_files.file_size,' \
-                 + 'metadata_files.file_id,metadata_files.file_name,metadata_files.file_size,metadata_files.type,' \
-                 + 'analysis.workflow_type,analysis.workflow_link,' \
-                 + 'analysis.input_files.file_id,' \
-                 + 'associated_entities.case_id,associated_entities.entity_id,' \
-                 + 'associated_entities.entity_submitter_id,' \
-                 + 'associated_entities.entity_type,' \
-                 + 'center.center_type,center.code,center.name,center.short_name,' \
-                 + 'downstream_analyses.workflow_type,downstream_analyses.workflow_link,' \
-                 + 'downstream_analyses.output_files.file_id,' \
-                 + 'cases.project.dbgap_accession_number,cases.project.disease_type,cases.project.name,cases.project.project_id,' \
-                 + 'cases.project.program.dbgap_accession_number,cases.project.program.name,' \
-                 + 'archive.archive_id,archive.revision,archive.state,archive.submitter_id'
+    fieldsList = FILE_FIELDS_LIST
 
     ## print " fieldsList: <%s> " % fieldsList
 
@@ -451,6 +501,93 @@ def get_file_info(files_endpt, file_id):
     ## sys.exit(-1)
 
 
+## -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+## batched version of get_file_info: one request with an 'in' filter for a whole
+## list of file ids. Returns a dict of file_id -> [fileInfo] for the ids that came
+## back; the caller decides what to do with the ones that did not. This runs in
+## worker threads, so new fields are left for the caller to merge (mergeFileFields)
+
+def get_file_info_batch(files_endpt, fileID_batch):
+    if (verboseFlag >= 3):
+        print " "
+        print " >>> in get_file_info_batch ... ", files_endpt, len(fileID_batch)
+        print " "
+
+    filt = {'op': 'in',
+            'content': {
+                'field': 'file_id',
+                'value': fileID_batch}}
+
+    ## POST the query, since a few hundred GUIDs do not fit in a GET url
+    params = {'fields': FILE_FIELDS_LIST,
+              'filters': filt,
+              'sort': 'file_id:asc',
+              'from': 0,
+              'size': len(fileID_batch)}
+
+    ## same backoff as get_file_info
+    iTry = 0
+    sleepTime = 1
+    while iTry < 11:
+
+        if iTry == 10:
+            print " HOLY COW WHAT IS GOING ON ??? !!! "
+
+        if (iTry > 0):
+            print " >>>> trying again ... ", iTry + 1, sleepTime
+            time.sleep(sleepTime)
+            sleepTime = sleepTime * 2
+            if (sleepTime > 600): sleepTime = 600
+        iTry += 1
+
+        try:
+            if (verboseFlag >= 9): print " post request ", files_endpt, fileID_batch[0], len(fileID_batch)
+            response = requests.post(files_endpt, json=params, timeout=60.0)
+        except:
+            print " ERROR !!! requests.post() call FAILED ??? (d) "
+            continue
+
+        if (response.status_code != 200):
+            print " --> BAD status_code returned !!! ", response.status_code
+            continue
+
+        try:
+            rj = response.json()
+            hits = rj['data']['hits']
+        except:
+            print " ERROR in get_file_info_batch ??? failed to parse response ??? ", fileID_batch[0]
+            continue
+
+        if (verboseFlag >= 9):
+            print "     --> got back information for %d of %d files " % (len(hits), len(fileID_batch))
+
+        fileInfo_map = {}
+        for aHit in hits:
+            fileInfo = flattenJSON(aHit)
+            fileInfo_map.setdefault(aHit['file_id'], []).append(fileInfo)
+
+        return (fileInfo_map)
+
+    if (verboseFlag >= 1):
+        print " "
+        print " --> returning EMPTY HANDED from get_file_info_batch ??? ERROR ??? ", fileID_batch[0]
+        print " "
+
+    return ({})
+
+
+## -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+def mergeFileFields(fileInfo):
+    global files_fields
+
+    for aField in fileInfo:
+        if (aField not in files_fields):
+            if (verboseFlag >= 1):
+                print " adding new field to files_fields list : ", aField
+            files_fields += [aField]
+
+
 ## -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 
 def get_fileID_list(caseInfo):
@@ -477,12 +614,10 @@ def get_fileID_list(caseInfo):
 
 ## -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 
-def examineFilesInfo(fileID_dict):
-    files_fields.sort()
-
+def examineFilesInfo(fileRecords):
     if (verboseFlag >= 1):
         print " "
-        print " >>> in examineFilesInfo ... ", len(fileID_dict)
+        print " >>> in examineFilesInfo ... "
         print " "
         print files_fields
 
@@ -492,15 +627,7 @@ def examineFilesInfo(fileID_dict):
     for aField in files_fields:
         fileFieldValues[aField] = {}
 
-    for file_id in fileID_dict:
-
-        if (len(fileID_dict[file_id]) > 1):
-            print " WHAT (file) ??? "
-            print len(fileID_dict[file_id])
-            print " FATAL ERROR in examineFilesInfo "
-            sys.exit(-1)
-
-        fileInfo = fileID_dict[file_id][0]
+    for (file_id, fileInfo) in fileRecords:
 
         if (verboseFlag >= 9):
             print " for this file_id : ", file_id
@@ -543,36 +670,47 @@ def examineFilesInfo(fileID_dict):
 ## -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 
 def mergeStrings(aVec, nMax):
-    mStr = ''
+    ## dedup through a set: the old list membership test was quadratic
+    uSet = set()
     uVec = []
-    for ii in range(len(aVec)):
-        if (aVec[ii] not in uVec): uVec += [aVec[ii]]
-
-    if (len(uVec) > nMax): return ("multi")
+    for aVal in aVec:
+        if (aVal not in uSet):
+            uSet.add(aVal)
+            uVec += [aVal]
+            if (len(uVec) > nMax): return ("multi")
 
     uVec.sort()
 
-    for ii in range(len(uVec)):
-        mStr += '%s' % uVec[ii]
-        if (ii < len(uVec) - 1): mStr += ';'
+    return (';'.join(['%s' % aVal for aVal in uVec]))
 
-    return (mStr)
+
+## -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+def fileLine4BQ(dbName, file_id, fileInfo):
+    outVec = [dbName, file_id]
+    for aField in files_fields:
+        if (aField != "file_id"):
+            aVal = fileInfo.get(aField, [])
+            if (len(aVal) == 0):
+                outVec += ['']
+            else:
+                outVec += [mergeStrings(aVal, 8)]
+
+    return ('\t'.join(outVec))
 
 
 ## -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 
-def writeFileTable4BigQuery(fh, dbName, fileID_dict):
+def writeFileTable4BigQuery(fh, dbName, fileRecords):
     if (verboseFlag >= 1):
         print " "
-        print " >>> in writeFileTablesBigQuery ... ", len(fileID_dict)
+        print " >>> in writeFileTablesBigQuery ... "
         print " "
 
-    hdrFlag = 1
-    hdrLine = ''
+    hdrVec = ['dbName', 'file_id'] + [aField for aField in files_fields if (aField != "file_id")]
+    fh.write("%s\n" % '\t'.join(hdrVec))
 
-    for file_id in fileID_dict:
-
-        fileInfo = fileID_dict[file_id][0]
+    for (file_id, fileInfo) in fileRecords:
 
         if (verboseFlag >= 1):
             print " for this file_id : ", file_id
@@ -580,34 +718,8 @@ def writeFileTable4BigQuery(fh, dbName, fileID_dict):
             print fileInfo
             print " "
             print " "
-            print " files_fields : "
-            print files_fields
 
-        ## build up the output line ...
-
-        if (hdrFlag):
-            hdrLine = 'dbName'
-            hdrLine += '\tfile_id'
-
-        outLine = '%s' % dbName
-        outLine += '\t%s' % file_id
-        for aField in files_fields:
-            if (aField != "file_id"):
-                if (hdrFlag): hdrLine += '\t%s' % aField
-                try:
-                    if (len(fileInfo[aField]) == 0):
-                        outLine += '\t'
-                    else:
-                        mStr = mergeStrings(fileInfo[aField], 8)
-                        outLine += '\t%s' % mStr
-                except:
-                    outLine += '\t'
-
-        if (hdrFlag):
-            fh.write("%s\n" % hdrLine)
-            hdrFlag = 0
-
-        fh.write("%s\n" % outLine)
+        fh.write("%s\n" % fileLine4BQ(dbName, file_id, fileInfo))
 
 
 ## -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
@@ -629,22 +741,7 @@ def writeOneFile4BQ(fh, dbName, file_id, fileInfo):
             print " files_fields : "
             print files_fields
 
-        ## build up the output line ...
-
-        outLine = '%s' % dbName
-        outLine += '\t%s' % file_id
-        for aField in files_fields:
-            if (aField != "file_id"):
-                try:
-                    if (len(fileInfo[aField]) == 0):
-                        outLine += '\t'
-                    else:
-                        mStr = mergeStrings(fileInfo[aField], 8)
-                        outLine += '\t%s' % mStr
-                except:
-                    outLine += '\t'
-
-        fh.write("%s\n" % outLine)
+        fh.write("%s\n" % fileLine4BQ(dbName, file_id, fileInfo))
 
 
 ## -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
@@ -685,6 +782,9 @@ def main(args):
     fName = "fileList." + uuidStr + ".txt"
     file_fh3 = file(fName, 'w')
 
+    crawlName = "fileCrawl." + uuidStr + ".jsonl"
+    crawl_fh = file(crawlName, 'w')
+
     for dbName in GDC_endpts.keys():
 
         print " "
@@ -706,10 +806,15 @@ def main(args):
             file_fh3.write("%s\n" % a)
         file_fh3.close()
 
-        fileID_dict = getFileInfo(fileID_list, GDC_endpts[dbName]['files'], dbName, file_fh2)
+        batchSize = defaultBatchSize if args.batch_size is None else args.batch_size
+        numWorkers = defaultWorkers if args.workers is None else args.workers
+        getFileInfo(fileID_list, GDC_endpts[dbName]['files'], dbName, file_fh2, crawl_fh, batchSize, numWorkers)
+        crawl_fh.close()
 
         print " DONE processing %s database " % dbName
         print " "
+        ## the fields are found in whatever order the batches came back, and they are the
+        ## column order of the BQ table written below, so sort them whatever the verbosity :
         files_fields.sort()
         print " files fields : "
         for aField in files_fields:
@@ -719,9 +824,10 @@ def main(args):
         print " "
         print " "
 
-        examineFilesInfo(fileID_dict)
+        if (verboseFlag >= 1):
+            examineFilesInfo(readFileRecords(crawlName))
 
-        writeFileTable4BigQuery(file_fh, dbName, fileID_dict)
+        writeFileTable4BigQuery(file_fh, dbName, readFileRecords(crawlName))
 
     file_fh.close()
     file_fh2.close()
@@ -738,6 +844,8 @@ if __name__ == '__main__':
     parser.add_argument("-v", "--verbosity", type=int, help="Verbosity (0 to 99) Can get ginormous if > 0")
     parser.add_argument("-e", "--endpoint", type=str, help="either legacy or active", required=True)
     parser.add_argument("-i", "--id_list", type=str, help="input file with list of file ids")
+    parser.add_argument("-b", "--batch_size", type=int, help="file ids per 'in' filter query (1 = one request per file)")
+    parser.add_argument("-w", "--workers", type=int, help="batched queries in flight at once")
     args = parser.parse_args()
 
     main(args)
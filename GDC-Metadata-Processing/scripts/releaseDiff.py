@@ -0,0 +1,242 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import argparse
+import heapq
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+
+'''
+----------------------------------------------------------------------------------------------
+Compare two releases of a metadata TSV (e.g. caseData.merge.t1 or fileData.current.t1) by an id
+column. columnChanges.py holds the changed rows of both releases in dicts, and compare_to_last.sh
+sorts and uniqs whole files to find them. Here each file is sorted by id on disk in bounded runs,
+then the two sorted streams are merge-joined in one pass, so memory is set by the run size and
+not by the size of the release.
+
+Reports added, removed and changed ids, and for every column how many rows changed, with a few
+examples, just like columnChanges.py.
+'''
+
+RUN_SEP = '\x1e'
+
+
+def _flush_run(run_rows, run_dir, run_files):
+    run_rows.sort()
+    run_file = os.path.join(run_dir, "run{:05d}.txt".format(len(run_files)))
+    with open(run_file, 'w') as run_fh:
+        run_fh.writelines(run_rows)
+    run_files.append(run_file)
+    del run_rows[:]
+
+
+def sort_runs(tsv_file, id_field, run_dir, max_rows_in_run):
+    """
+    Split the TSV into sorted runs of at most max_rows_in_run rows, each row prefixed by its id.
+    Returns the header tokens and the run file names.
+    """
+    run_files = []
+    run_rows = []
+    with open(tsv_file, 'r') as tsv_fh:
+        header = tsv_fh.readline().rstrip('\n').split('\t')
+        id_index = header.index(id_field)
+        for line in tsv_fh:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            row_id = line.split('\t', id_index + 1)[id_index]
+            run_rows.append("{}{}{}\n".format(row_id, RUN_SEP, line))
+            if len(run_rows) >= max_rows_in_run:
+                _flush_run(run_rows, run_dir, run_files)
+    if run_rows:
+        _flush_run(run_rows, run_dir, run_files)
+    return header, run_files
+
+
+def sorted_groups(run_files):
+    """
+    Merge the sorted runs, yielding (id, [row tokens]) in id order
+    """
+    run_handles = [open(run_file, 'r') for run_file in run_files]
+    try:
+        merged = heapq.merge(*run_handles)
+        for row_id, records in itertools.groupby(merged, key=lambda rec: rec.split(RUN_SEP, 1)[0]):
+            yield row_id, [rec.rstrip('\n').split(RUN_SEP, 1)[1].split('\t') for rec in records]
+    finally:
+        for handle in run_handles:
+            handle.close()
+
+
+def merge_join(old_groups, new_groups):
+    """
+    Walk two id-ordered group streams together, yielding (id, old rows, new rows). The side that
+    does not have the id gets an empty list.
+    """
+    old_next = next(old_groups, None)
+    new_next = next(new_groups, None)
+    while old_next is not None or new_next is not None:
+        if new_next is None or (old_next is not None and old_next[0] < new_next[0]):
+            yield old_next[0], old_next[1], []
+            old_next = next(old_groups, None)
+        elif old_next is None or new_next[0] < old_next[0]:
+            yield new_next[0], [], new_next[1]
+            new_next = next(new_groups, None)
+        else:
+            yield old_next[0], old_next[1], new_next[1]
+            old_next = next(old_groups, None)
+            new_next = next(new_groups, None)
+
+
+def _count_group(group_counts, group_indices, toks):
+    if group_indices:
+        group = '\t'.join(toks[i] for i in group_indices)
+        group_counts[group] = group_counts.get(group, 0) + 1
+
+
+def diff_releases(old_file, new_file, id_field, work_dir='.', max_rows_in_run=500000, num_examples=5,
+                  group_fields=None, id_out_prefix=None, verbose=False):
+    """
+    Diff two releases of a TSV keyed by id_field. Returns a summary dict. If id_out_prefix is given,
+    the added, removed and changed ids are written to <prefix>added.txt etc. as they are found.
+    """
+    run_dir = tempfile.mkdtemp(prefix="reldiff-", dir=work_dir)
+    id_handles = {}
+    try:
+        old_header, old_runs = sort_runs(old_file, id_field, tempfile.mkdtemp(prefix="old-", dir=run_dir),
+                                         max_rows_in_run)
+        new_header, new_runs = sort_runs(new_file, id_field, tempfile.mkdtemp(prefix="new-", dir=run_dir),
+                                         max_rows_in_run)
+
+        #
+        # Columns are matched by name, so a column added or dropped between releases does not
+        # shift the comparison of the others:
+        #
+
+        new_index = {name: i for i, name in enumerate(new_header)}
+        common_cols = [(name, i, new_index[name]) for i, name in enumerate(old_header) if name in new_index]
+        group_fields = group_fields if group_fields else []
+        old_group_indices = [old_header.index(name) for name in group_fields]
+        new_group_indices = [new_header.index(name) for name in group_fields]
+
+        if id_out_prefix is not None:
+            for kind in ('added', 'removed', 'changed'):
+                id_handles[kind] = open("{}{}.txt".format(id_out_prefix, kind), 'w')
+
+        summary = {
+            'old_only_columns': [name for name in old_header if name not in new_index],
+            'new_only_columns': [name for name in new_header if name not in set(old_header)],
+            'old_rows': 0, 'new_rows': 0, 'unchanged': 0,
+            'added': 0, 'removed': 0, 'changed': 0,
+            'added_groups': {}, 'removed_groups': {}, 'changed_groups': {},
+            'column_changes': {}, 'examples': {}
+        }
+
+        for row_id, old_rows, new_rows in merge_join(sorted_groups(old_runs), sorted_groups(new_runs)):
+            summary['old_rows'] += len(old_rows)
+            summary['new_rows'] += len(new_rows)
+            if not old_rows or not new_rows:
+                kind = 'removed' if not new_rows else 'added'
+                rows, indices = (old_rows, old_group_indices) if kind == 'removed' else (new_rows, new_group_indices)
+                summary[kind] += 1
+                _count_group(summary['{}_groups'.format(kind)], indices, rows[0])
+                if kind in id_handles:
+                    id_handles[kind].write("{}\n".format(row_id))
+                continue
+
+            #
+            # Ids are unique in these tables, but if one repeats, pair the rows in sorted order:
+            #
+
+            row_changed = len(old_rows) != len(new_rows)
+            for old_toks, new_toks in zip(old_rows, new_rows):
+                for name, old_i, new_i in common_cols:
+                    old_tok = old_toks[old_i]
+                    new_tok = new_toks[new_i]
+                    if old_tok != new_tok:
+                        row_changed = True
+                        count = summary['column_changes'].get(name, 0) + 1
+                        summary['column_changes'][name] = count
+                        if count <= num_examples:
+                            summary['examples'].setdefault(name, []).append("{} -> {}".format(old_tok, new_tok))
+                        if verbose:
+                            print("{}: {}: {} -> {}".format(row_id, name, old_tok, new_tok))
+
+            if row_changed:
+                summary['changed'] += 1
+                _count_group(summary['changed_groups'], new_group_indices, new_rows[0])
+                if 'changed' in id_handles:
+                    id_handles['changed'].write("{}\n".format(row_id))
+            else:
+                summary['unchanged'] += 1
+
+        return summary
+    finally:
+        for handle in id_handles.values():
+            handle.close()
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def print_summary(summary):
+    print("Previous count: {}".format(summary['old_rows']))
+    print("Current count: {}".format(summary['new_rows']))
+    print("Difference: {}".format(summary['new_rows'] - summary['old_rows']))
+    if summary['old_only_columns']:
+        print("Columns dropped: {}".format(', '.join(summary['old_only_columns'])))
+    if summary['new_only_columns']:
+        print("Columns added: {}".format(', '.join(summary['new_only_columns'])))
+
+    for kind in ('removed', 'added', 'changed'):
+        print(" ")
+        print("{} count: {}".format(kind.capitalize(), summary[kind]))
+        groups = summary['{}_groups'.format(kind)]
+        for group in sorted(groups):
+            print("{:7d} {}".format(groups[group], group))
+
+    print(" ")
+    for key in summary['column_changes']:
+        print("{}: {}".format(key, summary['column_changes'][key]))
+        for examp in summary['examples'][key]:
+            print("  Example: {}".format(examp))
+        print("\n")
+
+
+def main(args):
+    summary = diff_releases(args.old_file, args.new_file, args.id_field,
+                            work_dir=args.work_dir, max_rows_in_run=args.run_rows,
+                            num_examples=args.examples,
+                            group_fields=args.group_by.split(',') if args.group_by else None,
+                            id_out_prefix=args.id_out_prefix, verbose=args.verbose)
+    print_summary(summary)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Diff two releases of a metadata TSV without holding either in memory")
+    parser.add_argument("old_file", type=str, help="TSV from the previous release")
+    parser.add_argument("new_file", type=str, help="TSV from the current release")
+    parser.add_argument("id_field", type=str, help="header name of the id column, e.g. case_id")
+    parser.add_argument("-g", "--group_by", type=str, help="comma separated columns to count added/removed/changed by")
+    parser.add_argument("-o", "--id_out_prefix", type=str, help="write added/removed/changed ids to <prefix>*.txt")
+    parser.add_argument("-d", "--work_dir", type=str, default='.', help="directory for the sorted runs")
+    parser.add_argument("-n", "--run_rows", type=int, default=500000, help="rows per sorted run")
+    parser.add_argument("-x", "--examples", type=int, default=5, help="examples to keep per column")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print every changed value")
+    sys.exit(main(parser.parse_args()))
@@ -14,7 +14,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-nohup python ../scripts/queryByCase.py --endpoint legacy >& qbc.log1 &
+#
+# The case crawl runs in Python 3 with a pool of concurrent requests. It checkpoints every finished
+# case into caseCrawl.<hex>.jsonl, and keeps the hex in caseCrawl.inProgress until it is done. So if
+# a previous pull died, pick that one back up instead of starting over. A finished crawl has no
+# marker, and is never resumed:
+#
+
+RESUME_ARG=""
+if [ -f caseCrawl.inProgress ]; then
+    RESUME_ARG="--resume `cat caseCrawl.inProgress`"
+fi
+
+nohup ~/pyVenvForThree/bin/python ../scripts/queryByCaseParallel.py --endpoint legacy ${RESUME_ARG} >& qbc.log1 &
 
 sleep 10
 
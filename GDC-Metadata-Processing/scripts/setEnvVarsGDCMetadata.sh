@@ -99,6 +99,7 @@ OUTPUT_LOOK_FILES=skip
 BUILD_NORM_TSVS=skip
 COMPARE_TO_LAST=skip
 DETAILED_DIFFS=skip
+RELEASE_DIFFS=skip
 COPY_ANNOT_SCHEMA=skip
 LOAD_BQ=skip
 DESC_AND_LABELS=skip
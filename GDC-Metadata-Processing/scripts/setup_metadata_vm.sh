@@ -77,6 +77,7 @@ cd ~
 python3 -m venv pyVenvForThree
 source pyVenvForThree/bin/activate
 python3 -m pip install wheel
+python3 -m pip install requests
 python3 -m pip install google-api-python-client
 python3 -m pip install google-cloud-storage
 python3 -m pip install google-cloud-bigquery
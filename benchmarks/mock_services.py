@@ -0,0 +1,902 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import base64
+import collections
+import contextlib
+import csv
+import io
+import json
+import math
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import urllib.parse as up
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+'''
+----------------------------------------------------------------------------------------------
+Local stand-ins for the services the builders talk to, so they can be run and timed offline:
+
+    FakeGDC        the GDC REST API: cases, files, _mapping, data
+    FakePDC        the PDC GraphQL endpoint
+    FakeIndexD     IndexD document lookups
+    FakeStorage    a google.cloud.storage.Client backed by a local directory
+    FakeBigQuery   a google.cloud.bigquery.Client backed by SQLite
+
+The HTTP fakes run in a background thread on a local port and count every call per route. Each
+takes an optional latency (seconds per request) to mimic a real round trip. use_fake_google()
+installs FakeStorage and FakeBigQuery into the common_etl client registry (and in place of the
+google client classes, if those are installed), so common_etl helpers and builders use them
+without any code changes.
+
+FakeBigQuery runs the SQL that SQLite understands once table names are translated. BigQuery-only
+SQL (UNNEST, STRUCT, scripting) raises, so benchmarks should stick to the load / extract / simple
+query paths.
+'''
+
+
+class MockService(object):
+    """
+    Threaded local HTTP server. routes is a list of (method, path regex, handler) where the handler
+    takes (match, query dict, body bytes, headers) and returns (status, payload). A dict or list
+    payload is sent as JSON, str or bytes as-is.
+    """
+
+    def __init__(self, routes, latency=0.0):
+        self._routes = [(method, re.compile(pattern), handler) for method, pattern, handler in routes]
+        self._latency = latency
+        self._server = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.url = None
+
+    def _dispatch(self, request, method):
+        parsed = up.urlparse(request.path)
+        query = dict(up.parse_qsl(parsed.query))
+        length = int(request.headers.get('Content-Length', 0) or 0)
+        body = request.rfile.read(length) if length else b''
+        if body and request.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            query.update(dict(up.parse_qsl(body.decode('utf-8'))))
+        for route_method, pattern, handler in self._routes:
+            match = pattern.fullmatch(parsed.path)
+            if route_method == method and match:
+                with self._lock:
+                    self.calls[pattern.pattern] += 1
+                if self._latency:
+                    time.sleep(self._latency)
+                status, payload = handler(match, query, body, request.headers)
+                break
+        else:
+            status, payload = 404, {'error': 'no route for {} {}'.format(method, parsed.path)}
+
+        if isinstance(payload, (dict, list)):
+            out = json.dumps(payload).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            out = payload.encode('utf-8') if isinstance(payload, str) else payload
+            content_type = 'text/plain'
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(out)))
+        request.end_headers()
+        request.wfile.write(out)
+
+    def start(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                service._dispatch(self, 'GET')
+
+            def do_POST(self):
+                service._dispatch(self, 'POST')
+
+            def log_message(self, format, *args):
+                return
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def _dotted_values(record, field):
+    """
+    All values at a dotted path in a nested record, walking through lists
+    """
+    values = [record]
+    for key in field.split('.'):
+        next_values = []
+        for value in values:
+            if isinstance(value, list):
+                value = [item.get(key) for item in value if isinstance(item, dict)]
+                next_values.extend(value)
+            elif isinstance(value, dict) and key in value:
+                next_values.append(value[key])
+        values = next_values
+    flat = []
+    for value in values:
+        flat.extend(value if isinstance(value, list) else [value])
+    return flat
+
+
+def gdc_filter_matches(record, filters):
+    """
+    Evaluate the subset of GDC filter syntax the builders use: and, or, =, in, !=
+    """
+    if not filters:
+        return True
+    op = filters['op'].lower()
+    content = filters['content']
+    if op == 'and':
+        return all(gdc_filter_matches(record, sub) for sub in content)
+    if op == 'or':
+        return any(gdc_filter_matches(record, sub) for sub in content)
+    values = _dotted_values(record, content['field'])
+    wanted = content['value'] if isinstance(content['value'], list) else [content['value']]
+    if op in ('=', 'in'):
+        return any(value in wanted for value in values)
+    if op == '!=':
+        return not any(value in wanted for value in values)
+    raise ValueError("Unsupported filter op {}".format(op))
+
+
+class FakeGDC(MockService):
+    """
+    GDC REST API over in-memory lists of case and file records (nested dicts, as the API
+    returns them, keyed by 'id'). file_contents optionally maps file ids to bytes for /data.
+    """
+
+    def __init__(self, cases=None, files=None, file_contents=None, latency=0.0):
+        self.records = {'cases': cases if cases is not None else [],
+                        'files': files if files is not None else []}
+        self.file_contents = file_contents if file_contents is not None else {}
+        routes = []
+        for method in ('GET', 'POST'):
+            routes.extend([
+                (method, r'/(cases|files)', self._search),
+                (method, r'/(cases|files)/([^/]+)', self._one),
+                (method, r'/(cases|files)/_mapping', self._mapping),
+                (method, r'/data/([^/]+)', self._data)
+            ])
+        # _mapping has to win over the single-record route:
+        routes.sort(key=lambda route: '_mapping' not in route[1])
+        super(FakeGDC, self).__init__(routes, latency)
+
+    @staticmethod
+    def _request_params(query, body, headers):
+        params = dict(query)
+        if body and headers.get('Content-Type', '').startswith('application/json'):
+            params.update(json.loads(body.decode('utf-8')))
+        return params
+
+    def _search(self, match, query, body, headers):
+        params = self._request_params(query, body, headers)
+        filters = params.get('filters')
+        if isinstance(filters, str):
+            filters = json.loads(filters)
+        hits = [rec for rec in self.records[match.group(1)] if gdc_filter_matches(rec, filters)]
+        size = int(params.get('size', 10))
+        start = int(params.get('from', 0))
+        page_hits = hits[start:start + size]
+
+        if params.get('return_type') == 'manifest':
+            lines = ['id\tfilename\tmd5\tsize\tstate']
+            for rec in page_hits:
+                lines.append('\t'.join(str(rec.get(key, '')) for key in ('id', 'file_name', 'md5sum',
+                                                                          'file_size', 'state')))
+            return 200, '\n'.join(lines) + '\n'
+
+        total = len(hits)
+        pages = max(1, int(math.ceil(float(total) / size))) if size else 1
+        pagination = {'count': len(page_hits), 'total': total, 'size': size, 'from': start,
+                      'page': (start // size) + 1 if size else 1, 'pages': pages, 'sort': ''}
+        return 200, {'data': {'hits': page_hits, 'pagination': pagination}, 'warnings': {}}
+
+    def _one(self, match, query, body, headers):
+        for rec in self.records[match.group(1)]:
+            if rec.get('id') == match.group(2):
+                return 200, {'data': rec, 'warnings': {}}
+        return 404, {'message': '{} not found'.format(match.group(2))}
+
+    def _mapping(self, match, query, body, headers):
+        fields = set()
+
+        def walk(value, prefix):
+            if isinstance(value, list):
+                for item in value:
+                    walk(item, prefix)
+            elif isinstance(value, dict):
+                for key, sub in value.items():
+                    walk(sub, '{}.{}'.format(prefix, key) if prefix else key)
+            elif prefix:
+                fields.add(prefix)
+
+        for rec in self.records[match.group(1)][:1000]:
+            walk(rec, '')
+        expand = sorted(set(field.rsplit('.', 1)[0] for field in fields if '.' in field))
+        return 200, {'fields': sorted(fields), 'expand': expand, 'defaults': [], 'multi': [], 'nested': []}
+
+    def _data(self, match, query, body, headers):
+        if match.group(1) not in self.file_contents:
+            return 404, {'message': '{} not found'.format(match.group(1))}
+        return 200, self.file_contents[match.group(1)]
+
+
+class FakePDC(MockService):
+    """
+    PDC GraphQL endpoint. resolvers maps the top-level query field (e.g. quantDataMatrix) to a
+    function of the query text that returns that field's data.
+    """
+
+    def __init__(self, resolvers=None, latency=0.0):
+        self.resolvers = resolvers if resolvers is not None else {}
+        super(FakePDC, self).__init__([('POST', r'/graphql', self._graphql)], latency)
+
+    def _graphql(self, match, query, body, headers):
+        query_text = json.loads(body.decode('utf-8'))['query']
+        field_match = re.search(r'{\s*(\w+)', query_text)
+        field = field_match.group(1) if field_match else None
+        if field not in self.resolvers:
+            return 200, {'data': None, 'errors': [{'message': 'no resolver for {}'.format(field)}]}
+        return 200, {'data': {field: self.resolvers[field](query_text)}}
+
+    @staticmethod
+    def argument(query_text, name):
+        """
+        Pull a string argument out of a GraphQL query, for use in resolvers
+        """
+        arg_match = re.search(r'{}\s*:\s*"([^"]*)"'.format(name), query_text)
+        return arg_match.group(1) if arg_match else None
+
+
+class FakeIndexD(MockService):
+    """
+    IndexD lookups over a dict of did -> {'urls': [...], 'size': ..., 'hashes': {...}}
+    """
+
+    def __init__(self, documents=None, latency=0.0):
+        self.documents = documents if documents is not None else {}
+        super(FakeIndexD, self).__init__([
+            ('GET', r'/index/([^/]+)', self._one),
+            ('POST', r'/bulk/documents', self._bulk)
+        ], latency)
+
+    def _doc(self, did):
+        doc = dict(self.documents[did])
+        doc['did'] = did
+        return doc
+
+    def _one(self, match, query, body, headers):
+        if match.group(1) not in self.documents:
+            return 404, {'error': 'no record found'}
+        return 200, self._doc(match.group(1))
+
+    def _bulk(self, match, query, body, headers):
+        dids = json.loads(body.decode('utf-8'))
+        return 200, [self._doc(did) for did in dids if did in self.documents]
+
+
+'''
+----------------------------------------------------------------------------------------------
+Filesystem-backed GCS. gs://bucket/name lives at <root>/bucket/name.
+'''
+
+
+class FakeBlob(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = bucket.client.metadata.get((bucket.name, name))
+
+    @property
+    def _path(self):
+        return os.path.join(self.bucket.path, self.name)
+
+    @property
+    def size(self):
+        return os.path.getsize(self._path) if os.path.isfile(self._path) else None
+
+    @property
+    def crc32c(self):
+        if not os.path.isfile(self._path):
+            return None
+        try:
+            import google_crc32c
+        except ImportError:
+            return None
+        checksum = google_crc32c.Checksum()
+        with open(self._path, 'rb') as readfile:
+            for chunk in iter(lambda: readfile.read(1 << 20), b''):
+                checksum.update(chunk)
+        return base64.b64encode(checksum.digest()).decode('utf-8')
+
+    def _ready(self):
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        self.bucket.client.calls['upload'] += 1
+
+    def exists(self, client=None):
+        return os.path.isfile(self._path)
+
+    def reload(self, client=None):
+        return
+
+    def upload_from_filename(self, filename, **kwargs):
+        self._ready()
+        shutil.copyfile(filename, self._path)
+
+    def upload_from_file(self, file_obj, size=None, rewind=False, **kwargs):
+        self._ready()
+        if rewind:
+            file_obj.seek(0)
+        with open(self._path, 'wb') as out:
+            if size is None:
+                shutil.copyfileobj(file_obj, out)
+            else:
+                remaining = size
+                while remaining > 0:
+                    chunk = file_obj.read(min(remaining, 1 << 20))
+                    if not chunk:
+                        break
+                    out.write(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+                    remaining -= len(chunk)
+
+    def upload_from_string(self, data, **kwargs):
+        self._ready()
+        with open(self._path, 'wb') as out:
+            out.write(data.encode('utf-8') if isinstance(data, str) else data)
+
+    def download_to_filename(self, filename, **kwargs):
+        self.bucket.client.calls['download'] += 1
+        shutil.copyfile(self._path, filename)
+
+    def download_to_file(self, file_obj, **kwargs):
+        self.bucket.client.calls['download'] += 1
+        with open(self._path, 'rb') as readfile:
+            shutil.copyfileobj(readfile, file_obj)
+
+    def download_as_bytes(self, **kwargs):
+        self.bucket.client.calls['download'] += 1
+        with open(self._path, 'rb') as readfile:
+            return readfile.read()
+
+    download_as_string = download_as_bytes
+
+    def compose(self, sources, **kwargs):
+        self.bucket.client.calls['compose'] += 1
+        tmp_path = '{}.compose'.format(self._path)
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        with open(tmp_path, 'wb') as out:
+            for source in sources:
+                with open(source._path, 'rb') as readfile:
+                    shutil.copyfileobj(readfile, out)
+        os.replace(tmp_path, self._path)
+
+    def patch(self, client=None):
+        self.bucket.client.metadata[(self.bucket.name, self.name)] = self.metadata
+
+    def delete(self, client=None):
+        self.bucket.client.metadata.pop((self.bucket.name, self.name), None)
+        os.remove(self._path)
+
+
+class FakeBucket(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.path = os.path.join(client.root_dir, name)
+
+    def blob(self, blob_name, **kwargs):
+        return FakeBlob(self, blob_name)
+
+    def get_blob(self, blob_name, **kwargs):
+        blob = FakeBlob(self, blob_name)
+        return blob if blob.exists() else None
+
+    def list_blobs(self, prefix=None, **kwargs):
+        return self.client.list_blobs(self, prefix=prefix)
+
+    def copy_blob(self, blob, destination_bucket, new_name=None, **kwargs):
+        target = destination_bucket.blob(new_name if new_name is not None else blob.name)
+        target.upload_from_filename(blob._path)
+        return target
+
+    def exists(self, client=None):
+        return os.path.isdir(self.path)
+
+
+class FakeStorage(object):
+    def __init__(self, root_dir, project='fake-project'):
+        self.root_dir = root_dir
+        self.project = project
+        self.calls = collections.Counter()
+        self.metadata = {}
+        os.makedirs(root_dir, exist_ok=True)
+
+    def bucket(self, bucket_name, **kwargs):
+        return FakeBucket(self, bucket_name)
+
+    def get_bucket(self, bucket_or_name, **kwargs):
+        name = bucket_or_name.name if isinstance(bucket_or_name, FakeBucket) else bucket_or_name
+        bucket = FakeBucket(self, name)
+        os.makedirs(bucket.path, exist_ok=True)
+        return bucket
+
+    def list_blobs(self, bucket_or_name, prefix=None, **kwargs):
+        bucket = bucket_or_name if isinstance(bucket_or_name, FakeBucket) else FakeBucket(self, bucket_or_name)
+        self.calls['list'] += 1
+        blobs = []
+        for dir_path, _, file_names in os.walk(bucket.path):
+            for file_name in file_names:
+                name = os.path.relpath(os.path.join(dir_path, file_name), bucket.path).replace(os.sep, '/')
+                if prefix is None or name.startswith(prefix):
+                    blobs.append(FakeBlob(bucket, name))
+        return sorted(blobs, key=lambda blob: blob.name)
+
+    def path_for_uri(self, gs_uri):
+        parsed = up.urlparse(gs_uri)
+        return os.path.join(self.root_dir, parsed.netloc, parsed.path.lstrip('/'))
+
+
+'''
+----------------------------------------------------------------------------------------------
+SQLite-backed BigQuery. A table project.dataset.table is the SQLite table "project.dataset.table";
+nested values (RECORD / REPEATED) are stored as JSON text.
+'''
+
+
+class FakeRow(object):
+    def __init__(self, names, values):
+        self._names = names
+        self._values = values
+        self._index = {name: i for i, name in enumerate(names)}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._values[self._index[name]]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, key):
+        return self._values[self._index[key] if isinstance(key, str) else key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return list(self._names)
+
+    def values(self):
+        return tuple(self._values)
+
+    def items(self):
+        return list(zip(self._names, self._values))
+
+    def get(self, key, default=None):
+        return self._values[self._index[key]] if key in self._index else default
+
+
+class FakeRowIterator(list):
+    def __init__(self, rows, total_rows):
+        super(FakeRowIterator, self).__init__(rows)
+        self.total_rows = total_rows
+
+
+class FakeJob(object):
+    def __init__(self, job_type, rows=None, destination=None, error=None):
+        self.job_id = 'fake_{}_{}'.format(job_type, uuid.uuid4().hex)
+        self.job_type = job_type
+        self.state = 'DONE'
+        self.error_result = None if error is None else {'reason': 'invalidQuery', 'message': str(error)}
+        self.errors = None if error is None else [self.error_result]
+        self.destination = destination
+        self._rows = rows if rows is not None else FakeRowIterator([], 0)
+        self.total_bytes_processed = 0
+        self.total_bytes_billed = 0
+        self.slot_millis = 0
+        self.cache_hit = False
+        self.created = self.started = self.ended = None
+
+    def result(self, *args, **kwargs):
+        if self.error_result is not None:
+            raise RuntimeError(self.error_result['message'])
+        return self._rows
+
+    def done(self):
+        return True
+
+
+class FakeSchemaField(object):
+    def __init__(self, name, field_type='STRING', mode='NULLABLE', description=None, fields=()):
+        self.name = name
+        self.field_type = field_type
+        self.mode = mode
+        self.description = description
+        self.fields = tuple(fields)
+
+    def to_api_repr(self):
+        api_repr = {'name': self.name, 'type': self.field_type, 'mode': self.mode,
+                    'description': self.description}
+        if self.fields:
+            api_repr['fields'] = [field.to_api_repr() for field in self.fields]
+        return api_repr
+
+
+def schema_from_records(records):
+    """
+    Infer a nested BigQuery-style schema (FakeSchemaFields) from a list of JSON records, the way
+    autodetect would for the clinical master table: dicts become RECORDs, lists of dicts become
+    REPEATED RECORDs, everything else is typed from the first non-null value.
+    """
+    def scalar_type(value):
+        if isinstance(value, bool):
+            return 'BOOLEAN'
+        if isinstance(value, int):
+            return 'INTEGER'
+        if isinstance(value, float):
+            return 'FLOAT'
+        return 'STRING'
+
+    def merge(fields, record):
+        for key, value in record.items():
+            if isinstance(value, list) and value and isinstance(value[0], dict):
+                sub = fields.setdefault(key, ('RECORD', 'REPEATED', collections.OrderedDict()))
+                for item in value:
+                    merge(sub[2], item)
+            elif isinstance(value, dict):
+                sub = fields.setdefault(key, ('RECORD', 'NULLABLE', collections.OrderedDict()))
+                merge(sub[2], value)
+            elif key not in fields or (fields[key][0] == 'STRING' and value is not None):
+                mode = 'REPEATED' if isinstance(value, list) else 'NULLABLE'
+                first = value[0] if isinstance(value, list) and value else value
+                fields[key] = (scalar_type(first) if first is not None else 'STRING', mode, None)
+
+    def build(fields):
+        return [FakeSchemaField(name, field_type, mode, fields=build(sub) if sub else ())
+                for name, (field_type, mode, sub) in fields.items()]
+
+    fields = collections.OrderedDict()
+    for record in records:
+        merge(fields, record)
+    return build(fields)
+
+
+class FakeTableRef(object):
+    def __init__(self, project, dataset_id, table_id):
+        self.project = project
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+
+    def __str__(self):
+        return '{}.{}.{}'.format(self.project, self.dataset_id, self.table_id)
+
+
+class FakeDatasetRef(object):
+    def __init__(self, project, dataset_id):
+        self.project = project
+        self.dataset_id = dataset_id
+
+    def table(self, table_id):
+        return FakeTableRef(self.project, self.dataset_id, table_id)
+
+
+class FakeTable(FakeTableRef):
+    def __init__(self, project, dataset_id, table_id, schema=None, num_rows=0):
+        super(FakeTable, self).__init__(project, dataset_id, table_id)
+        self.schema = schema if schema is not None else []
+        self.num_rows = num_rows
+        self.description = None
+        self.friendly_name = None
+        self.labels = {}
+        self.view_query = None
+        self.num_bytes = 0
+
+    @property
+    def reference(self):
+        return FakeTableRef(self.project, self.dataset_id, self.table_id)
+
+
+class FakeBigQuery(object):
+    def __init__(self, storage, db_file=':memory:', project='fake-project'):
+        self.project = project
+        self.storage = storage
+        self.calls = collections.Counter()
+        self._db = sqlite3.connect(db_file, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._jobs = {}
+        self._tables = {}
+
+    def _full_id(self, table):
+        if isinstance(table, FakeTableRef):
+            return str(table)
+        if hasattr(table, 'project') and hasattr(table, 'dataset_id') and hasattr(table, 'table_id'):
+            return '{}.{}.{}'.format(table.project, table.dataset_id, table.table_id)
+        pieces = str(table).replace(':', '.').split('.')
+        return '.'.join([self.project] + pieces) if len(pieces) == 2 else '.'.join(pieces)
+
+    def _translate(self, sql):
+        def table_name(match):
+            return '"{}"'.format(self._full_id(match.group(1)))
+        return re.sub(r'`([^`]+)`', table_name, sql)
+
+    def _register(self, job):
+        self._jobs[job.job_id] = job
+        return job
+
+    def _create_sqlite_table(self, full_id, names, replace):
+        if replace:
+            self._db.execute('DROP TABLE IF EXISTS "{}"'.format(full_id))
+        cols = ', '.join('"{}"'.format(name) for name in names)
+        self._db.execute('CREATE TABLE IF NOT EXISTS "{}" ({})'.format(full_id, cols))
+
+    def _refresh_table(self, full_id, schema=None):
+        project, dataset_id, table_id = full_id.split('.', 2)
+        num_rows = self._db.execute('SELECT COUNT(*) FROM "{}"'.format(full_id)).fetchone()[0]
+        table = self._tables.get(full_id)
+        if table is None:
+            table = FakeTable(project, dataset_id, table_id)
+            self._tables[full_id] = table
+        if schema is not None:
+            table.schema = list(schema)
+        elif not table.schema:
+            info = self._db.execute('PRAGMA table_info("{}")'.format(full_id)).fetchall()
+            table.schema = [FakeSchemaField(col[1]) for col in info]
+        table.num_rows = num_rows
+        return table
+
+    @staticmethod
+    def _disposition(job_config):
+        disposition = getattr(job_config, 'write_disposition', None) if job_config is not None else None
+        return str(disposition) if disposition is not None else None
+
+    def dataset(self, dataset_id, project=None):
+        return FakeDatasetRef(project if project is not None else self.project, dataset_id)
+
+    def query(self, sql, location=None, job_config=None, **kwargs):
+        self.calls['query'] += 1
+        dry_run = getattr(job_config, 'dry_run', False) if job_config is not None else False
+        destination = getattr(job_config, 'destination', None) if job_config is not None else None
+        with self._lock:
+            try:
+                if dry_run:
+                    self._db.execute('EXPLAIN {}'.format(self._translate(sql)))
+                    return self._register(FakeJob('query'))
+                cursor = self._db.execute(self._translate(sql))
+                names = [col[0] for col in cursor.description] if cursor.description else []
+                values = cursor.fetchall()
+                if destination is None:
+                    destination = FakeTableRef(self.project, '_fake_anon', 'anon_{}'.format(uuid.uuid4().hex))
+                full_id = self._full_id(destination)
+                replace = 'TRUNCATE' in (self._disposition(job_config) or 'WRITE_TRUNCATE')
+                if names:
+                    self._create_sqlite_table(full_id, names, replace)
+                    self._db.executemany('INSERT INTO "{}" VALUES ({})'.format(full_id, ', '.join('?' * len(names))),
+                                         values)
+                    self._refresh_table(full_id)
+                self._db.commit()
+                rows = FakeRowIterator([FakeRow(names, list(value)) for value in values], len(values))
+                return self._register(FakeJob('query', rows, self._tables.get(full_id, destination)))
+            except sqlite3.Error as ex:
+                return self._register(FakeJob('query', error=ex))
+
+    def _load_rows(self, lines, full_id, job_config):
+        source_format = str(getattr(job_config, 'source_format', 'CSV'))
+        schema = getattr(job_config, 'schema', None)
+        schema_names = [field.name for field in schema] if schema else None
+        if 'JSON' in source_format:
+            records = [json.loads(line) for line in lines if line.strip()]
+            names = schema_names
+            if names is None:
+                names = []
+                for record in records:
+                    names.extend(key for key in record if key not in names)
+            rows = [[json.dumps(rec[name]) if isinstance(rec.get(name), (dict, list)) else rec.get(name)
+                     for name in names] for rec in records]
+        else:
+            delimiter = getattr(job_config, 'field_delimiter', None) or ','
+            skip = getattr(job_config, 'skip_leading_rows', None) or 0
+            null_marker = getattr(job_config, 'null_marker', None)
+            reader = list(csv.reader(lines, delimiter=delimiter))
+            names = schema_names if schema_names is not None else reader[0] if reader else []
+            rows = [[None if null_marker is not None and value == null_marker else value for value in row]
+                    for row in reader[skip:]]
+        replace = 'TRUNCATE' in (self._disposition(job_config) or 'WRITE_APPEND')
+        self._create_sqlite_table(full_id, names, replace)
+        if rows:
+            self._db.executemany('INSERT INTO "{}" VALUES ({})'.format(full_id, ', '.join('?' * len(names))), rows)
+        self._db.commit()
+        self._refresh_table(full_id, schema)
+
+    def load_table_from_uri(self, source_uris, destination, job_config=None, **kwargs):
+        self.calls['load'] += 1
+        uris = [source_uris] if isinstance(source_uris, str) else list(source_uris)
+        full_id = self._full_id(destination)
+        with self._lock:
+            try:
+                lines = []
+                for uri in uris:
+                    with open(self.storage.path_for_uri(uri), 'r') as readfile:
+                        lines.extend(readfile.read().splitlines())
+                self._load_rows(lines, full_id, job_config)
+            except (OSError, sqlite3.Error, ValueError) as ex:
+                return self._register(FakeJob('load', error=ex))
+        return self._register(FakeJob('load', destination=self._tables[full_id]))
+
+    def load_table_from_file(self, file_obj, destination, job_config=None, **kwargs):
+        self.calls['load'] += 1
+        data = file_obj.read()
+        text = data.decode('utf-8') if isinstance(data, bytes) else data
+        full_id = self._full_id(destination)
+        with self._lock:
+            self._load_rows(text.splitlines(), full_id, job_config)
+        return self._register(FakeJob('load', destination=self._tables[full_id]))
+
+    def extract_table(self, source, destination_uris, location=None, job_config=None, **kwargs):
+        self.calls['extract'] += 1
+        full_id = self._full_id(source)
+        uri = destination_uris if isinstance(destination_uris, str) else destination_uris[0]
+        delimiter = getattr(job_config, 'field_delimiter', None) or ','
+        print_header = getattr(job_config, 'print_header', True)
+        with self._lock:
+            cursor = self._db.execute('SELECT * FROM "{}"'.format(full_id))
+            names = [col[0] for col in cursor.description]
+            out_path = self.storage.path_for_uri(uri)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            with open(out_path, 'w', newline='') as out:
+                writer = csv.writer(out, delimiter=delimiter, lineterminator='\n')
+                if print_header is not False:
+                    writer.writerow(names)
+                for row in cursor:
+                    writer.writerow(['' if value is None else value for value in row])
+        return self._register(FakeJob('extract'))
+
+    def get_job(self, job_id, location=None, **kwargs):
+        return self._jobs[job_id]
+
+    def get_table(self, table):
+        self.calls['get_table'] += 1
+        full_id = self._full_id(table)
+        if full_id not in self._tables:
+            from google.api_core.exceptions import NotFound
+            raise NotFound('Table {} not found'.format(full_id))
+        return self._tables[full_id]
+
+    def create_table(self, table, exists_ok=False, **kwargs):
+        self.calls['create_table'] += 1
+        full_id = self._full_id(table)
+        schema = list(getattr(table, 'schema', []) or [])
+        with self._lock:
+            self._create_sqlite_table(full_id, [field.name for field in schema] or ['_empty'], False)
+            created = self._refresh_table(full_id, schema)
+        for attr in ('description', 'friendly_name', 'labels', 'view_query'):
+            if getattr(table, attr, None) is not None:
+                setattr(created, attr, getattr(table, attr))
+        return created
+
+    def update_table(self, table, fields, **kwargs):
+        self.calls['update_table'] += 1
+        stored = self._tables[self._full_id(table)]
+        for field in fields:
+            attr = 'friendly_name' if field == 'friendlyName' else field
+            value = getattr(table, attr)
+            if attr == 'labels':
+                labels = dict(stored.labels)
+                for key, label in value.items():
+                    if label is None:
+                        labels.pop(key, None)
+                    else:
+                        labels[key] = label
+                value = labels
+            setattr(stored, attr, value)
+        return stored
+
+    def delete_table(self, table, not_found_ok=False, **kwargs):
+        self.calls['delete_table'] += 1
+        full_id = self._full_id(table)
+        with self._lock:
+            self._db.execute('DROP TABLE IF EXISTS "{}"'.format(full_id))
+            self._tables.pop(full_id, None)
+
+    def list_tables(self, dataset, **kwargs):
+        dataset_id = dataset.dataset_id if hasattr(dataset, 'dataset_id') else str(dataset).split('.')[-1]
+        return [table for table in self._tables.values() if table.dataset_id == dataset_id]
+
+    def list_datasets(self, **kwargs):
+        names = sorted(set(table.dataset_id for table in self._tables.values()))
+        return [FakeDatasetRef(self.project, name) for name in names]
+
+    def create_dataset(self, dataset, **kwargs):
+        return dataset
+
+    def delete_dataset(self, dataset, delete_contents=False, not_found_ok=False, **kwargs):
+        dataset_id = dataset.dataset_id if hasattr(dataset, 'dataset_id') else str(dataset).split('.')[-1]
+        for table in list(self.list_tables(dataset_id)):
+            self.delete_table(table)
+
+
+class _FakeRegistry(dict):
+    """
+    Stands in for the common_etl client registry: every project gets the fake for its service
+    """
+
+    def __init__(self, fakes):
+        super(_FakeRegistry, self).__init__()
+        self._fakes = fakes
+
+    def get(self, key, default=None):
+        return self._fakes.get(key[0], default)
+
+
+@contextlib.contextmanager
+def use_fake_google(root_dir, project='fake-project'):
+    """
+    Route the common_etl client registry (and google.cloud bigquery.Client / storage.Client, if
+    installed) to a FakeStorage and FakeBigQuery rooted at root_dir. Yields (storage, bigquery).
+    """
+    import common_etl.support as support
+
+    storage = FakeStorage(os.path.join(root_dir, 'gcs'), project)
+    bigquery = FakeBigQuery(storage, os.path.join(root_dir, 'bq.sqlite'), project)
+    saved_registry = support._CLIENTS
+    saved_thread_client = support.thread_gcs_client
+    support._CLIENTS = _FakeRegistry({'bigquery': bigquery, 'storage': storage})
+    support.thread_gcs_client = lambda: storage
+
+    patched = []
+    for module_name, fake in (('google.cloud.bigquery', bigquery), ('google.cloud.storage', storage)):
+        try:
+            module = __import__(module_name, fromlist=['Client'])
+        except ImportError:
+            continue
+        patched.append((module, module.Client))
+        module.Client = lambda *args, **kwargs: fake
+
+    try:
+        yield storage, bigquery
+    finally:
+        support._CLIENTS = saved_registry
+        support.thread_gcs_client = saved_thread_client
+        for module, client_class in patched:
+            module.Client = client_class
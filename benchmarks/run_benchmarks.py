@@ -0,0 +1,337 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (REPO_ROOT, os.path.join(REPO_ROOT, 'BQ_Table_Building')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from benchmarks.mock_services import FakeGDC, FakePDC, FakeTable, schema_from_records, use_fake_google
+from benchmarks import synthetic_data
+
+'''
+----------------------------------------------------------------------------------------------
+Offline benchmarks for the builders, run against the services in mock_services.py:
+
+    python -m benchmarks.run_benchmarks -s 1.0 -r 3 -o results.json [--baseline old_results.json]
+
+Every benchmark does its setup (fixtures, fake servers, builder params) and hands back a function
+to time, plus an optional cleanup. Each one is timed -r times and the median is reported. With a
+baseline, a benchmark whose median is more than --tolerance slower is flagged as a regression
+and the exit status is 1. A benchmark whose builder cannot be imported here (e.g. pandas is not
+installed) is reported as skipped rather than failing the run.
+
+Fixtures come from synthetic_data.py. The -s scale multiplies case and file counts (1.0 is about
+one program in a release) and -w multiplies the rows in each file.
+'''
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return register
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def _quiet():
+    """
+    The builders print progress for every file and page; keep that out of the timings report. If the
+    run fails, what it printed goes to stderr, since the reason is usually in there.
+    """
+    captured = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(captured):
+            yield
+    except BaseException:
+        sys.stderr.write(captured.getvalue())
+        raise
+
+
+def _scaled(count, scale):
+    return max(1, int(count * scale))
+
+
+'''
+----------------------------------------------------------------------------------------------
+Benchmarks
+'''
+
+
+def _file_info(file_name, program_prefix):
+    return [os.path.basename(os.path.dirname(file_name)), program_prefix]
+
+
+def _star_files(work_dir, args):
+    return synthetic_data.write_files('star', os.path.join(work_dir, 'files'), args.scale * 0.2, args.rows_scale,
+                                      args.seed, 'mixed')
+
+
+@benchmark('concat_all_files')
+def bench_concat_all_files(work_dir, args):
+    import common_etl.support as support
+    all_files = _star_files(work_dir, args)
+    out_file = os.path.join(work_dir, 'concat.tsv')
+
+    def run():
+        with _quiet():
+            support.concat_all_files(all_files, out_file, 'BENCH', ['file_gdc_id', 'program'],
+                                     _file_info, None)
+    return run, None
+
+
+@benchmark('concat_all_files_parallel')
+def bench_concat_all_files_parallel(work_dir, args):
+    import common_etl.support as support
+    all_files = _star_files(work_dir, args)
+    out_file = os.path.join(work_dir, 'concat.tsv')
+
+    def run():
+        with _quiet():
+            support.concat_all_files_parallel(all_files, out_file, 'BENCH', ['file_gdc_id', 'program'],
+                                              _file_info, None)
+    return run, None
+
+
+@benchmark('maf_concat')
+def bench_maf_concat(work_dir, args):
+    import build_open_somatic_mut_bq_table as builder
+    all_files = synthetic_data.write_files('maf', os.path.join(work_dir, 'files'), args.scale, args.rows_scale,
+                                           args.seed, 'gz')
+    out_file = os.path.join(work_dir, 'maf.tsv')
+    fields_to_fix = [{'Tumor_Sample_Barcode': 'Tumor_Aliquot_Barcode'},
+                     {'Matched_Norm_Sample_Barcode': 'Matched_Norm_Aliquot_Barcode'}]
+
+    def run():
+        with _quiet():
+            builder.concat_all_files(all_files, out_file, 'CPTAC', synthetic_data.MAF_CALLERS, fields_to_fix)
+    return run, None
+
+
+@benchmark('methylation_concat')
+def bench_methylation_concat(work_dir, args):
+    import build_dna_methylation_bq_table as builder
+    import common_etl.support as support
+    all_files = synthetic_data.write_files('methylation', os.path.join(work_dir, 'files'), args.scale * 0.1,
+                                           args.rows_scale * 0.1, args.seed, 'gz')
+    out_file = os.path.join(work_dir, 'methylation.tsv')
+
+    def run():
+        with _quiet():
+            support.concat_all_files_parallel(all_files, out_file, 'TCGA', ['platform', 'aliquot_barcode', 'file_gdc_id'],
+                                              builder.file_info, None,
+                                              retain_cols=['Composite Element REF', 'Beta_value'],
+                                              check_col='Beta_value', drop_val='NA')
+    return run, None
+
+
+@benchmark('retrieve_and_save_case_records')
+def bench_retrieve_and_save_case_records(work_dir, args):
+    import build_clinical_data_bq_table as builder
+    num_cases = _scaled(synthetic_data.SIZES['clinical']['cases'], args.scale)
+    gdc = FakeGDC(cases=synthetic_data.make_cases(num_cases, args.seed), latency=args.latency).start()
+    builder.API_PARAMS = {
+        'ENDPOINT': '{}/cases'.format(gdc.url),
+        'BATCH_SIZE': 1000,
+        'START_INDEX': 0,
+        'MAX_PAGES': None,
+        'EXCLUDE_FIELDS': synthetic_data.DEFAULT_FIELD_CONFIG['cases']['excluded_fields'],
+        'FIELD_GROUPS': [fg.split('.', 1)[1] for fg in synthetic_data.DEFAULT_FIELD_CONFIG if '.' in fg]
+    }
+    builder.BQ_PARAMS = {'IO_MODE': 'w', 'RELEASE': 'bench'}
+    scratch_fp = os.path.join(work_dir, 'cases.jsonl')
+
+    def run():
+        with _quiet():
+            builder.retrieve_and_save_case_records(scratch_fp)
+    return run, gdc.stop
+
+
+@benchmark('create_and_load_tables')
+def bench_create_and_load_tables(work_dir, args):
+    """
+    Runs the create_tables step for one program (structure analysis, schema building, jsonl
+    writing, upload and load), which is where create_and_load_tables spends its time. Needs the
+    clinical yaml config for the table naming params; cases are generated from its FIELD_CONFIG.
+    """
+    if not args.clinical_config:
+        raise SkipBenchmark('needs --clinical_config')
+    import build_clinical_data_program_tables as builder
+    from common_etl.utils import create_schema_dict, get_working_table_id, load_config
+
+    api_params, bq_params, _ = load_config([None, args.clinical_config], builder.YAML_HEADERS)
+    bq_params = dict(bq_params, SCRATCH_DIR=work_dir, LOCATION='US', UPLOAD_PARTS=None)
+    builder.API_PARAMS, builder.BQ_PARAMS = api_params, bq_params
+
+    num_cases = _scaled(synthetic_data.SIZES['clinical']['cases'], args.scale)
+    cases = synthetic_data.make_cases(num_cases, args.seed, api_params['FIELD_CONFIG'], programs=['TCGA'])
+    fake_google = contextlib.ExitStack()
+    storage, bigquery = fake_google.enter_context(use_fake_google(os.path.join(work_dir, 'google')))
+    project, dataset_id, table_id = get_working_table_id(bq_params).split('.')
+    bigquery.create_table(FakeTable(project, dataset_id, table_id, schema=schema_from_records(cases)))
+    schema = create_schema_dict(api_params, bq_params)
+
+    def run():
+        with _quiet():
+            builder.create_tables('TCGA', [json.loads(json.dumps(case)) for case in cases], dict(schema))
+
+    return run, fake_google.close
+
+
+@benchmark('build_quant_tsv')
+def bench_build_quant_tsv(work_dir, args):
+    import build_pdc_tables as builder
+    sizes = synthetic_data.SIZES['quant']
+    matrix = synthetic_data.quant_matrix(_scaled(sizes['aliquots'], args.scale),
+                                         _scaled(sizes['genes'], args.rows_scale), args.seed)
+    pdc = FakePDC({'quantDataMatrix': lambda query: [list(row) for row in matrix]}, latency=args.latency).start()
+    builder.API_PARAMS = {'ENDPOINT': '{}/graphql'.format(pdc.url)}
+    builder.BQ_PARAMS = {'NULL_MARKER': ''}
+    study = {'study_submitter_id': 'BENCH-STUDY', 'study_name': 'Benchmark study'}
+    tsv_fp = os.path.join(work_dir, 'quant.tsv')
+
+    def run():
+        with _quiet():
+            builder.build_quant_tsv(study, 'log2_ratio', tsv_fp)
+    return run, pdc.stop
+
+
+@benchmark('vcf_transform')
+def bench_vcf_transform(work_dir, args):
+    import build_cabq_vcf as builder
+    num_records = _scaled(synthetic_data.SIZES['vcf']['records'] * 100, args.rows_scale)
+    rng = synthetic_data.rng_for(args.seed, 'vcf', 0)
+    lines = [line.encode('utf-8') for line in synthetic_data.vcf_lines(rng, num_records)]
+    format_file = os.path.join(work_dir, 'format_info.txt')
+
+    def run():
+        with _quiet():
+            column_headers, records, ref_id = builder.parse_zipped_vcf(lines, format_file)
+            builder.generate_dataframe(column_headers, records, ref_id, 'gs://bench/file.vcf.gz', 'TCGA-BENCH',
+                                       'file.vcf.gz', 'MuTect2', 'TCGA-00-0000', 'TCGA-00-0000-01A',
+                                       os.path.join(work_dir, 'vcf.csv'), False, True)
+    return run, None
+
+
+'''
+----------------------------------------------------------------------------------------------
+Runner
+'''
+
+
+def run_benchmarks(names, repeats, args):
+    results = {}
+    if args.work_dir is not None:
+        os.makedirs(args.work_dir, exist_ok=True)
+    for name, func in BENCHMARKS:
+        if names and name not in names:
+            continue
+        work_dir = tempfile.mkdtemp(prefix='bench-{}-'.format(name), dir=args.work_dir)
+        cleanup = None
+        try:
+            try:
+                run, cleanup = func(work_dir, args)
+            except ImportError as ex:
+                raise SkipBenchmark('cannot import: {}'.format(ex))
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                run()
+                times.append(time.perf_counter() - start)
+            results[name] = {'median': statistics.median(times), 'min': min(times), 'times': times}
+            print("{:35s} median {:9.3f}s  min {:9.3f}s".format(name, results[name]['median'], results[name]['min']))
+        except SkipBenchmark as ex:
+            results[name] = {'skipped': str(ex)}
+            print("{:35s} skipped ({})".format(name, ex))
+        except (Exception, SystemExit) as ex:
+            # Builders call sys.exit() on fatal errors; that should not end the whole run:
+            reason = 'exit {}'.format(ex.code) if isinstance(ex, SystemExit) else repr(ex)
+            results[name] = {'failed': reason}
+            print("{:35s} FAILED ({})".format(name, reason))
+        finally:
+            if cleanup is not None:
+                cleanup()
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Returns the names of benchmarks more than tolerance (a fraction) slower than the baseline
+    """
+    regressions = []
+    for name, result in results.items():
+        if 'median' not in result or 'median' not in baseline.get(name, {}):
+            continue
+        ratio = result['median'] / baseline[name]['median']
+        result['vs_baseline'] = ratio
+        flag = ''
+        if ratio > 1.0 + tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print("{:35s} {:6.2f}x baseline{}".format(name, ratio, flag))
+    return regressions
+
+
+def main(args):
+    names = args.benchmarks.split(',') if args.benchmarks else None
+    results = run_benchmarks(names, args.repeats, args)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+    if args.output:
+        with open(args.output, 'w') as out_file:
+            json.dump({'scale': args.scale, 'rows_scale': args.rows_scale, 'seed': args.seed,
+                       'repeats': args.repeats, 'results': results}, out_file, indent=2)
+    failures = [name for name, result in results.items() if 'failed' in result]
+    return 1 if regressions or failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the builders offline against mock GDC/PDC/GCS/BQ services")
+    parser.add_argument("-b", "--benchmarks", type=str, help="comma separated benchmark names (default all)")
+    parser.add_argument("-s", "--scale", type=float, default=1.0, help="multiplier on case and file counts")
+    parser.add_argument("-w", "--rows_scale", type=float, default=1.0, help="multiplier on rows per file")
+    parser.add_argument("--seed", type=int, default=0, help="fixture random seed")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="timed runs per benchmark")
+    parser.add_argument("-o", "--output", type=str, help="write results as json")
+    parser.add_argument("--baseline", type=str, help="results json from an earlier run to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="slowdown fraction flagged as a regression")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every mock API request")
+    parser.add_argument("--clinical_config", type=str, help="clinical yaml config, for create_and_load_tables")
+    parser.add_argument("-d", "--work_dir", type=str, default=None, help="directory for fixtures and outputs")
+    sys.exit(main(parser.parse_args()))
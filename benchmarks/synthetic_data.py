@@ -0,0 +1,620 @@
+"""
+
+Copyright 2020, Institute for Systems Biology
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import sys
+import uuid
+import zipfile
+
+import yaml
+
+'''
+----------------------------------------------------------------------------------------------
+Seeded generator for benchmark fixtures shaped like a GDC release:
+
+    clinical       nested case records laid out by a FIELD_CONFIG (as in the clinical yaml)
+    star           STAR - Counts augmented gene count TSVs
+    htseq          HTSeq counts files
+    maf            ensemble MAFs with the callers column at caller_col (124) and TCGA-style
+                   per-caller MAFs
+    methylation    level 3 beta value files
+    vcf            somatic VCFs with FORMAT, NORMAL and TUMOR columns
+    quant          PDC quantDataMatrix rows
+
+Every case and file is generated from its own Random seeded by (seed, kind, index), so the output
+does not depend on how many items are asked for or in what order: case 10 is the same case in a
+1x and a 100x run. Files are laid out the way pull_from_buckets leaves them, <file uuid>/<name>,
+and gzipped or zipped the way the GDC serves them.
+
+SIZES gives the counts for one program in a release (scale 1.0). The scale multiplies the
+number of cases and files; rows_scale multiplies the rows inside each file, which is handy for
+small smoke runs.
+'''
+
+SIZES = {
+    'clinical': {'cases': 11000},
+    'star': {'files': 1000, 'genes': 60660},
+    'htseq': {'files': 1000, 'genes': 60483},
+    'maf': {'files': 500, 'rows': 400},
+    'methylation': {'files': 500, 'probes': 485577},
+    'vcf': {'files': 500, 'records': 2000},
+    'quant': {'aliquots': 200, 'genes': 10000},
+}
+
+PROGRAMS = ['TCGA', 'TARGET', 'CPTAC', 'HCMI', 'BEATAML1.0', 'CGCI']
+
+MAF_CALLERS = ['muse', 'mutect', 'somaticsniper', 'varscan2', 'pindel']
+
+'''
+----------------------------------------------------------------------------------------------
+Clinical field groups. Same layout as FIELD_CONFIG / FG_CONFIG in the clinical yaml config;
+a FIELD_CONFIG read from a real config can be passed in instead.
+'''
+
+DEFAULT_FIELD_CONFIG = {
+    'cases': {
+        'id_key': 'case_id', 'prefix': None, 'table_suffix': None,
+        'excluded_fields': ['aliquot_ids', 'analyte_ids', 'portion_ids', 'sample_ids', 'slide_ids',
+                            'submitter_aliquot_ids', 'submitter_analyte_ids', 'submitter_portion_ids',
+                            'submitter_sample_ids', 'submitter_slide_ids'],
+        'app_excluded_fields': ['id', 'state'],
+        'column_order': ['submitter_id', 'case_id', 'primary_site', 'disease_type', 'index_date',
+                         'days_to_index', 'consent_type', 'days_to_consent', 'lost_to_followup',
+                         'days_to_lost_to_followup', 'state', 'created_datetime', 'updated_datetime']
+    },
+    'cases.project': {
+        'id_key': 'project_id', 'prefix': 'proj', 'table_suffix': None,
+        'excluded_fields': [], 'app_excluded_fields': [],
+        'column_order': ['project_id', 'name']
+    },
+    'cases.demographic': {
+        'id_key': 'demographic_id', 'prefix': 'demo', 'table_suffix': None,
+        'excluded_fields': ['submitter_id'], 'app_excluded_fields': ['state'],
+        'column_order': ['demographic_id', 'gender', 'race', 'ethnicity', 'vital_status',
+                         'age_at_index', 'days_to_birth', 'year_of_birth', 'days_to_death',
+                         'year_of_death', 'cause_of_death', 'state', 'created_datetime', 'updated_datetime']
+    },
+    'cases.diagnoses': {
+        'id_key': 'diagnosis_id', 'prefix': 'diag', 'table_suffix': 'diag',
+        'excluded_fields': ['submitter_id'], 'app_excluded_fields': ['state'],
+        'column_order': ['diagnosis_id', 'primary_diagnosis', 'tissue_or_organ_of_origin', 'site_of_resection_or_biopsy',
+                         'morphology', 'classification_of_tumor', 'tumor_grade', 'tumor_stage', 'ajcc_pathologic_stage',
+                         'ajcc_pathologic_t', 'ajcc_pathologic_n', 'ajcc_pathologic_m', 'age_at_diagnosis',
+                         'days_to_diagnosis', 'days_to_last_follow_up', 'days_to_recurrence', 'prior_malignancy',
+                         'prior_treatment', 'progression_or_recurrence', 'last_known_disease_status',
+                         'state', 'created_datetime', 'updated_datetime']
+    },
+    'cases.diagnoses.treatments': {
+        'id_key': 'treatment_id', 'prefix': 'diag__treat', 'table_suffix': 'diag__treat',
+        'excluded_fields': ['submitter_id'], 'app_excluded_fields': ['state'],
+        'column_order': ['treatment_id', 'treatment_type', 'treatment_or_therapy', 'treatment_intent_type',
+                         'therapeutic_agents', 'days_to_treatment_start', 'days_to_treatment_end',
+                         'treatment_outcome', 'state', 'created_datetime', 'updated_datetime']
+    },
+    'cases.diagnoses.annotations': {
+        'id_key': 'annotation_id', 'prefix': 'diag__anno', 'table_suffix': 'diag__anno',
+        'excluded_fields': ['submitter_id'], 'app_excluded_fields': ['state'],
+        'column_order': ['annotation_id', 'entity_id', 'entity_type', 'category', 'classification',
+                         'notes', 'status', 'state', 'created_datetime', 'updated_datetime']
+    },
+    'cases.exposures': {
+        'id_key': 'exposure_id', 'prefix': 'exp', 'table_suffix': 'exp',
+        'excluded_fields': ['submitter_id'], 'app_excluded_fields': ['state'],
+        'column_order': ['exposure_id', 'alcohol_history', 'alcohol_intensity', 'tobacco_smoking_status',
+                         'pack_years_smoked', 'years_smoked', 'cigarettes_per_day', 'bmi', 'height', 'weight',
+                         'state', 'created_datetime', 'updated_datetime']
+    },
+    'cases.family_histories': {
+        'id_key': 'family_history_id', 'prefix': 'fam_hist', 'table_suffix': 'fam_hist',
+        'excluded_fields': ['submitter_id'], 'app_excluded_fields': ['state'],
+        'column_order': ['family_history_id', 'relationship_type', 'relationship_gender',
+                         'relationship_age_at_diagnosis', 'relationship_primary_diagnosis',
+                         'relative_with_cancer_history', 'state', 'created_datetime', 'updated_datetime']
+    },
+    'cases.follow_ups': {
+        'id_key': 'follow_up_id', 'prefix': 'follow', 'table_suffix': 'follow',
+        'excluded_fields': ['submitter_id'], 'app_excluded_fields': ['state'],
+        'column_order': ['follow_up_id', 'days_to_follow_up', 'disease_response', 'ecog_performance_status',
+                         'karnofsky_performance_status', 'progression_or_recurrence', 'progression_or_recurrence_type',
+                         'days_to_progression', 'state', 'created_datetime', 'updated_datetime']
+    },
+    'cases.follow_ups.molecular_tests': {
+        'id_key': 'molecular_test_id', 'prefix': 'follow__mol_test', 'table_suffix': 'follow__mol_test',
+        'excluded_fields': ['submitter_id'], 'app_excluded_fields': ['state'],
+        'column_order': ['molecular_test_id', 'gene_symbol', 'laboratory_test', 'molecular_analysis_method',
+                         'test_result', 'test_value', 'test_units', 'variant_type', 'state',
+                         'created_datetime', 'updated_datetime']
+    }
+}
+
+DEFAULT_FG_CONFIG = {
+    'base_fg': 'cases',
+    'order': list(DEFAULT_FIELD_CONFIG.keys()),
+    'last_keys_in_table': [],
+    'excluded_fgs': ['cases.project']
+}
+
+#
+# Field groups the API returns as a single object rather than a list:
+#
+
+SINGLE_FGS = {'cases.project', 'cases.demographic'}
+
+#
+# Average number of child records for a list field group. The real distributions are long
+# tailed: most cases have one diagnosis and no molecular tests, a few have dozens.
+#
+
+FG_FANOUT = {
+    'cases.diagnoses': 1.3,
+    'cases.diagnoses.treatments': 2.0,
+    'cases.diagnoses.annotations': 0.1,
+    'cases.exposures': 0.8,
+    'cases.family_histories': 0.6,
+    'cases.follow_ups': 3.0,
+    'cases.follow_ups.molecular_tests': 1.5
+}
+
+VOCAB = {
+    'gender': ['female', 'male', 'not reported'],
+    'race': ['white', 'black or african american', 'asian', 'not reported', 'Unknown'],
+    'ethnicity': ['not hispanic or latino', 'hispanic or latino', 'not reported'],
+    'vital_status': ['Alive', 'Dead', 'Not Reported'],
+    'primary_diagnosis': ['Adenocarcinoma, NOS', 'Squamous cell carcinoma, NOS', 'Infiltrating duct carcinoma, NOS',
+                          'Acute myeloid leukemia, NOS', 'Glioblastoma', 'Serous cystadenocarcinoma, NOS'],
+    'treatment_type': ['Pharmaceutical Therapy, NOS', 'Radiation Therapy, NOS', 'Surgery, NOS'],
+    'state': ['released'],
+    'tumor_grade': ['G1', 'G2', 'G3', 'G4', 'Not Reported'],
+    'ajcc_pathologic_stage': ['Stage I', 'Stage IA', 'Stage II', 'Stage IIB', 'Stage III', 'Stage IV', None],
+}
+
+YES_NO = ['yes', 'no', 'not reported', None]
+
+
+def rng_for(seed, kind, index):
+    """
+    Independent, reproducible Random for one item
+    """
+    return random.Random('{}:{}:{}'.format(seed, kind, index))
+
+
+def rng_uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def _poisson(rng, mean):
+    """
+    Small-mean Poisson draw (Knuth), for child record counts
+    """
+    limit = pow(2.718281828459045, -mean)
+    count = 0
+    product = rng.random()
+    while product > limit:
+        count += 1
+        product *= rng.random()
+    return count
+
+
+def _field_value(rng, field, program, case_index):
+    if field in VOCAB:
+        return rng.choice(VOCAB[field])
+    if field.endswith('_id'):
+        return rng_uuid(rng)
+    if field.startswith('days_to') or field.startswith('age_at') or field.endswith('_age_at_diagnosis'):
+        return rng.randint(-30000, 5000) if rng.random() < 0.8 else None
+    if field.startswith('year_of'):
+        return rng.randint(1920, 2015) if rng.random() < 0.7 else None
+    if field.endswith('_datetime'):
+        return '20{:02d}-{:02d}-{:02d}T{:02d}:00:00.000000-05:00'.format(rng.randint(16, 23), rng.randint(1, 12),
+                                                                        rng.randint(1, 28), rng.randint(0, 23))
+    if field in ('bmi', 'height', 'weight', 'pack_years_smoked', 'test_value', 'cigarettes_per_day'):
+        return round(rng.uniform(1, 200), 2) if rng.random() < 0.5 else None
+    if field.startswith('prior_') or field.startswith('relative_with') or field == 'lost_to_followup':
+        return rng.choice(YES_NO)
+    if rng.random() < 0.3:
+        return None
+    return '{} {}'.format(field.replace('_', ' '), rng.randint(1, 12))
+
+
+def _fill_fg(rng, field_config, fg, program, case_index):
+    record = {}
+    for field in field_config[fg].get('column_order') or []:
+        record[field] = _field_value(rng, field, program, case_index)
+    record[field_config[fg]['id_key']] = rng_uuid(rng)
+    record['submitter_id'] = '{}-{:06d}-{}'.format(program, case_index, fg.split('.')[-1])
+    return record
+
+
+def make_case(index, seed=0, field_config=None, programs=PROGRAMS):
+    """
+    One nested case record, in the shape the GDC cases endpoint returns it with every field
+    group expanded. Child field groups are nested under their parents by name.
+    """
+    field_config = field_config if field_config is not None else DEFAULT_FIELD_CONFIG
+    rng = rng_for(seed, 'case', index)
+    program = programs[index % len(programs)]
+    base_fg = min(field_config, key=lambda fg: fg.count('.'))
+    case = _fill_fg(rng, field_config, base_fg, program, index)
+    case['id'] = case[field_config[base_fg]['id_key']]
+    case['submitter_id'] = '{}-{:06d}'.format(program, index)
+
+    def attach(parent, parent_fg):
+        depth = parent_fg.count('.') + 1
+        for fg in sorted(field_config):
+            if not fg.startswith(parent_fg + '.') or fg.count('.') != depth:
+                continue
+            name = fg.split('.')[-1]
+            if fg in SINGLE_FGS:
+                child = _fill_fg(rng, field_config, fg, program, index)
+                attach(child, fg)
+                parent[name] = child
+            else:
+                count = _poisson(rng, FG_FANOUT.get(fg, 1.0))
+                if count:
+                    children = [_fill_fg(rng, field_config, fg, program, index) for _ in range(count)]
+                    for child in children:
+                        attach(child, fg)
+                    parent[name] = children
+
+    attach(case, base_fg)
+    if 'project' in case:
+        case['project']['project_id'] = '{}-SYN{}'.format(program, index % 20)
+        case['project']['program'] = {'name': program, 'program_id': str(uuid.uuid5(uuid.NAMESPACE_DNS, program))}
+    return case
+
+
+def make_cases(num_cases, seed=0, field_config=None, programs=PROGRAMS, start=0):
+    return [make_case(i, seed, field_config, programs) for i in range(start, start + num_cases)]
+
+
+def write_cases_jsonl(out_file, num_cases, seed=0, field_config=None):
+    """
+    Cases as JSON lines, the way retrieve_and_save_case_records leaves them
+    """
+    with open(out_file, 'w') as out:
+        for i in range(num_cases):
+            json.dump(make_case(i, seed, field_config), out)
+            out.write('\n')
+    return out_file
+
+
+'''
+----------------------------------------------------------------------------------------------
+Files
+'''
+
+
+def write_lines(path, lines, compression=None):
+    """
+    Write lines to path, or to path.gz / path.zip. A zip holds one member named like the file,
+    so unzipping next to it gives back path. Returns the name written.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if compression == 'gz':
+        path = '{}.gz'.format(path)
+        with gzip.open(path, 'wt', compresslevel=6) as out:
+            out.writelines(lines)
+    elif compression == 'zip':
+        zip_path = '{}.zip'.format(path)
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_out:
+            zip_out.writestr(os.path.basename(path), ''.join(lines))
+        path = zip_path
+    else:
+        with open(path, 'w') as out:
+            out.writelines(lines)
+    return path
+
+
+def gene_ids(num_genes, seed=0):
+    """
+    The same gene list for every file of a run, like a real annotation
+    """
+    rng = rng_for(seed, 'genes', 0)
+    genes = []
+    for i in range(num_genes):
+        genes.append(('ENSG{:011d}.{}'.format(i * 7 + 3, rng.randint(1, 20)),
+                      'GENE{}'.format(i),
+                      rng.choice(['protein_coding', 'lncRNA', 'processed_pseudogene', 'miRNA'])))
+    return genes
+
+
+def star_counts_lines(rng, genes):
+    lines = ['# gene-model: GENCODE v36\n',
+             'gene_id\tgene_name\tgene_type\tunstranded\tstranded_first\tstranded_second\t'
+             'tpm_unstranded\tfpkm_unstranded\tfpkm_uq_unstranded\n']
+    for stat in ('N_unmapped', 'N_multimapping', 'N_noFeature', 'N_ambiguous'):
+        count = rng.randint(10 ** 5, 10 ** 7)
+        lines.append('{}\t\t\t{}\t{}\t{}\t\t\t\n'.format(stat, count, count // 2, count // 2))
+    for gene_id, gene_name, gene_type in genes:
+        count = int(rng.expovariate(1.0 / 500)) if rng.random() < 0.7 else 0
+        tpm = count * 0.0123
+        lines.append('{}\t{}\t{}\t{}\t{}\t{}\t{:.4f}\t{:.4f}\t{:.4f}\n'.format(
+            gene_id, gene_name, gene_type, count, count // 2, count - count // 2, tpm, tpm * 0.4, tpm * 0.9))
+    return lines
+
+
+def htseq_lines(rng, genes):
+    lines = ['{}\t{}\n'.format(gene_id, int(rng.expovariate(1.0 / 500)) if rng.random() < 0.7 else 0)
+             for gene_id, _, _ in genes]
+    for stat in ('__no_feature', '__ambiguous', '__too_low_aQual', '__not_aligned', '__alignment_not_unique'):
+        lines.append('{}\t{}\n'.format(stat, rng.randint(10 ** 4, 10 ** 7)))
+    return lines
+
+
+def maf_columns(caller_col=124):
+    """
+    Ensemble MAF header. The GDC MAF columns come first, padded with annotation columns so that
+    the callers column sits at caller_col, where build_open_somatic_mut_bq_table expects it.
+    """
+    columns = ['Hugo_Symbol', 'Entrez_Gene_Id', 'Center', 'NCBI_Build', 'Chromosome', 'Start_Position',
+               'End_Position', 'Strand', 'Variant_Classification', 'Variant_Type', 'Reference_Allele',
+               'Tumor_Seq_Allele1', 'Tumor_Seq_Allele2', 'dbSNP_RS', 'dbSNP_Val_Status', 'Tumor_Sample_Barcode',
+               'Matched_Norm_Sample_Barcode', 'Match_Norm_Seq_Allele1', 'Match_Norm_Seq_Allele2',
+               'Tumor_Validation_Allele1', 'Tumor_Validation_Allele2', 'Match_Norm_Validation_Allele1',
+               'Match_Norm_Validation_Allele2', 'Verification_Status', 'Validation_Status', 'Mutation_Status',
+               'Sequencing_Phase', 'Sequence_Source', 'Validation_Method', 'Score', 'BAM_File', 'Sequencer',
+               'Tumor_Sample_UUID', 'Matched_Norm_Sample_UUID', 'HGVSc', 'HGVSp', 'HGVSp_Short', 'Transcript_ID',
+               'Exon_Number', 't_depth', 't_ref_count', 't_alt_count', 'n_depth', 'n_ref_count', 'n_alt_count',
+               'all_effects', 'Allele', 'Gene', 'Feature', 'Feature_type', 'One_Consequence', 'Consequence',
+               'cDNA_position', 'CDS_position', 'Protein_position', 'Amino_acids', 'Codons', 'Existing_variation',
+               'DISTANCE', 'TRANSCRIPT_STRAND', 'SYMBOL', 'SYMBOL_SOURCE', 'HGNC_ID', 'BIOTYPE', 'CANONICAL',
+               'CCDS', 'ENSP', 'SWISSPROT', 'TREMBL', 'UNIPARC', 'RefSeq', 'SIFT', 'PolyPhen', 'EXON', 'INTRON',
+               'DOMAINS', 'GMAF', 'AFR_MAF', 'AMR_MAF', 'ASN_MAF', 'EAS_MAF', 'EUR_MAF', 'SAS_MAF', 'AA_MAF',
+               'EA_MAF', 'CLIN_SIG', 'SOMATIC', 'PUBMED', 'MOTIF_NAME', 'MOTIF_POS', 'HIGH_INF_POS',
+               'MOTIF_SCORE_CHANGE', 'IMPACT', 'PICK', 'VARIANT_CLASS', 'TSL', 'HGVS_OFFSET', 'PHENO',
+               'MINIMISED', 'ExAC_AF', 'ExAC_AF_Adj', 'ExAC_AF_AFR', 'ExAC_AF_AMR', 'ExAC_AF_EAS', 'ExAC_AF_FIN',
+               'ExAC_AF_NFE', 'ExAC_AF_OTH', 'ExAC_AF_SAS', 'GENE_PHENO', 'FILTER', 'CONTEXT', 'src_vcf_id',
+               'tumor_bam_uuid', 'normal_bam_uuid', 'case_id', 'GDC_FILTER', 'COSMIC', 'MC3_Overlap',
+               'GDC_Validation_Status']
+    pad = 0
+    while len(columns) < caller_col:
+        columns.append('annotation_{}'.format(pad))
+        pad += 1
+    columns = columns[:caller_col]
+    columns.append('callers')
+    return columns
+
+
+def maf_lines(rng, num_rows, columns, case_id, callers_in_file=None):
+    """
+    MAF body. callers_in_file=None gives an ensemble MAF with a callers column like
+    "mutect;muse*;varscan2"; a caller name gives a single caller MAF (TCGA style, where the
+    caller is only in the file name unless columns has a callers column).
+    """
+    lines = ['#version gdc-1.0.0\n', '#filedate 20210101\n', '\t'.join(columns) + '\n']
+    index = {name: i for i, name in enumerate(columns)}
+    tumor_bam = rng_uuid(rng)
+    normal_bam = rng_uuid(rng)
+    for _ in range(num_rows):
+        row = [''] * len(columns)
+        ref, alt = rng.sample('ACGT', 2)
+        start = rng.randint(1, 10 ** 8)
+        row[index['Hugo_Symbol']] = 'GENE{}'.format(rng.randint(0, 20000))
+        row[index['Entrez_Gene_Id']] = str(rng.randint(1, 10 ** 5))
+        row[index['Center']] = 'BI'
+        row[index['NCBI_Build']] = 'GRCh38'
+        row[index['Chromosome']] = 'chr{}'.format(rng.randint(1, 22))
+        row[index['Start_Position']] = str(start)
+        row[index['End_Position']] = str(start)
+        row[index['Strand']] = '+'
+        row[index['Variant_Classification']] = rng.choice(['Missense_Mutation', 'Silent', 'Nonsense_Mutation',
+                                                           "3'UTR", 'Intron', 'Frame_Shift_Del'])
+        row[index['Variant_Type']] = 'SNP'
+        row[index['Reference_Allele']] = ref
+        row[index['Tumor_Seq_Allele1']] = ref
+        row[index['Tumor_Seq_Allele2']] = alt
+        row[index['t_depth']] = str(rng.randint(20, 400))
+        row[index['t_alt_count']] = str(rng.randint(3, 100))
+        row[index['n_depth']] = str(rng.randint(20, 400))
+        row[index['IMPACT']] = rng.choice(['LOW', 'MODERATE', 'HIGH', 'MODIFIER'])
+        row[index['tumor_bam_uuid']] = tumor_bam
+        row[index['normal_bam_uuid']] = normal_bam
+        row[index['case_id']] = case_id
+        row[index['GDC_FILTER']] = rng.choice(['', 'ndp', 'NonExonic', 'gdc_pon'])
+        if callers_in_file is None:
+            picked = rng.sample(MAF_CALLERS, rng.randint(1, len(MAF_CALLERS)))
+            row[index['callers']] = ';'.join(caller + ('*' if rng.random() < 0.1 else '') for caller in picked)
+        elif 'callers' in index:
+            row[index['callers']] = callers_in_file
+        lines.append('\t'.join(row) + '\n')
+    return lines
+
+
+METHYLATION_HEADER = ['Composite Element REF', 'Beta_value', 'Chromosome', 'Start', 'End', 'Gene_Symbol',
+                      'Gene_Type', 'Transcript_ID', 'Position_to_TSS', 'CGI_Coordinate', 'Feature_Type']
+
+
+def probe_ids(num_probes, seed=0):
+    rng = rng_for(seed, 'probes', 0)
+    probes = []
+    for i in range(num_probes):
+        chrom = 'chr{}'.format(rng.randint(1, 22))
+        start = rng.randint(10 ** 4, 2 * 10 ** 8)
+        probes.append(('cg{:08d}'.format(i), chrom, start, 'GENE{}'.format(rng.randint(0, 20000))))
+    return probes
+
+
+def methylation_lines(rng, probes):
+    lines = ['\t'.join(METHYLATION_HEADER) + '\n']
+    for probe, chrom, start, gene in probes:
+        beta = 'NA' if rng.random() < 0.02 else '{:.6f}'.format(rng.betavariate(0.6, 0.6))
+        lines.append('\t'.join([probe, beta, chrom, str(start), str(start + 1), gene, 'protein_coding',
+                                'ENST{:011d}.1'.format(start % 10 ** 8), str(rng.randint(-1500, 1500)),
+                                '{}:{}-{}'.format(chrom, start - 200, start + 200),
+                                rng.choice(['Island', 'N_Shore', 'S_Shelf', '.'])]) + '\n')
+    return lines
+
+
+def vcf_lines(rng, num_records, tumor_barcode='TUMOR', normal_barcode='NORMAL'):
+    lines = ['##fileformat=VCFv4.1\n',
+             '##reference=file:///GRCh38.d1.vd1.fa\n',
+             '##contig=<ID=chr1,length=248956422>\n',
+             '##INFO=<ID=DP,Number=1,Type=Integer,Description="Total Depth">\n',
+             '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n',
+             '##FORMAT=<ID=AD,Number=.,Type=Integer,Description="Allelic depths">\n',
+             '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth">\n',
+             '##FORMAT=<ID=AF,Number=A,Type=Float,Description="Allele fraction">\n',
+             '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{}\t{}\n'.format(normal_barcode, tumor_barcode)]
+    positions = sorted((rng.randint(1, 22), rng.randint(1, 10 ** 8)) for _ in range(num_records))
+    for chrom, pos in positions:
+        ref, alt = rng.sample('ACGT', 2)
+        normal_depth = rng.randint(10, 200)
+        tumor_ref = rng.randint(5, 150)
+        tumor_alt = rng.randint(3, 80)
+        lines.append('chr{}\t{}\t.\t{}\t{}\t.\t{}\tDP={}\tGT:AD:DP:AF\t0/0:{},0:{}:0.0\t0/1:{},{}:{}:{:.3f}\n'.format(
+            chrom, pos, ref, alt, rng.choice(['PASS', 'PASS', 'PASS', 'panel_of_normals', 't_lod']),
+            normal_depth + tumor_ref + tumor_alt, normal_depth, normal_depth, tumor_ref, tumor_alt,
+            tumor_ref + tumor_alt, float(tumor_alt) / (tumor_ref + tumor_alt)))
+    return lines
+
+
+def quant_matrix(num_aliquots, num_genes, seed=0):
+    """
+    PDC quantDataMatrix rows: a header of 'run:aliquot' ids, then a row of log2 ratios per gene
+    """
+    rng = rng_for(seed, 'quant', 0)
+    rows = [['Gene/Aliquot'] + ['{}:{}'.format(rng_uuid(rng), 'aliquot{:05d}'.format(a)) for a in range(num_aliquots)]]
+    for g in range(num_genes):
+        rows.append(['GENE{:05d}'.format(g)] + ['{:.4f}'.format(rng.gauss(0, 1)) if rng.random() < 0.95 else None
+                                               for _ in range(num_aliquots)])
+    return rows
+
+
+def _scaled(count, scale):
+    return max(1, int(round(count * scale)))
+
+
+def write_files(kind, out_dir, scale=1.0, rows_scale=1.0, seed=0, compression='gz', program='CPTAC'):
+    """
+    Write the files of one kind (star, htseq, maf, methylation, vcf) under out_dir as
+    <file uuid>/<file name>[.gz|.zip]. Returns the list of file names written, in index order.
+    """
+    sizes = SIZES[kind]
+    num_files = _scaled(sizes['files'], scale)
+    if kind in ('star', 'htseq'):
+        genes = gene_ids(_scaled(sizes['genes'], rows_scale), seed)
+    elif kind == 'methylation':
+        probes = probe_ids(_scaled(sizes['probes'], rows_scale), seed)
+    elif kind == 'maf':
+        columns = maf_columns()
+
+    files = []
+    for i in range(num_files):
+        rng = rng_for(seed, kind, i)
+        file_id = rng_uuid(rng)
+        if kind == 'star':
+            name, lines = '{}.rna_seq.augmented_star_gene_counts.tsv'.format(rng_uuid(rng)), star_counts_lines(rng, genes)
+        elif kind == 'htseq':
+            name, lines = '{}.htseq.counts'.format(rng_uuid(rng)), htseq_lines(rng, genes)
+        elif kind == 'maf':
+            num_rows = _scaled(sizes['rows'], rows_scale)
+            if program == 'TCGA':
+                caller = MAF_CALLERS[i % len(MAF_CALLERS)]
+                name = 'TCGA.SYN{}.{}.{}.DR-10.0.somatic.maf'.format(i // len(MAF_CALLERS), caller, file_id)
+                lines = maf_lines(rng, num_rows, columns[:-1], rng_uuid(rng), caller)
+            else:
+                name = '{}.wxs.aliquot_ensemble_masked.maf'.format(rng_uuid(rng))
+                lines = maf_lines(rng, num_rows, columns, rng_uuid(rng))
+        elif kind == 'methylation':
+            barcode = 'TCGA-{:02d}-{:04d}-01A-11D-A37D-05'.format(i % 100, i)
+            name = 'jhu-usc.edu_SYN.HumanMethylation450.{}.lvl-3.{}.gdc_hg38.txt'.format(i % 20 + 1, barcode)
+            lines = methylation_lines(rng, probes)
+        elif kind == 'vcf':
+            name = '{}.wxs.MuTect2.somatic_annotation.vcf'.format(rng_uuid(rng))
+            lines = vcf_lines(rng, _scaled(sizes['records'], rows_scale))
+        else:
+            raise ValueError("Unknown file kind {}".format(kind))
+        use_compression = compression
+        if compression == 'mixed':
+            use_compression = [None, 'gz', 'zip'][i % 3]
+        files.append(write_lines(os.path.join(out_dir, file_id, name), lines, use_compression))
+    return files
+
+
+def file_records(files, data_type=None):
+    """
+    GDC /files style records for written files, for serving from FakeGDC
+    """
+    records = []
+    for file_name in files:
+        md5 = hashlib.md5()
+        with open(file_name, 'rb') as readfile:
+            for chunk in iter(lambda: readfile.read(1 << 20), b''):
+                md5.update(chunk)
+        records.append({'id': os.path.basename(os.path.dirname(file_name)),
+                        'file_id': os.path.basename(os.path.dirname(file_name)),
+                        'file_name': os.path.basename(file_name),
+                        'md5sum': md5.hexdigest(),
+                        'file_size': os.path.getsize(file_name),
+                        'data_type': data_type,
+                        'state': 'released'})
+    return records
+
+
+def main(args):
+    field_config = None
+    if args.clinical_config:
+        with open(args.clinical_config, 'r') as yaml_file:
+            field_config = yaml.load(yaml_file, Loader=yaml.FullLoader)['api_params']['FIELD_CONFIG']
+
+    written = {}
+    for kind in args.kinds.split(','):
+        kind_dir = os.path.join(args.out_dir, kind)
+        if kind == 'clinical':
+            os.makedirs(kind_dir, exist_ok=True)
+            cases_file = os.path.join(kind_dir, 'cases.jsonl')
+            write_cases_jsonl(cases_file, _scaled(SIZES['clinical']['cases'], args.scale), args.seed, field_config)
+            written[kind] = [cases_file]
+        elif kind == 'quant':
+            os.makedirs(kind_dir, exist_ok=True)
+            quant_file = os.path.join(kind_dir, 'quant_matrix.json')
+            with open(quant_file, 'w') as out:
+                json.dump(quant_matrix(_scaled(SIZES['quant']['aliquots'], args.scale),
+                                       _scaled(SIZES['quant']['genes'], args.rows_scale), args.seed), out)
+            written[kind] = [quant_file]
+        else:
+            written[kind] = write_files(kind, kind_dir, args.scale, args.rows_scale, args.seed,
+                                        args.compression, args.program)
+        print("{}: {} files".format(kind, len(written[kind])))
+
+    with open(os.path.join(args.out_dir, 'fixtures.json'), 'w') as out:
+        json.dump({'seed': args.seed, 'scale': args.scale, 'rows_scale': args.rows_scale, 'files': written}, out,
+                  indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write seeded synthetic GDC-shaped fixtures for the benchmarks")
+    parser.add_argument("out_dir", type=str, help="directory to write fixtures under")
+    parser.add_argument("-k", "--kinds", type=str, default='clinical,star,htseq,maf,methylation,vcf,quant',
+                        help="comma separated fixture kinds")
+    parser.add_argument("-s", "--scale", type=float, default=1.0, help="multiplier on case and file counts")
+    parser.add_argument("-w", "--rows_scale", type=float, default=1.0, help="multiplier on rows per file")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("-c", "--compression", type=str, default='gz', choices=['none', 'gz', 'zip', 'mixed'],
+                        help="how files are compressed")
+    parser.add_argument("-p", "--program", type=str, default='CPTAC', help="TCGA gives per-caller MAFs")
+    parser.add_argument("--clinical_config", type=str, help="clinical yaml config to take FIELD_CONFIG from")
+    args = parser.parse_args()
+    args.compression = None if args.compression == 'none' else args.compression
+    sys.exit(main(args))
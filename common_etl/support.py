@@ -18,19 +18,943 @@ limitations under the License.
 
 from google.cloud import bigquery
 from google.cloud import storage
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.csv
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 from google.cloud import exceptions
 from google.cloud.exceptions import NotFound
+import google.auth
+import google_crc32c
+import base64
+import ast
+import atexit
+import collections
+import concurrent.futures
+import functools
+import heapq
+import inspect
+import itertools
+import multiprocessing.util
+import tempfile
 import shutil
+import textwrap
 import os
 import requests
+import requests.adapters
+import resource
+import sys
 import copy
 import urllib.parse as up
 import time
 import zipfile
 import gzip
+import hashlib
 import threading
+import queue
 from json import loads as json_loads, dumps as json_dumps
 
+#
+# Process-wide client registry. Building a client resolves credentials and sets up a new HTTP
+# session, so the helpers below share one lazily built client per (service, project) instead of
+# making a new one on every call. The google-cloud clients are safe to share across threads; the
+# connection pool is sized so a thread pool does not queue up on a handful of connections.
+#
+
+_CLIENT_LOCK = threading.Lock()
+_CLIENTS = {}
+_CLIENT_POOL_SIZE = 32
+_SHARED_CREDENTIALS = None
+_THREAD_CLIENTS = threading.local()
+
+
+def set_client_pool_size(pool_size):
+    """
+    Connection pool size for clients built after this call
+    """
+    global _CLIENT_POOL_SIZE
+    _CLIENT_POOL_SIZE = pool_size
+
+
+def _pooled(client):
+    adapter = requests.adapters.HTTPAdapter(pool_connections=_CLIENT_POOL_SIZE, pool_maxsize=_CLIENT_POOL_SIZE)
+    client._http.mount("https://", adapter)
+    return client
+
+
+def _shared_client(service, project, builder):
+    key = (service, project)
+    client = _CLIENTS.get(key)
+    if client is None:
+        with _CLIENT_LOCK:
+            client = _CLIENTS.get(key)
+            if client is None:
+                client = _pooled(builder() if project is None else builder(project=project))
+                _CLIENTS[key] = client
+    return client
+
+
+def bq_client(project=None):
+    """
+    Shared BigQuery client for the project (the default project if None)
+    """
+    return _shared_client('bigquery', project, bigquery.Client)
+
+
+def gcs_client(project=None):
+    """
+    Shared Storage client for the project (the default project if None)
+    """
+    return _shared_client('storage', project, storage.Client)
+
+
+def thread_gcs_client():
+    """
+    Storage client with its own HTTP session for the calling thread. The credentials are resolved
+    once for the process and shared, so a new thread only pays for its session.
+    """
+    global _SHARED_CREDENTIALS
+    client = getattr(_THREAD_CLIENTS, 'storage', None)
+    if client is None:
+        with _CLIENT_LOCK:
+            if _SHARED_CREDENTIALS is None:
+                _SHARED_CREDENTIALS = google.auth.default()
+        credentials, project = _SHARED_CREDENTIALS
+        client = storage.Client(project=project, credentials=credentials)
+        _THREAD_CLIENTS.storage = client
+    return client
+
+
+#
+# Run instrumentation. A timed step records wall time, CPU time (ours and that of finished child
+# processes), the growth in peak RSS, and how much each event counter (BQ jobs, API calls, rows,
+# bytes, ...) moved while it was open. Steps nest, and each finished step is appended as one JSON
+# line to the run log, if there is one, and kept for the summary table printed at exit. A worker
+# thread that has not opened a step of its own works for whatever step the main thread has open.
+#
+
+_RUN_LOCK = threading.Lock()
+_RUN_COUNTS = collections.Counter()
+_RUN_STATE = {'log_file': None, 'run_id': None, 'records': [], 'summary': False, 'started': None,
+              'program': None, 'bq_dry_run': False, 'main_steps': None}
+_STEP_STACK = threading.local()
+
+
+def _current_steps():
+    """
+    The steps open on this thread, outermost first, or those of the main thread if there are none
+    """
+    stack = getattr(_STEP_STACK, 'steps', None)
+    if not stack:
+        stack = _RUN_STATE['main_steps']
+    return list(stack) if stack else []
+
+
+def count_event(name, amount=1):
+    """
+    Bump a run counter, e.g. count_event('bq_jobs') or count_event('rows', len(chunk))
+    """
+    with _RUN_LOCK:
+        _RUN_COUNTS[name] += amount
+
+
+def _max_rss_mb():
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024.0
+
+
+def _child_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class StepTimer(object):
+    """
+    Context manager for one step or sub-phase of a run. Use timed_step() to get one, or to
+    decorate a function so every call is timed.
+    """
+
+    def __init__(self, name, **tags):
+        self.name = name
+        self.tags = tags
+        self.counts = collections.Counter()
+        self.record = None
+        self.ok = True
+
+    def add(self, **counts):
+        """
+        Counts that belong to this step only (e.g. rows=n), on top of the run counters
+        """
+        self.counts.update(counts)
+
+    def __enter__(self):
+        open_steps = _current_steps()
+        self._parent = open_steps[-1].name if open_steps else None
+        stack = getattr(_STEP_STACK, 'steps', None)
+        if stack is None:
+            stack = _STEP_STACK.steps = []
+            if threading.current_thread() is threading.main_thread():
+                _RUN_STATE['main_steps'] = stack
+        stack.append(self)
+        with _RUN_LOCK:
+            self._start_counts = collections.Counter(_RUN_COUNTS)
+        self._start_time = time.time()
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+        self._start_child_cpu = _child_cpu_seconds()
+        self._start_rss = _max_rss_mb()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _STEP_STACK.steps.remove(self)
+        with _RUN_LOCK:
+            counts = collections.Counter(_RUN_COUNTS)
+        counts.subtract(self._start_counts)
+        counts.update(self.counts)
+        max_rss = _max_rss_mb()
+        self.record = {
+            'event': 'step',
+            'run_id': _RUN_STATE['run_id'],
+            'step': self.name,
+            'parent': self._parent,
+            'start': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self._start_time)),
+            'wall_s': round(time.perf_counter() - self._start_wall, 3),
+            'cpu_s': round(time.process_time() - self._start_cpu, 3),
+            'child_cpu_s': round(_child_cpu_seconds() - self._start_child_cpu, 3),
+            'max_rss_mb': round(max_rss, 1),
+            'rss_growth_mb': round(max_rss - self._start_rss, 1),
+            'counts': {key: val for key, val in counts.items() if val},
+            'ok': exc_type is None and self.ok
+        }
+        self.record.update(self.tags)
+        _log_run_record(self.record)
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with StepTimer(self.name, **self.tags):
+                return func(*args, **kwargs)
+        return wrapped
+
+
+def timed_step(name, **tags):
+    """
+    with timed_step('concat_all_files') as step: ... step.add(rows=n)
+    or as a decorator: @timed_step('build_quant_tsv')
+    """
+    return StepTimer(name, **tags)
+
+
+def _log_run_record(record):
+    with _RUN_LOCK:
+        _RUN_STATE['records'].append(record)
+        if _RUN_STATE['log_file'] is not None:
+            with open(_RUN_STATE['log_file'], 'a') as log_file:
+                log_file.write(json_dumps(record))
+                log_file.write('\n')
+
+
+def start_run_log(log_file=None, summary=True, run_name=None, program=None):
+    """
+    Start recording steps for this run. log_file (optional) gets one JSON line per finished step;
+    summary prints a per-step table when the process exits. BQ jobs are credited to program unless
+    an open step is tagged with another (timed_step(name, program=...)).
+    """
+    _RUN_STATE['log_file'] = log_file
+    _RUN_STATE['program'] = program
+    _RUN_STATE['run_id'] = "{}-{}-{}".format(run_name if run_name else os.path.basename(sys.argv[0]),
+                                            time.strftime('%Y%m%d%H%M%S'), os.getpid())
+    _RUN_STATE['started'] = time.perf_counter()
+    if summary and not _RUN_STATE['summary']:
+        _RUN_STATE['summary'] = True
+        atexit.register(print_run_summary)
+    return _RUN_STATE['run_id']
+
+
+def print_run_summary():
+    """
+    Per-step totals for the run so far, slowest first, then the BQ job totals
+    """
+    with _RUN_LOCK:
+        records = [record for record in _RUN_STATE['records'] if record['event'] == 'step']
+        bq_records = [record for record in _RUN_STATE['records'] if record['event'] != 'step']
+    if records:
+        _print_step_table(records)
+    if bq_records:
+        print_bq_summary(bq_records)
+
+
+def _print_step_table(records):
+    totals = collections.OrderedDict()
+    for record in records:
+        total = totals.setdefault((record['parent'], record['step']), {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                                                        'max_rss_mb': 0.0,
+                                                                        'counts': collections.Counter()})
+        total['calls'] += 1
+        total['wall_s'] += record['wall_s']
+        total['cpu_s'] += record['cpu_s'] + record['child_cpu_s']
+        total['max_rss_mb'] = max(total['max_rss_mb'], record['max_rss_mb'])
+        total['counts'].update(record['counts'])
+    run_wall = time.perf_counter() - _RUN_STATE['started'] if _RUN_STATE['started'] is not None else None
+
+    print("{:40s} {:>6s} {:>10s} {:>10s} {:>6s} {:>9s}  {}".format('step', 'calls', 'wall', 'cpu', '%run',
+                                                                    'rss_mb', 'counts'))
+    #
+    # Slowest steps first, each followed by its own sub-phases:
+    #
+
+    ordered = []
+
+    def add_children(parent, depth):
+        children = [(key, total) for key, total in totals.items() if key[0] == parent]
+        for key, total in sorted(children, key=lambda item: -item[1]['wall_s']):
+            ordered.append((depth, key, total))
+            if key[1] != parent:
+                add_children(key[1], depth + 1)
+
+    add_children(None, 0)
+    for depth, (parent, step), total in ordered:
+        name = "{}{}".format('  ' * depth, step)
+        share = "{:6.1f}".format(100.0 * total['wall_s'] / run_wall) if run_wall else '     -'
+        counts = ' '.join("{}={}".format(key, val) for key, val in sorted(total['counts'].items()))
+        print("{:40s} {:6d} {:>10s} {:>10s} {} {:9.1f}  {}".format(name[:40], total['calls'],
+                                                                   _clock_format(total['wall_s']),
+                                                                   _clock_format(total['cpu_s']), share,
+                                                                   total['max_rss_mb'], counts))
+
+
+def _clock_format(seconds):
+    """
+    h:mm:ss.s, for the summary columns
+    """
+    minutes, secs = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return "{}:{:02d}:{:04.1f}".format(hours, minutes, secs)
+
+
+class InstrumentedSteps(list):
+    """
+    The steps list from the yaml config, with each step timed. The builders run a step inside an
+    "if 'step' in steps:" block of their main(), so a test from there that succeeds starts timing
+    the step. A line hook on main() closes the step as soon as a line outside of its block runs.
+    Tests inside the block nest under it, and a step tested again (e.g. inside a loop) gets a
+    record for each pass. A step that main() leaves by an exception, or by a return from inside
+    its block (the builders' usual way out of a failed step), is logged with ok false, as is one
+    still open at an exit on an uncaught exception. Tests from any other function are plain
+    membership tests. Without the hook (a debugger or coverage already traces the process), steps
+    are closed by the next test from main() instead.
+    """
+
+    def __init__(self, steps, owner=None):
+        super(InstrumentedSteps, self).__init__(steps if steps is not None else [])
+        self._owner = owner.f_code if owner is not None else None
+        self._blocks, self._return_lines = _step_lines(self._owner) if owner is not None else ({}, set())
+        self._open = []
+        self._exc_info = None
+        self._frame = None
+        if owner is not None and sys.gettrace() is None:
+            self._frame = owner
+            owner.f_trace = self._trace
+            sys.settrace(_trace_nothing)
+
+    def __contains__(self, step):
+        found = list.__contains__(self, step)
+        caller = sys._getframe(1)
+        if caller.f_code is not self._owner:
+            return found
+        self._leave_blocks(caller.f_lineno)
+        if found:
+            # A test that does not guard a block (e.g. flag = 'step' in steps) times nothing:
+            line = caller.f_lineno
+            self._open.append((StepTimer(step).__enter__(), self._blocks.get(line, (line + 1, line))))
+            self._switch_profile()
+        return found
+
+    def _trace(self, frame, event, arg):
+        if event == 'line':
+            self._exc_info = None
+            self._leave_blocks(frame.f_lineno)
+        elif event == 'exception':
+            self._exc_info = arg
+        elif event == 'return':
+            self._main_returned(frame.f_lineno)
+        return self._trace
+
+    def _leave_blocks(self, line):
+        while self._open and not self._open[-1][1][0] <= line <= self._open[-1][1][1]:
+            self._close_innermost()
+
+    def _main_returned(self, line):
+        exc_info = self._exc_info
+        if exc_info is not None and issubclass(exc_info[0], SystemExit) and exc_info[1].code in (None, 0):
+            exc_info = None
+        early_return = exc_info is None and line in self._return_lines
+        while self._open:
+            if early_return:
+                self._open[-1][0].ok = False
+            self._close_innermost(exc_info)
+        self._stop_tracing()
+
+    def _close_innermost(self, exc_info=None):
+        step, _ = self._open.pop()
+        step.__exit__(*(exc_info if exc_info is not None else (None, None, None)))
+        self._switch_profile()
+
+    def _switch_profile(self):
+        if _PROFILER['sampler'] is not None:
+            _PROFILER['sampler'].switch(self._open[-1][0].name if self._open else None)
+
+    def _stop_tracing(self):
+        if self._frame is not None:
+            self._frame.f_trace = None
+            self._frame = None
+            if sys.gettrace() is _trace_nothing:
+                sys.settrace(None)
+
+    def finish(self):
+        """
+        Close whatever is still open; at exit after an uncaught exception, as failed
+        """
+        last_exc = getattr(sys, 'last_value', None)
+        exc_info = (type(last_exc), last_exc, last_exc.__traceback__) if last_exc is not None else None
+        while self._open:
+            self._close_innermost(exc_info)
+        self._stop_tracing()
+
+
+def _trace_nothing(frame, event, arg):
+    """
+    Global trace function while InstrumentedSteps hooks main(): line events are only delivered to
+    a frame's own f_trace while some trace function is set, and no other frame is traced
+    """
+    return None
+
+
+def _step_lines(code):
+    """
+    For the function running the steps: a map from each line of an if or while test to the first
+    and last lines of the block it guards, and the lines of its return statements. Empty if the
+    source can't be found.
+    """
+    try:
+        lines, first = inspect.getsourcelines(code)
+        tree = ast.parse(textwrap.dedent(''.join(lines)))
+    except (OSError, TypeError, SyntaxError):
+        return {}, set()
+    offset = first - 1 if first else 0
+    blocks = {}
+    return_lines = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.If, ast.While)):
+            block = (node.body[0].lineno + offset, node.body[-1].end_lineno + offset)
+            for line in range(node.test.lineno, node.test.end_lineno + 1):
+                blocks[line + offset] = block
+        elif isinstance(node, ast.Return):
+            return_lines.add(node.lineno + offset)
+    return blocks, return_lines
+
+
+def instrument_steps(steps, log_file=None, summary=True, program=None, profile_dir=None, profile_interval=0.01):
+    """
+    Wrap a builder's steps list so every step it runs is timed and logged. With a profile_dir, the
+    process is also sampled (see start_profiler) and each step gets its own profile.
+    """
+    start_run_log(log_file, summary, program=program)
+    if profile_dir is not None:
+        start_profiler(profile_dir, profile_interval)
+    instrumented = InstrumentedSteps(steps, sys._getframe(1))
+    # Registered after the summary, so it runs first and the last step makes it into the table:
+    atexit.register(instrumented.finish)
+    return instrumented
+
+
+#
+# BQ job accounting. Every harness hands its finished job to record_bq_job, which logs the job
+# statistics (bytes processed and billed, slot time, cache hit, queue and run time, destination)
+# and adds bytes and slot time to the run counters, so they roll up into the enclosing steps.
+# With dry runs on, the query harnesses only validate their SQL and log BQ's byte estimate.
+#
+
+def _open_step():
+    open_steps = _current_steps()
+    return open_steps[-1] if open_steps else None
+
+
+def _open_program():
+    for step in reversed(_current_steps()):
+        if 'program' in step.tags:
+            return step.tags['program']
+    return _RUN_STATE['program']
+
+
+def _job_destination(job):
+    dest = getattr(job, 'destination', None)
+    if dest is not None and hasattr(dest, 'table_id'):
+        return '{}.{}.{}'.format(dest.project, dest.dataset_id, dest.table_id)
+    uris = getattr(job, 'destination_uris', None)
+    return ','.join(uris) if uris else None
+
+
+def _seconds_between(start, end):
+    return round((end - start).total_seconds(), 3) if start is not None and end is not None else None
+
+
+def record_bq_job(job, label=None):
+    """
+    Log the statistics of a finished BQ job (query, load, extract or copy) and add its bytes and
+    slot time to the run counters
+    """
+    step = _open_step()
+    processed = getattr(job, 'total_bytes_processed', None)
+    billed = getattr(job, 'total_bytes_billed', None)
+    slot_ms = getattr(job, 'slot_millis', None)
+    record = {
+        'event': 'bq_job',
+        'run_id': _RUN_STATE['run_id'],
+        'step': step.name if step is not None else None,
+        'program': _open_program(),
+        'label': label,
+        'job_id': job.job_id,
+        'job_type': getattr(job, 'job_type', None),
+        'statement_type': getattr(job, 'statement_type', None),
+        'destination': _job_destination(job),
+        'bytes_processed': processed,
+        'bytes_billed': billed,
+        'slot_ms': slot_ms,
+        'cache_hit': getattr(job, 'cache_hit', None),
+        'output_rows': getattr(job, 'output_rows', None),
+        'queue_s': _seconds_between(job.created, job.started),
+        'run_s': _seconds_between(job.started, job.ended),
+        'ok': job.error_result is None
+    }
+    count_event('bq_bytes_processed', processed if processed else 0)
+    count_event('bq_bytes_billed', billed if billed else 0)
+    count_event('bq_slot_ms', slot_ms if slot_ms else 0)
+    _log_run_record(record)
+    return record
+
+
+def set_bq_dry_run(dry_run=True):
+    """
+    With dry runs on, the query harnesses estimate their SQL instead of running it (see
+    bq_preflight_steps)
+    """
+    _RUN_STATE['bq_dry_run'] = dry_run
+
+
+def bq_dry_run_enabled():
+    return _RUN_STATE['bq_dry_run']
+
+
+def preflight_query(sql, label=None, client=None):
+    """
+    Log the dry run estimate (query_bytes_estimate) for a query. Returns the byte count, or None
+    if the query does not validate, e.g. because it reads a table an earlier step has not built.
+    """
+    step = _open_step()
+    record = {
+        'event': 'bq_estimate',
+        'run_id': _RUN_STATE['run_id'],
+        'step': step.name if step is not None else None,
+        'program': _open_program(),
+        'label': label,
+        'bytes_processed': None,
+        'error': None
+    }
+    try:
+        record['bytes_processed'] = query_bytes_estimate(sql, client)
+        count_event('bq_bytes_estimated', record['bytes_processed'])
+    except exceptions.GoogleCloudError as ex:
+        record['error'] = str(ex)
+    print('Dry run {}: {}'.format(label if label else 'query',
+                                  _gb_format(record['bytes_processed']) if record['error'] is None else record['error']))
+    _log_run_record(record)
+    return record['bytes_processed']
+
+
+def bq_preflight_steps(steps, sql_steps):
+    """
+    Turn dry runs on and keep only the steps that are in sql_steps, i.e. the ones that do nothing
+    but run SQL through the harnesses. The builder then estimates what each of its queries would
+    process without building tables or touching files. A query that reads a table built by an
+    earlier query can only be estimated once that table exists.
+    """
+    set_bq_dry_run(True)
+    kept = [step for step in steps if step in sql_steps]
+    skipped = [step for step in steps if step not in sql_steps]
+    if skipped:
+        print('BQ preflight skips non-SQL steps: {}'.format(', '.join(skipped)))
+    return kept
+
+
+#
+# Sampling profiler. A daemon thread looks at the stack of every other thread each interval and
+# counts the distinct stacks, under the name of the step that is running. It takes no tracing
+# hooks, so the run itself is not slowed down beyond the sampling, and it can stay on for full
+# production runs. Each step is written out as collapsed stacks (for flamegraph.pl, speedscope
+# or inferno) and as speedscope JSON. Pool workers sample themselves if the pool is created
+# with **profiler_pool_kwargs().
+#
+
+_PROFILER = {'sampler': None, 'profile_dir': None, 'interval': None}
+
+
+class StackSampler(object):
+    """
+    Samples the stacks of the other threads in this process every interval seconds
+    """
+
+    def __init__(self, profile_dir, interval, file_prefix, label=None):
+        self.profile_dir = profile_dir
+        self.interval = interval
+        self.file_prefix = file_prefix
+        self.label = label
+        self.stacks = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        my_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            frames = sys._current_frames()
+            with self._lock:
+                counts = self.stacks.setdefault(self.label, collections.Counter())
+                for ident, frame in frames.items():
+                    if ident == my_ident:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                        frame = frame.f_back
+                    stack.append((names.get(ident, 'thread-{}'.format(ident)), '', 0))
+                    counts[tuple(reversed(stack))] += 1
+
+    def switch(self, label):
+        """
+        Samples from now on belong to label. The profile of the label being left is written out.
+        """
+        with self._lock:
+            done, self.label = self.label, label
+        if done is not None:
+            self.write(done)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        for label in list(self.stacks):
+            self.write(label)
+
+    def write(self, label):
+        """
+        Write <prefix>.<label>.collapsed and <prefix>.<label>.speedscope.json with all the samples
+        taken for label so far
+        """
+        with self._lock:
+            counts = collections.Counter(self.stacks.get(label, {}))
+        if not counts:
+            return
+        base = os.path.join(self.profile_dir, "{}.{}".format(self.file_prefix, label if label else 'no_step'))
+        with open("{}.collapsed".format(base), 'w') as collapsed_file:
+            for stack, count in counts.most_common():
+                collapsed_file.write(';'.join(_frame_name(frame) for frame in stack))
+                collapsed_file.write(" {}\n".format(count))
+
+        frame_index = {}
+        samples = []
+        weights = []
+        for stack, count in counts.most_common():
+            samples.append([frame_index.setdefault(frame, len(frame_index)) for frame in stack])
+            weights.append(round(count * self.interval, 6))
+        frames = [{'name': name, 'file': file_name, 'line': line} if file_name else {'name': name}
+                  for name, file_name, line in frame_index]
+        speedscope = {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': "{} {}".format(self.file_prefix, label),
+            'exporter': 'common_etl.support',
+            'shared': {'frames': frames},
+            'profiles': [{'type': 'sampled', 'name': str(label), 'unit': 'seconds', 'startValue': 0,
+                          'endValue': round(sum(weights), 6), 'samples': samples, 'weights': weights}]
+        }
+        with open("{}.speedscope.json".format(base), 'w') as speedscope_file:
+            speedscope_file.write(json_dumps(speedscope))
+
+
+def _frame_name(frame):
+    name, file_name, line = frame
+    return "{} ({}:{})".format(name, os.path.basename(file_name), line) if file_name else name
+
+
+def start_profiler(profile_dir, interval=0.01):
+    """
+    Start sampling this process. Profiles land in profile_dir as <run id>.<step>.collapsed and
+    <run id>.<step>.speedscope.json, and are written as each step ends and at exit.
+    """
+    if _PROFILER['sampler'] is not None:
+        return _PROFILER['sampler']
+    file_prefix = _RUN_STATE['run_id'] if _RUN_STATE['run_id'] else "{}-{}".format(
+        os.path.basename(sys.argv[0]), os.getpid())
+    _PROFILER['profile_dir'] = profile_dir
+    _PROFILER['interval'] = interval
+    _PROFILER['sampler'] = StackSampler(profile_dir, interval, file_prefix).start()
+    atexit.register(_PROFILER['sampler'].stop)
+    print('Profiling every {}s into {}'.format(interval, profile_dir))
+    return _PROFILER['sampler']
+
+
+def _start_worker_profiler(profile_dir, interval, file_prefix, label):
+    sampler = StackSampler(profile_dir, interval, "{}.worker-{}".format(file_prefix, os.getpid()), label).start()
+    _PROFILER['sampler'] = sampler
+    # Pool workers leave through multiprocessing's exit handlers, not atexit:
+    multiprocessing.util.Finalize(None, sampler.stop, exitpriority=10)
+
+
+def profiler_pool_kwargs():
+    """
+    Extra ProcessPoolExecutor arguments that have each worker profile itself when the profiler is
+    on, e.g. ProcessPoolExecutor(max_workers=n, **profiler_pool_kwargs()). Empty when it is off.
+    """
+    sampler = _PROFILER['sampler']
+    if sampler is None:
+        return {}
+    return {'initializer': _start_worker_profiler,
+            'initargs': (_PROFILER['profile_dir'], _PROFILER['interval'], sampler.file_prefix, sampler.label)}
+
+
+def _gb_format(num_bytes):
+    return '{:.2f} GB'.format(num_bytes / 1e9) if num_bytes is not None else '-'
+
+
+def print_bq_summary(records, top_jobs=10):
+    """
+    BQ bytes and slot time for the run, per program, plus the costliest jobs and any dry run
+    estimates
+    """
+    jobs = [record for record in records if record['event'] == 'bq_job']
+    estimates = [record for record in records if record['event'] == 'bq_estimate']
+    if jobs:
+        totals = collections.OrderedDict()
+        for job in jobs:
+            total = totals.setdefault(job['program'], collections.Counter())
+            total['jobs'] += 1
+            total['cache_hits'] += 1 if job['cache_hit'] else 0
+            total['bytes_billed'] += job['bytes_billed'] if job['bytes_billed'] else 0
+            total['bytes_processed'] += job['bytes_processed'] if job['bytes_processed'] else 0
+            total['slot_ms'] += job['slot_ms'] if job['slot_ms'] else 0
+            total['run_s'] += job['run_s'] if job['run_s'] else 0
+        print("{:24s} {:>6s} {:>6s} {:>14s} {:>14s} {:>10s} {:>10s}".format('program', 'jobs', 'cached',
+                                                                           'processed', 'billed', 'slot_h',
+                                                                           'run'))
+        for program, total in sorted(totals.items(), key=lambda item: -item[1]['bytes_billed']):
+            print("{:24s} {:6d} {:6d} {:>14s} {:>14s} {:10.2f} {:>10s}".format(
+                str(program)[:24], total['jobs'], total['cache_hits'], _gb_format(total['bytes_processed']),
+                _gb_format(total['bytes_billed']), total['slot_ms'] / 3600000.0, _clock_format(total['run_s'])))
+
+        print("{:24s} {:>14s} {:>10s} {:>10s}  {}".format('step', 'billed', 'slot_h', 'run', 'destination'))
+        costly = sorted(jobs, key=lambda job: -(job['bytes_billed'] if job['bytes_billed'] else 0))
+        for job in costly[:top_jobs]:
+            print("{:24s} {:>14s} {:10.2f} {:>10s}  {}".format(
+                str(job['step'])[:24], _gb_format(job['bytes_billed']),
+                (job['slot_ms'] if job['slot_ms'] else 0) / 3600000.0,
+                _clock_format(job['run_s'] if job['run_s'] else 0),
+                job['destination'] if job['destination'] else job['label']))
+
+    if estimates:
+        print("{:24s} {:>14s}  {}".format('step', 'estimate', 'query'))
+        for estimate in estimates:
+            print("{:24s} {:>14s}  {}".format(str(estimate['step'])[:24],
+                                              _gb_format(estimate['bytes_processed']) if estimate['error'] is None
+                                              else 'not valid yet', estimate['label']))
+        print("{:24s} {:>14s}".format('total', _gb_format(sum(estimate['bytes_processed']
+                                                              for estimate in estimates
+                                                              if estimate['bytes_processed']))))
+
+
+#
+# Step cache. A step that turns local inputs into local outputs can be skipped on a rerun when
+# nothing it depends on has changed. The cache key hashes the step name, a fingerprint of every
+# input file (the manifest md5 when the file is a GDC download, else its size and mtime), the
+# config values the step uses, and the source of the code that runs it. The outputs are copied
+# into the cache directory under that key (and optionally to the working bucket), and a later
+# run with the same key copies them back instead of running the step.
+#
+
+def manifest_checksums(manifest_file):
+    """
+    {file id: md5} from a GDC manifest (id, filename, md5, size, state). Downloads sit in a
+    directory named for the file id, which is how step_cache matches them up.
+    """
+    checksums = {}
+    with open(manifest_file, 'r') as readfile:
+        next(readfile, None)
+        for line in readfile:
+            split_line = line.rstrip('\n').split("\t")
+            if len(split_line) > 2:
+                checksums[split_line[0]] = split_line[2]
+    return checksums
+
+
+def file_fingerprint(file_name, checksums=None):
+    """
+    Manifest md5 if we have one for the file, else size and modification time
+    """
+    file_id = os.path.basename(os.path.dirname(file_name))
+    if checksums is not None and file_id in checksums:
+        return [file_id, checksums[file_id]]
+    stat = os.stat(file_name)
+    return [os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns]
+
+
+def code_fingerprint(code_files):
+    """
+    Hash of the source of the given modules, so an edit to the code invalidates what it made
+    """
+    code_hash = hashlib.sha256()
+    for code_file in sorted(set(code_files)):
+        with open(code_file, 'rb') as readfile:
+            code_hash.update(readfile.read())
+    return code_hash.hexdigest()
+
+
+class StepCache(object):
+    """
+    Cache for one step's outputs. Use it as:
+
+        cache = step_cache(params, 'concat_all_files', all_files, [one_big_tsv], config)
+        if not cache.restore():
+            concat_all_files(...)
+            cache.save()
+
+    Outputs are files. They are copied both ways rather than linked, since later steps may rewrite
+    an output in place.
+    """
+
+    def __init__(self, cache_dir, step, inputs=(), outputs=(), config=None, checksums=None, code_files=None,
+                 bucket=None, bucket_dir=None):
+        self.step = step
+        self.outputs = list(outputs)
+        self.bucket = bucket
+        self.bucket_dir = bucket_dir
+        if code_files is None:
+            # The builder that is running, plus this module:
+            main_file = getattr(sys.modules['__main__'], '__file__', None)
+            code_files = [__file__] if main_file is None or not os.path.isfile(main_file) \
+                else [os.path.abspath(main_file), __file__]
+        key_parts = {
+            'step': step,
+            'inputs': sorted(file_fingerprint(file_name, checksums) for file_name in inputs),
+            'outputs': [os.path.basename(out_file) for out_file in self.outputs],
+            'config': config,
+            'code': code_fingerprint(code_files)
+        }
+        self.key = hashlib.sha256(json_dumps(key_parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        self.entry_dir = os.path.join(cache_dir, step, self.key)
+
+    def _cache_names(self):
+        return ["{:03d}-{}".format(i, os.path.basename(out_file)) for i, out_file in enumerate(self.outputs)]
+
+    def _blob_name(self, cache_name):
+        return "{}/{}/{}/{}".format(self.bucket_dir, self.step, self.key, cache_name)
+
+    def _fetch_from_bucket(self):
+        client = gcs_client()
+        bucket = client.bucket(self.bucket)
+        entry_blob = bucket.blob(self._blob_name('entry.json'))
+        if not entry_blob.exists():
+            return False
+        tmp_dir = "{}.tmp-{}".format(self.entry_dir, os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        for cache_name in self._cache_names():
+            bucket.blob(self._blob_name(cache_name)).download_to_filename(os.path.join(tmp_dir, cache_name))
+        entry_blob.download_to_filename(os.path.join(tmp_dir, 'entry.json'))
+        os.replace(tmp_dir, self.entry_dir)
+        count_event('gcs_downloads', len(self.outputs) + 1)
+        return True
+
+    def restore(self):
+        """
+        Copy the cached outputs into place. Returns False (and does nothing) on a miss.
+        """
+        if not os.path.isfile(os.path.join(self.entry_dir, 'entry.json')):
+            if self.bucket is None or not self._fetch_from_bucket():
+                print("Step cache miss for {} ({})".format(self.step, self.key[:12]))
+                count_event('cache_misses')
+                return False
+        for cache_name, out_file in zip(self._cache_names(), self.outputs):
+            out_dir = os.path.dirname(out_file)
+            if out_dir:
+                os.makedirs(out_dir, exist_ok=True)
+            shutil.copyfile(os.path.join(self.entry_dir, cache_name), out_file)
+        print("Step cache hit for {} ({}): restored {}".format(self.step, self.key[:12], ', '.join(self.outputs)))
+        count_event('cache_hits')
+        return True
+
+    def save(self):
+        """
+        Store the step's outputs under its key. Call once the step has succeeded.
+        """
+        tmp_dir = "{}.tmp-{}".format(self.entry_dir, os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        for cache_name, out_file in zip(self._cache_names(), self.outputs):
+            shutil.copyfile(out_file, os.path.join(tmp_dir, cache_name))
+        with open(os.path.join(tmp_dir, 'entry.json'), 'w') as entry_file:
+            entry_file.write(json_dumps({'step': self.step, 'outputs': self.outputs,
+                                         'created': time.strftime('%Y-%m-%dT%H:%M:%S')}))
+        shutil.rmtree(self.entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, self.entry_dir)
+
+        if self.bucket is not None:
+            bucket = gcs_client().bucket(self.bucket)
+            # The entry goes up last, so a partial upload is never taken for a hit:
+            for cache_name in self._cache_names() + ['entry.json']:
+                bucket.blob(self._blob_name(cache_name)).upload_from_filename(os.path.join(self.entry_dir, cache_name))
+
+
+class _NoStepCache(object):
+    """
+    Stand-in when no cache is configured: always a miss, saves nothing
+    """
+
+    def restore(self):
+        return False
+
+    def save(self):
+        pass
+
+
+def step_cache(params, step, inputs=(), outputs=(), config=None, checksums=None, code_files=None):
+    """
+    StepCache for a builder step, from the optional STEP_CACHE_DIR config value (plus
+    STEP_CACHE_BUCKET and STEP_CACHE_BUCKET_DIR to share entries through a bucket). Without
+    STEP_CACHE_DIR, every lookup misses and steps run as always.
+    """
+    if 'STEP_CACHE_DIR' not in params or not params['STEP_CACHE_DIR']:
+        return _NoStepCache()
+    cache_dir = os.path.expanduser(params['STEP_CACHE_DIR'])
+    bucket = params['STEP_CACHE_BUCKET'] if 'STEP_CACHE_BUCKET' in params else None
+    bucket_dir = params['STEP_CACHE_BUCKET_DIR'] if 'STEP_CACHE_BUCKET_DIR' in params else 'step_cache'
+    return StepCache(cache_dir, step, inputs, outputs, config, checksums, code_files, bucket, bucket_dir)
+
 
 def checkToken(aToken):
     """
@@ -274,6 +1198,176 @@ def read_MAFs(tumor_type, maf_list, program_prefix, extra_cols, col_count,
     return mutCalls, hdrPick
 
 
+def _flush_maf_run(run_records, run_dir, run_files):
+    """
+    Sort one batch of MAF records and write it out as a sorted run file
+    """
+    run_records.sort()
+    run_file = os.path.join(run_dir, "run-{:05d}.txt".format(len(run_files)))
+    with open(run_file, 'w') as run_out:
+        run_out.writelines(run_records)
+    run_files.append(run_file)
+    run_records.clear()
+
+
+def read_MAFs_to_runs(tumor_type, maf_list, program_prefix, extra_cols, col_count,
+                      do_logging, key_fields, first_token, file_info_func, run_dir, max_rows_in_run=500000):
+    """
+    Bounded-memory version of read_MAFs.
+    Instead of holding every call for a tumor type in one dictionary, each call is turned into a
+    (mutation key, read order, row) record. Records are sorted in batches of max_rows_in_run and
+    spilled to run files in run_dir, so that write_MAFs_from_runs can merge them in one streaming
+    pass. Returns the list of run files and the header.
+    """
+    hdrPick = None
+    hdrTokens = None
+    run_files = []
+    run_records = []
+    record_count = 0
+    with open("MAFLOG-READ-{}.txt".format(tumor_type), 'w') as log_file:
+
+        for aFile in maf_list:
+            file_info_list = file_info_func(aFile, program_prefix)
+            if file_info_list[0] != (program_prefix + tumor_type):
+                continue
+            toss_zip = False
+            use_file_name = aFile
+            try:
+                if aFile.endswith('.gz'):
+                    use_file_name = aFile[:-3]
+                    log_file.write("Uncompressing {}\n".format(aFile))
+                    with gzip.open(aFile, "rb") as gzip_in:
+                        with open(use_file_name, "wb") as uncomp_out:
+                            shutil.copyfileobj(gzip_in, uncomp_out)
+                    toss_zip = True
+
+                log_file.write(" opening input file {}\n".format(use_file_name))
+
+                if not os.path.isfile(use_file_name):
+                    print('{} was not found'.format(use_file_name))
+                    continue
+
+                with open(use_file_name, 'r') as fh:
+                    key_indices = []
+                    for aLine in fh:
+                        if aLine.startswith("#"):
+                            continue
+                        if aLine.startswith(first_token):
+                            hdrTokens = aLine.strip().split('\t')
+                            if len(hdrTokens) != col_count:
+                                print("ERROR: incorrect number of header tokens! {} vs {}".format(col_count,
+                                                                                                  len(hdrTokens)))
+                                print(hdrTokens)
+                                raise Exception()
+                            hdrPick = hdrTokens + extra_cols
+                            key_indices = [hdrPick.index(keef) for keef in key_fields]
+                            continue
+
+                        if hdrPick is None:
+                            print("ERROR: Header row not found")
+                            raise Exception()
+
+                        tokenList = aLine.strip().split('\t')
+                        if len(tokenList) != len(hdrTokens):
+                            print("ERROR: incorrect number of tokens! {} vs {}".format(len(tokenList), len(hdrTokens)))
+                            raise Exception()
+
+                        infoList = tokenList + file_info_list
+                        if len(infoList) != len(hdrPick):
+                            print(" ERROR: inconsistent number of tokens!")
+                            raise Exception()
+
+                        #
+                        # Records sort as plain strings: the key comes first, then a zero-padded read
+                        # counter so the calls for a mutation come back in the order read_MAFs saw them:
+                        #
+
+                        mutPrint = '\x1f'.join([tokenList[x] for x in key_indices])
+                        run_records.append("{}\x1e{:012d}\x1e{}\n".format(mutPrint, record_count, '\t'.join(infoList)))
+                        record_count += 1
+                        if len(run_records) >= max_rows_in_run:
+                            _flush_maf_run(run_records, run_dir, run_files)
+
+                    if do_logging: log_file.write(" --> done with this file ... {}\n".format(record_count))
+            finally:
+                if toss_zip and os.path.isfile(use_file_name):
+                    os.remove(use_file_name)
+
+        if run_records:
+            _flush_maf_run(run_records, run_dir, run_files)
+
+        log_file.write(" DONE READING MAFs ... {} calls in {} runs\n".format(record_count, len(run_files)))
+    return run_files, hdrPick
+
+
+def _merged_maf_line(calls, mutCallers):
+    """
+    Merge the calls for one mutation into an output line, using the same rules as write_MAFs
+    """
+    outLine = ''
+    for kk in range(len(calls[0])):
+        v = [call[kk] for call in calls]
+        if len(v) == 1 or v.count(v[0]) == len(v):
+            outLine += "%s\t" % v[0]
+        else:
+            for c in mutCallers:
+                for ii in range(len(calls)):
+                    ## 3rd from the last feature is the 'caller'
+                    if calls[ii][-3] == c:
+                        outLine += "%s|" % v[ii]
+            outLine = outLine[:-1] + "\t"
+    return outLine[:-1]
+
+
+def write_MAFs_from_runs(tumor, run_files, hdrPick, mutCallers, do_logging):
+    """
+    Streaming version of write_MAFs.
+    Merges the sorted runs from read_MAFs_to_runs, so only the calls for one mutation are in memory
+    at a time. The output file matches write_MAFs, except that mutations come out ordered by
+    their key instead of in the order they were first seen.
+    """
+    run_handles = [open(run_file, 'r') for run_file in run_files]
+    try:
+        with open("MAFLOG-WRITE-{}.txt".format(tumor), 'w') as log_file:
+            outFilename = "mergeA." + tumor + ".maf"
+            histCount = [0] * 10
+            num_prints = 0
+            with open(outFilename, 'w') as fhOut:
+                fhOut.write("%s\n" % '\t'.join(hdrPick))
+                merged = heapq.merge(*run_handles)
+                for mutPrint, records in itertools.groupby(merged, key=lambda rec: rec.split('\x1e', 1)[0]):
+                    calls = [rec.rstrip('\n').split('\x1e', 2)[2].split('\t') for rec in records]
+                    histCount[len(calls)] += 1
+                    num_prints += 1
+                    if do_logging: log_file.write(" {} numCalls = {}\n".format(mutPrint.split('\x1f'), len(calls)))
+                    fhOut.write("%s\n" % _merged_maf_line(calls, mutCallers))
+            log_file.write(" --> total # of mutPrints : {}\n".format(num_prints))
+    finally:
+        for handle in run_handles:
+            handle.close()
+
+    return histCount
+
+
+def merge_MAFs_on_disk(tumor_type, maf_list, program_prefix, extra_cols, col_count, do_logging,
+                       key_fields, first_token, file_info_func, mutCallers, work_dir='.', max_rows_in_run=500000):
+    """
+    Does read_MAFs + write_MAFs for a tumor type through sorted runs on disk, so memory stays bounded
+    by max_rows_in_run no matter how many calls the tumor type has.
+    """
+    run_dir = tempfile.mkdtemp(prefix="mafruns-{}-".format(tumor_type), dir=work_dir)
+    try:
+        run_files, hdrPick = read_MAFs_to_runs(tumor_type, maf_list, program_prefix, extra_cols, col_count,
+                                               do_logging, key_fields, first_token, file_info_func,
+                                               run_dir, max_rows_in_run)
+        if hdrPick is None:
+            print("No MAFs found for {}".format(tumor_type))
+            return None
+        return write_MAFs_from_runs(tumor_type, run_files, hdrPick, mutCallers, do_logging)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
 def concat_all_merged_files(all_files, one_big_tsv):
     """
     Concatenate all Merged Files
@@ -302,17 +1396,20 @@ def concat_all_merged_files(all_files, one_big_tsv):
 
 
 def build_pull_list_with_bq(manifest_table, indexd_table, project, tmp_dataset, tmp_bq,
-                            tmp_bucket, tmp_bucket_file, local_file, do_batch):
+                            tmp_bucket, tmp_bucket_file, local_file, do_batch, use_storage_api=False):
     """
     IndexD using BQ Tables
     GDC provides us a file that allows us to not have to pound the IndexD API; we build a BQ table.
-    Use it to resolve URIs
+    Use it to resolve URIs. With use_storage_api, the query result is streamed to the local file
+    without a scratch table, extract job or bucket copy.
     """
     #
     # If we are using bq to build a manifest, we can use that table to build the pull list too!
     #
 
     sql = pull_list_builder_sql(manifest_table, indexd_table)
+    if use_storage_api and bigquery_storage is not None:
+        return query_to_local_tsv(sql, local_file, do_batch, False)
     success = generic_bq_harness(sql, tmp_dataset, tmp_bq, do_batch, True)
     if not success:
         return False
@@ -324,17 +1421,20 @@ def build_pull_list_with_bq(manifest_table, indexd_table, project, tmp_dataset,
 
 
 def build_pull_list_with_bq_public(manifest_table, indexd_table, project, tmp_dataset, tmp_bq,
-                                   tmp_bucket, tmp_bucket_file, local_file, do_batch):
+                                   tmp_bucket, tmp_bucket_file, local_file, do_batch, use_storage_api=False):
     """
     IndexD using BQ Tables
     GDC provides us a file that allows us to not have to pound the IndexD API; we build a BQ table.
-    Use it to resolve URIs
+    Use it to resolve URIs. With use_storage_api, the query result is streamed to the local file
+    without a scratch table, extract job or bucket copy.
     """
     #
     # If we are using bq to build a manifest, we can use that table to build the pull list too!
     #
 
     sql = pull_list_builder_sql_public(manifest_table, indexd_table)
+    if use_storage_api and bigquery_storage is not None:
+        return query_to_local_tsv(sql, local_file, do_batch, False)
     success = generic_bq_harness(sql, tmp_dataset, tmp_bq, do_batch, True)
     if not success:
         return False
@@ -369,16 +1469,20 @@ def pull_list_builder_sql_public(manifest_table, indexd_table):
 
 
 def get_the_bq_manifest(file_table, filter_dict, max_files, project, tmp_dataset, tmp_bq,
-                        tmp_bucket, tmp_bucket_file, local_file, do_batch):
+                        tmp_bucket, tmp_bucket_file, local_file, do_batch, use_storage_api=False):
     """
     Build a Manifest File Using ISB-CGC File Tables. This duplicates the manifest file returned by
-    GDC API, but uses the BQ file table as the data source.
+    GDC API, but uses the BQ file table as the data source. With use_storage_api, the manifest table
+    (still needed to build the pull list) is read straight to the local file, skipping the extract
+    job and the bucket copy.
     """
 
     sql = manifest_builder_sql(file_table, filter_dict, max_files)
     success = generic_bq_harness(sql, tmp_dataset, tmp_bq, do_batch, True)
     if not success:
         return False
+    if use_storage_api and bigquery_storage is not None:
+        return table_to_local_tsv('{}.{}.{}'.format(project, tmp_dataset, tmp_bq), local_file, True)
     success = bq_to_bucket_tsv(tmp_bq, project, tmp_dataset, tmp_bucket, tmp_bucket_file, do_batch, True)
     if not success:
         return False
@@ -426,7 +1530,7 @@ def bq_to_bucket_tsv(src_table, project, dataset, bucket_name, bucket_file, do_b
     Get a BQ Result to a Bucket TSV file
     Export BQ table to a cloud bucket
     """
-    client = bigquery.Client()
+    client = bq_client()
     destination_uri = "gs://{}/{}".format(bucket_name, bucket_file)
     dataset_ref = client.dataset(dataset, project=project)
     table_ref = dataset_ref.table(src_table)
@@ -439,6 +1543,7 @@ def bq_to_bucket_tsv(src_table, project, dataset, bucket_name, bucket_file, do_b
     job_config.print_header = do_header
 
     extract_job = client.extract_table(table_ref, destination_uri, location="US", job_config=job_config)
+    count_event('bq_jobs')
 
     # Query
     extract_job = client.get_job(extract_job.job_id, location=location)
@@ -453,6 +1558,7 @@ def bq_to_bucket_tsv(src_table, project, dataset, bucket_name, bucket_file, do_b
     print('Job {} is done'.format(extract_job.job_id))
 
     extract_job = client.get_job(extract_job.job_id, location=location)
+    record_bq_job(extract_job)
     if extract_job.error_result is not None:
         print('Error result!! {}'.format(extract_job.error_result))
         return False
@@ -465,20 +1571,110 @@ def bucket_to_local(bucket_name, bucket_file, local_file):
     Export a cloud bucket file to the local filesystem
     No leading / in bucket_file name!!
     """
-    storage_client = storage.Client()
+    storage_client = gcs_client()
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(bucket_file)  # no leading / in blob name!!
     blob.download_to_filename(local_file)
     return
 
 
+def _tsv_value(value):
+    """
+    Write values the way a BQ extract job does
+    """
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def _read_stream_to_file(read_client, session, stream_name, field_names, part_file):
+    reader = read_client.read_rows(stream_name)
+    num_rows = 0
+    with open(part_file, 'w') as part_fh:
+        for row in reader.rows(session):
+            part_fh.write('\t'.join([_tsv_value(row[name]) for name in field_names]))
+            part_fh.write('\n')
+            num_rows += 1
+    return num_rows
+
+
+def table_to_local_tsv(table_id, local_file, do_header, max_streams=8, billing_project=None):
+    """
+    Read a BQ table straight to a local TSV through the BigQuery Storage Read API, one thread per
+    read stream. Replaces bq_to_bucket_tsv + bucket_to_local for small and medium tables.
+    """
+    client = bq_client()
+    table = client.get_table(table_id)
+    field_names = [field.name for field in table.schema]
+    billing_project = client.project if billing_project is None else billing_project
+
+    read_client = bigquery_storage.BigQueryReadClient()
+    requested_session = bigquery_storage.types.ReadSession(
+        table="projects/{}/datasets/{}/tables/{}".format(table.project, table.dataset_id, table.table_id),
+        data_format=bigquery_storage.types.DataFormat.AVRO)
+    session = read_client.create_read_session(parent="projects/{}".format(billing_project),
+                                              read_session=requested_session, max_stream_count=max_streams)
+
+    #
+    # Each stream goes to its own part file, and the parts are glued together at the end:
+    #
+
+    part_dir = tempfile.mkdtemp(prefix="bqread-", dir=os.path.dirname(os.path.abspath(local_file)))
+    try:
+        part_files = [os.path.join(part_dir, "part{:03d}.tsv".format(i)) for i in range(len(session.streams))]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(session.streams))) as executor:
+            futures = [executor.submit(_read_stream_to_file, read_client, session, stream.name, field_names,
+                                       part_file) for stream, part_file in zip(session.streams, part_files)]
+            num_rows = sum(future.result() for future in futures)
+
+        with open(local_file, 'w') as out_fh:
+            if do_header:
+                out_fh.write('\t'.join(field_names))
+                out_fh.write('\n')
+            for part_file in part_files:
+                with open(part_file, 'r') as part_fh:
+                    shutil.copyfileobj(part_fh, out_fh)
+    finally:
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+    count_event('rows_read', num_rows)
+    print("Read {} rows from {} over {} streams".format(num_rows, table_id, len(session.streams)))
+    return True
+
+
+def query_to_local_tsv(sql, local_file, do_batch, do_header, max_streams=8):
+    """
+    Run a query and read its (anonymous) result table straight to a local TSV, with no scratch
+    table, extract job or bucket copy
+    """
+    client = bq_client()
+    job_config = bigquery.QueryJobConfig()
+    if do_batch:
+        job_config.priority = bigquery.QueryPriority.BATCH
+    if bq_dry_run_enabled():
+        preflight_query(sql, local_file, client)
+        return True
+    query_job = client.query(sql, location='US', job_config=job_config)
+    count_event('bq_jobs')
+    query_job.result()
+    record_bq_job(query_job, local_file)
+    if query_job.error_result is not None:
+        print('Error result!! {}'.format(query_job.error_result))
+        return False
+    dest = query_job.destination
+    return table_to_local_tsv('{}.{}.{}'.format(dest.project, dest.dataset_id, dest.table_id),
+                              local_file, do_header, max_streams)
+
+
 def bucket_to_bucket(source_bucket_name, bucket_file, target_bucket_name, target_bucket_file=None):
     """
     Get a Bucket File to another bucket
     No leading / in bucket_file name!!
     Target bucket is the same as source, unless provided
     """
-    storage_client = storage.Client()
+    storage_client = gcs_client()
     source_bucket = storage_client.bucket(source_bucket_name)
     source_blob = source_bucket.blob(bucket_file)  # no leading / in blob name!!
 
@@ -530,9 +1726,28 @@ def build_manifest_filter(filter_dict_list):
     return ''.join(whole_filter)
 
 
-def get_the_manifest(filter_string, api_url, manifest_file, max_files=None):
+MANIFEST_HEADER = 'id\tfilename\tmd5\tsize\tstate'
+
+
+def _manifest_total(filter_string, api_url):
     """
-    This function takes a JSON filter string and uses it to download a manifest from GDC
+    How many files match the filter, from the pagination block of a zero-size JSON query
+    """
+    request_url = '{}?filters={}&size=0&format=json'.format(api_url, up.quote(filter_string))
+    resp = requests.request("GET", request_url)
+    count_event('api_calls')
+    if resp.status_code != 200:
+        raise Exception("Problem counting manifest files. HTTP Status Code: {} URL: {}".format(resp.status_code,
+                                                                                            request_url))
+    return json_loads(resp.text)['data']['pagination']['total']
+
+
+def stream_manifest(filter_string, api_url, manifest_file, max_files=None, page_size=10000):
+    """
+    Download a GDC manifest a page at a time, streaming each page to manifest_file as it arrives,
+    and yield each record ({'id', 'filename', 'md5', 'size', 'state'}) as it is written. The
+    number of records is checked against the pagination total GDC reports for the filter, and
+    an Exception is raised if they differ.
     """
 
     #
@@ -540,28 +1755,56 @@ def get_the_manifest(filter_string, api_url, manifest_file, max_files=None):
     # back as JSON, not the manifest format.
     # 2) Putting the return type as parameter in the URL while doing a post with the filter just returns
     # every file they own (i.e. the filter in the POST doc is ignored, probably to be expected?).
-    # 3) Thus, put the filter in a GET request.
+    # 3) Thus, put the filter in a GET request. The pages are sorted on file_id so that they do not
+    # overlap.
     #
 
-    num_files = max_files if max_files is not None else 100000
-    request_url = '{}?filters={}&size={}&return_type=manifest'.format(api_url,
-                                                                      up.quote(filter_string),
-                                                                      num_files)
-
-    resp = requests.request("GET", request_url)
-
-    if resp.status_code == 200:
-        mfile = manifest_file
-        with open(mfile, mode='wb') as localfile:
-            localfile.write(resp.content)
-        print("Wrote out manifest file: {}".format(mfile))
-        return True
-    else:
+    total = _manifest_total(filter_string, api_url)
+    expected = total if max_files is None else min(total, max_files)
+    num_records = 0
+    with open(manifest_file, mode='w') as localfile:
+        localfile.write(MANIFEST_HEADER + '\n')
+        for page_start in range(0, expected, page_size):
+            request_url = '{}?filters={}&size={}&from={}&sort=file_id:asc&return_type=manifest'.format(
+                api_url, up.quote(filter_string), min(page_size, expected - page_start), page_start)
+            with requests.request("GET", request_url, stream=True) as resp:
+                count_event('api_calls')
+                if resp.status_code != 200:
+                    raise Exception("Problem downloading manifest page. HTTP Status Code: {} URL: {}".format(
+                        resp.status_code, request_url))
+                lines = resp.iter_lines(chunk_size=1024 * 1024, decode_unicode=True)
+                next(lines, None)  # every page has a header
+                for line in lines:
+                    if not line:
+                        continue
+                    localfile.write(line + '\n')
+                    num_records += 1
+                    split_line = line.split('\t')
+                    yield {
+                        'id': split_line[0],
+                        'filename': split_line[1],
+                        'md5': split_line[2],
+                        'size': int(split_line[3]),
+                        'state': split_line[4] if len(split_line) > 4 else None
+                    }
+
+    if num_records != expected:
+        raise Exception("Manifest has {} records, but GDC reports {} for the filter".format(num_records, expected))
+    print("Wrote out manifest file: {} ({} records)".format(manifest_file, num_records))
+
+
+def get_the_manifest(filter_string, api_url, manifest_file, max_files=None, page_size=10000):
+    """
+    This function takes a JSON filter string and uses it to download a manifest from GDC
+    """
+    try:
+        for _ in stream_manifest(filter_string, api_url, manifest_file, max_files, page_size):
+            pass
+    except Exception as ex:
         print()
-        print("Request URL: {} ".format(request_url))
-        print("Problem downloading manifest file. HTTP Status Code: {}".format(resp.status_code))
-        print("HTTP content: {}".format(resp.content))
+        print("Problem downloading manifest file: {}".format(str(ex)))
         return False
+    return True
 
 
 def create_clean_target(local_files_dir):
@@ -582,59 +1825,129 @@ def create_clean_target(local_files_dir):
         os.makedirs(local_files_dir)
 
 
-def build_pull_list_with_indexd(manifest_file, indexd_max, indexd_url, local_file):
+def manifest_records(manifest_file):
     """
-    Generate a list of gs:// urls to pull down from a manifest, using indexD
+    Yield the records of a manifest file, in the form stream_manifest yields them
     """
-
-    # Parse the manifest file for uids, pull out other data too as a sanity check:
-
-    manifest_vals = {}
     with open(manifest_file, 'r') as readfile:
-        first = True
+        next(readfile, None)
         for line in readfile:
-            if first:
-                first = False
-                continue
             split_line = line.rstrip('\n').split("\t")
-            manifest_vals[split_line[0]] = {
+            yield {
+                'id': split_line[0],
                 'filename': split_line[1],
                 'md5': split_line[2],
-                'size': int(split_line[3])
+                'size': int(split_line[3]),
+                'state': split_line[4] if len(split_line) > 4 else None
             }
 
+
+def _prefetch(iterable, max_queued=10000):
+    """
+    Run an iterator in a background thread, so a slow producer (e.g. a manifest download) keeps
+    going while the consumer works. Exceptions in the producer are raised in the consumer. If the
+    consumer stops early (e.g. it raised, and closed this generator), the producer stops too, and
+    the iterator is closed.
+    """
+    done = object()
+    item_queue = queue.Queue(maxsize=max_queued)
+    failure = []
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                item_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    break
+        except Exception as ex:
+            failure.append(ex)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+            put(done)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = item_queue.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+    producer.join()
+    if failure:
+        raise failure[0]
+
+
+def build_pull_list_with_indexd(manifest_file, indexd_max, indexd_url, local_file, records=None):
+    """
+    Generate a list of gs:// urls to pull down from a manifest, using indexD. If records is given
+    (e.g. from stream_manifest), it is used instead of reading manifest_file, and the IndexD calls
+    start as soon as the first batch of records is in, while the rest are still downloading.
+    """
+
     # Use IndexD to map to Google bucket URIs. Batch up IndexD calls to reduce API load:
 
-    print("Pulling {} files from buckets...".format(len(manifest_vals)))
-    max_per_call = indexd_max
+    if records is None:
+        records = manifest_records(manifest_file)
+        print("Pulling files listed in {} from buckets...".format(manifest_file))
+    else:
+        records = _prefetch(records)
+        print("Pulling files from buckets as the manifest arrives...")
+
     indexd_results = {}
-    num_full_calls = len(manifest_vals) // max_per_call  # Python 3: // is classic integer floor!
-    num_final_call = len(manifest_vals) % max_per_call
-    all_calls = num_full_calls + (1 if (num_final_call > 0) else 0)
-    uuid_list = []
     call_count = 0
-    for uuid in manifest_vals:
-        uuid_list.append(uuid)
-        list_len = len(uuid_list)
-        is_last = (num_final_call > 0) and (call_count == num_full_calls)
-        if list_len == max_per_call or (is_last and list_len == num_final_call):
-            request_url = '{}{}'.format(indexd_url, ','.join(uuid_list))
-            resp = requests.request("GET", request_url)
+
+    def call_indexd(batch):
+        request_url = '{}{}'.format(indexd_url, ','.join(batch))
+        resp = requests.request("GET", request_url)
+        count_event('api_calls')
+        file_dict = json_loads(resp.text)
+        # IndexD does not promise to return the records in the order asked for:
+        returned = {curr_record['did']: curr_record for curr_record in file_dict['records']}
+        if set(returned) != set(batch):
+            raise Exception("IndexD returned unexpected ids {} and left out {}".format(
+                sorted(set(returned) - set(batch)), sorted(set(batch) - set(returned))))
+        for curr_id, manifest_record in batch.items():
+            curr_record = returned[curr_id]
+            indexd_results[curr_id] = curr_record
+            if curr_record['hashes']['md5'] != manifest_record['md5'] or \
+                    curr_record['size'] != manifest_record['size']:
+                raise Exception(
+                    "Expected data mismatch! {} vs. {}".format(str(curr_record), str(manifest_record)))
+
+    # A file listed twice in the manifest is only looked up (and pulled) once:
+    seen_ids = set()
+    batch = collections.OrderedDict()
+    try:
+        for record in records:
+            if record['id'] in seen_ids:
+                continue
+            seen_ids.add(record['id'])
+            batch[record['id']] = record
+            if len(batch) == indexd_max:
+                call_indexd(batch)
+                call_count += 1
+                print("completed {} calls to IndexD ({} files)".format(call_count, len(indexd_results)))
+                batch = collections.OrderedDict()
+        if batch:
+            call_indexd(batch)
             call_count += 1
-            print ("completed {} of {} calls to IndexD".format(call_count, all_calls))
-            file_dict = json_loads(resp.text)
-            for i in range(0, list_len):
-                call_id = uuid_list[i]
-                curr_record = file_dict['records'][i]
-                curr_id = curr_record['did']
-                manifest_record = manifest_vals[curr_id]
-                indexd_results[curr_id] = curr_record
-                if curr_record['did'] != curr_id or \
-                                curr_record['hashes']['md5'] != manifest_record['md5'] or \
-                                curr_record['size'] != manifest_record['size']:
-                    raise Exception(
-                        "Expected data mismatch! {} vs. {}".format(str(curr_record), str(manifest_record)))
-            uuid_list.clear()
+    finally:
+        # Stops the manifest download (or closes the manifest file) if an IndexD call failed:
+        records.close()
+    print("completed {} calls to IndexD for {} files".format(call_count, len(indexd_results)))
 
     # Create a list of URIs to pull, write to specified file:
 
@@ -695,18 +2008,60 @@ class BucketPuller(object):
         return
 
     def _pull_func(self, pull_list, local_files_dir):
-        storage_client = storage.Client()
+        storage_client = thread_gcs_client()
         for url in pull_list:
-            path_pieces = up.urlparse(url)
-            dir_name = os.path.dirname(path_pieces.path)
-            make_dir = "{}{}".format(local_files_dir, dir_name)
-            os.makedirs(make_dir, exist_ok=True)
-            bucket = storage_client.bucket(path_pieces.netloc)
-            blob = bucket.blob(path_pieces.path[1:])  # drop leading / from blob name
-            full_file = "{}{}".format(local_files_dir, path_pieces.path)
-            blob.download_to_filename(full_file)
+            _pull_one(storage_client, url, local_files_dir)
             self._bump_progress()
 
+    def pull_into_queue(self, pull_list, local_files_dir, done_queue, slots=None, stop=None):
+        """
+        Download like pull_from_buckets, but in the background: (index in pull_list, local file, None)
+        goes on done_queue as each file lands, then (None, None, None) once every file is down, or
+        (None, None, exception) if a download fails. If slots (a semaphore) is given, a slot is
+        taken before each download and the consumer gives it back when it is done with the file,
+        which caps how many downloaded files sit on disk. Setting stop (an Event) ends the
+        downloads early.
+        """
+        self._total_files = len(pull_list)
+        self._bar_bump = max(1, self._total_files // 100)
+        stop = stop if stop is not None else threading.Event()
+        work = queue.Queue()
+        for index, url in enumerate(pull_list):
+            work.put((index, url))
+
+        def pull_queued():
+            storage_client = thread_gcs_client()
+            while not stop.is_set():
+                try:
+                    index, url = work.get_nowait()
+                except queue.Empty:
+                    return
+                while slots is not None and not slots.acquire(timeout=1.0):
+                    if stop.is_set():
+                        return
+                try:
+                    full_file = _pull_one(storage_client, url, local_files_dir)
+                except Exception as ex:
+                    stop.set()
+                    done_queue.put((None, None, ex))
+                    return
+                self._bump_progress()
+                done_queue.put((index, full_file, None))
+
+        def watch():
+            for th in self._threads:
+                th.join()
+            if not stop.is_set():
+                print_progress_bar(self._read_files, self._total_files)
+                done_queue.put((None, None, None))
+
+        self._threads = [threading.Thread(target=pull_queued, daemon=True)
+                         for _ in range(min(self._thread_count, max(1, len(pull_list))))]
+        for th in self._threads:
+            th.start()
+        threading.Thread(target=watch, daemon=True).start()
+        return stop
+
     def _bump_progress(self):
 
         with self._lock:
@@ -715,6 +2070,22 @@ class BucketPuller(object):
                 print_progress_bar(self._read_files, self._total_files)
 
 
+def _pull_one(storage_client, url, local_files_dir):
+    """
+    Download one gs:// url to the same path under local_files_dir. Returns the local file name.
+    """
+    path_pieces = up.urlparse(url)
+    dir_name = os.path.dirname(path_pieces.path)
+    make_dir = "{}{}".format(local_files_dir, dir_name)
+    os.makedirs(make_dir, exist_ok=True)
+    bucket = storage_client.bucket(path_pieces.netloc)
+    blob = bucket.blob(path_pieces.path[1:])  # drop leading / from blob name
+    full_file = "{}{}".format(local_files_dir, path_pieces.path)
+    blob.download_to_filename(full_file)
+    count_event('gcs_downloads')
+    return full_file
+
+
 def pull_from_buckets(pull_list, local_files_dir):
     """
     Run the "Download Client", which now justs hauls stuff out of the cloud buckets
@@ -724,7 +2095,7 @@ def pull_from_buckets(pull_list, local_files_dir):
 
     num_files = len(pull_list)
     print("Begin {} bucket copies...".format(num_files))
-    storage_client = storage.Client()
+    storage_client = gcs_client()
     copy_count = 0
     for url in pull_list:
         path_pieces = up.urlparse(url)
@@ -735,6 +2106,7 @@ def pull_from_buckets(pull_list, local_files_dir):
         blob = bucket.blob(path_pieces.path[1:])  # drop leading / from blob name
         full_file = "{}{}".format(local_files_dir, path_pieces.path)
         blob.download_to_filename(full_file)
+        count_event('gcs_downloads')
         copy_count += 1
         if (copy_count % 10) == 0:
             print_progress_bar(copy_count, num_files)
@@ -765,7 +2137,7 @@ def generic_bq_harness(sql, target_dataset, dest_table, do_batch, do_replace):
     """
     Handles all the boilerplate for running a BQ job
     """
-    client = bigquery.Client()
+    client = bq_client()
     job_config = bigquery.QueryJobConfig()
     if do_batch:
         job_config.priority = bigquery.QueryPriority.BATCH
@@ -777,7 +2149,7 @@ def generic_bq_harness_write_depo(sql, target_dataset, dest_table, do_batch, wri
     """
     Handles all the boilerplate for running a BQ job
     """
-    client = bigquery.Client()
+    client = bq_client()
     job_config = bigquery.QueryJobConfig()
     if do_batch:
         job_config.priority = bigquery.QueryPriority.BATCH
@@ -789,8 +2161,13 @@ def generic_bq_harness_write_depo(sql, target_dataset, dest_table, do_batch, wri
     print(target_ref)
     location = 'US'
 
+    if bq_dry_run_enabled():
+        preflight_query(sql, '{}.{}'.format(target_dataset, dest_table), client)
+        return True
+
     # API request - starts the query
     query_job = client.query(sql, location=location, job_config=job_config)
+    count_event('bq_jobs')
 
     # Query
     query_job = client.get_job(query_job.job_id, location=location)
@@ -805,6 +2182,7 @@ def generic_bq_harness_write_depo(sql, target_dataset, dest_table, do_batch, wri
     print('Job {} is done'.format(query_job.job_id))
 
     query_job = client.get_job(query_job.job_id, location=location)
+    record_bq_job(query_job)
     if query_job.error_result is not None:
         print('Error result!! {}'.format(query_job.error_result))
         return False
@@ -819,14 +2197,19 @@ def bq_harness_with_result(sql, do_batch):
     Handles all the boilerplate for running a BQ job
     """
 
-    client = bigquery.Client()
+    client = bq_client()
     job_config = bigquery.QueryJobConfig()
     if do_batch:
         job_config.priority = bigquery.QueryPriority.BATCH
     location = 'US'
 
+    # A dry run still runs these, since their results steer the queries that follow:
+    if bq_dry_run_enabled():
+        preflight_query(sql, 'query with result', client)
+
     # API request - starts the query
     query_job = client.query(sql, location=location, job_config=job_config)
+    count_event('bq_jobs')
 
     # Query
     job_state = 'NOT_STARTED'
@@ -839,6 +2222,7 @@ def bq_harness_with_result(sql, do_batch):
     print('Job {} is done'.format(query_job.job_id))
 
     query_job = client.get_job(query_job.job_id, location=location)
+    record_bq_job(query_job, 'query with result')
     if query_job.error_result is not None:
         print('Error result!! {}'.format(query_job.error_result))
         return None
@@ -854,32 +2238,228 @@ def upload_to_bucket(target_tsv_bucket, target_tsv_file, local_tsv_file):
     Large files have to be in a bucket for them to be ingested into Big Query. This does this.
     This function is also used to archive files.
     """
-    storage_client = storage.Client()
+    storage_client = gcs_client()
     bucket = storage_client.get_bucket(target_tsv_bucket)
     blob = bucket.blob(target_tsv_file)
     print(blob.name)
     blob.upload_from_filename(local_tsv_file)
 
 
+def bucket_parts_uri(target_tsv_bucket, target_tsv_file, do_compose, do_gzip):
+    """
+    URI to hand to BQ for a file pushed up with upload_to_bucket_in_parts. If the parts were composed
+    back together, this is just the target file. Otherwise it is a wildcard over the part files.
+    """
+    if do_compose:
+        return "gs://{}/{}".format(target_tsv_bucket, target_tsv_file)
+    return "gs://{}/{}-part-*".format(target_tsv_bucket, target_tsv_file)
+
+
+def _part_blob_name(target_tsv_file, part_num, do_gzip):
+    return "{}-part-{:03d}{}".format(target_tsv_file, part_num, '.gz' if do_gzip else '')
+
+
+def _crc32c_b64(file_obj, num_bytes=None, chunk_size=8 * 1024 * 1024):
+    """
+    Base64 CRC32C of the next num_bytes (or all remaining bytes) of the file, in the form GCS
+    reports it in blob.crc32c
+    """
+    checksum = google_crc32c.Checksum()
+    remaining = num_bytes
+    while remaining is None or remaining > 0:
+        want = chunk_size if remaining is None else min(chunk_size, remaining)
+        chunk = file_obj.read(want)
+        if not chunk:
+            break
+        checksum.update(chunk)
+        if remaining is not None:
+            remaining -= len(chunk)
+    return base64.b64encode(checksum.digest()).decode('utf-8')
+
+
+def _remote_crc32c(bucket, blob_name):
+    blob = bucket.get_blob(blob_name)
+    return None if blob is None else blob.crc32c
+
+
+def _split_on_lines(local_tsv_file, num_parts):
+    """
+    Byte ranges that cut the file into num_parts pieces, each ending on a line boundary. The
+    first line is returned separately so it can be repeated at the top of each part.
+    """
+    file_size = os.path.getsize(local_tsv_file)
+    with open(local_tsv_file, 'rb') as readfile:
+        header = readfile.readline()
+        boundaries = [0]
+        for i in range(1, num_parts):
+            readfile.seek(max((file_size * i) // num_parts, boundaries[-1]))
+            readfile.readline()
+            cut = readfile.tell()
+            if cut >= file_size:
+                break
+            if cut > boundaries[-1]:
+                boundaries.append(cut)
+        boundaries.append(file_size)
+    ranges = [(boundaries[i], boundaries[i + 1]) for i in range(len(boundaries) - 1)]
+    return header, ranges
+
+
+def _crc32c_range(local_tsv_file, start, end):
+    with open(local_tsv_file, 'rb') as readfile:
+        readfile.seek(start)
+        return _crc32c_b64(readfile, end - start)
+
+
+def _upload_part(bucket, blob_name, local_tsv_file, start, end, header, do_gzip, skip_if_same):
+    """
+    Upload one byte range of the file as its own blob. Plain ranges are streamed straight out
+    of the big file; if a header line is to be prepended or the part is gzipped, the part is
+    staged in a scratch file next to the original first. Returns whether the part was sent, and
+    its CRC32C as GCS has it.
+    """
+    if header is None and not do_gzip:
+        with open(local_tsv_file, 'rb') as readfile:
+            if skip_if_same:
+                readfile.seek(start)
+                local_crc = _crc32c_b64(readfile, end - start)
+                if local_crc == _remote_crc32c(bucket, blob_name):
+                    return False, local_crc
+            readfile.seek(start)
+            blob = bucket.blob(blob_name)
+            blob.upload_from_file(readfile, size=end - start, rewind=False)
+        return True, blob.crc32c
+
+    staged_file = "{}.{}".format(local_tsv_file, blob_name.split('/')[-1])
+    try:
+        with open(local_tsv_file, 'rb') as readfile:
+            readfile.seek(start)
+            if do_gzip:
+                # mtime=0 keeps the output byte-identical run to run, so the CRC check still works:
+                stage_out = gzip.GzipFile(staged_file, mode='wb', compresslevel=6, mtime=0)
+            else:
+                stage_out = open(staged_file, 'wb')
+            with stage_out:
+                if header is not None:
+                    stage_out.write(header)
+                remaining = end - start
+                while remaining > 0:
+                    chunk = readfile.read(min(8 * 1024 * 1024, remaining))
+                    if not chunk:
+                        break
+                    stage_out.write(chunk)
+                    remaining -= len(chunk)
+        if skip_if_same:
+            with open(staged_file, 'rb') as staged:
+                local_crc = _crc32c_b64(staged)
+            if local_crc == _remote_crc32c(bucket, blob_name):
+                return False, local_crc
+        blob = bucket.blob(blob_name)
+        blob.upload_from_filename(staged_file)
+        return True, blob.crc32c
+    finally:
+        if os.path.isfile(staged_file):
+            os.remove(staged_file)
+
+
+def upload_to_bucket_in_parts(target_tsv_bucket, target_tsv_file, local_tsv_file, num_parts,
+                              do_compose=True, do_gzip=False, has_header=True, skip_if_same=True):
+    """
+    Parallel Upload to Google Bucket
+    Multi-GB files take minutes to push up through the single stream used by upload_to_bucket. This
+    splits the file on line boundaries into num_parts pieces and uploads them concurrently. With
+    do_compose, the pieces are glued back into target_tsv_file in the bucket and then deleted, so
+    downstream steps see the same object upload_to_bucket would have made. Otherwise the pieces are
+    left in place (each starting with the header line if has_header) for a wildcard BQ load, and can
+    be gzipped on the way up. Pieces with a matching CRC32C in the bucket are not uploaded again. A
+    composed file carries the ranges and CRC32Cs of its parts in its metadata, and is skipped if all
+    of them still match; those are checked part by part in parallel, never over the whole file.
+    Returns the gs:// URI to load from, or None on failure.
+    """
+    if do_gzip and do_compose:
+        print("Gzipped parts cannot be composed into a loadable file; use do_compose=False")
+        return None
+
+    storage_client = gcs_client()
+    bucket = storage_client.bucket(target_tsv_bucket)
+
+    header, ranges = _split_on_lines(local_tsv_file, num_parts)
+    part_names = [_part_blob_name(target_tsv_file, i, do_gzip) for i in range(len(ranges))]
+
+    if do_compose and skip_if_same:
+        target_blob = bucket.get_blob(target_tsv_file)
+        if target_blob is not None and target_blob.metadata and 'part_crc32c' in target_blob.metadata:
+            stored_parts = json_loads(target_blob.metadata['part_crc32c'])
+            if [part[:2] for part in stored_parts] == [list(rng) for rng in ranges]:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                    local_crcs = list(executor.map(_crc32c_range, itertools.repeat(local_tsv_file),
+                                                   [rng[0] for rng in ranges], [rng[1] for rng in ranges]))
+                if local_crcs == [part[2] for part in stored_parts]:
+                    print("{} is already in the bucket, skipping upload".format(target_tsv_file))
+                    return bucket_parts_uri(target_tsv_bucket, target_tsv_file, do_compose, do_gzip)
+
+    print("Uploading {} as {} parts".format(local_tsv_file, len(part_names)))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(part_names)) as executor:
+        futures = []
+        for i, (start, end) in enumerate(ranges):
+            # The first part already starts with the header:
+            part_header = header if (has_header and not do_compose and i > 0) else None
+            # Composed parts are deleted, so there is never one in the bucket to compare with:
+            futures.append(executor.submit(_upload_part, bucket, part_names[i], local_tsv_file,
+                                           start, end, part_header, do_gzip, skip_if_same and not do_compose))
+        try:
+            part_results = [future.result() for future in futures]
+        except Exception as ex:
+            print("Part upload failed: {}".format(ex))
+            return None
+    uploaded = [result[0] for result in part_results]
+    print("Uploaded {} parts, {} already present".format(sum(uploaded), len(uploaded) - sum(uploaded)))
+
+    part_prefix = "{}-part-".format(target_tsv_file)
+    if do_compose:
+        #
+        # GCS composes at most 32 sources per call, so fold any remaining parts onto the end
+        # of the target:
+        #
+        part_blobs = [bucket.blob(name) for name in part_names]
+        target_blob = bucket.blob(target_tsv_file)
+        target_blob.compose(part_blobs[:32])
+        remaining = part_blobs[32:]
+        while remaining:
+            target_blob.compose([target_blob] + remaining[:31])
+            remaining = remaining[31:]
+        target_blob.metadata = {'part_crc32c': json_dumps([[start, end, result[1]] for (start, end), result
+                                                           in zip(ranges, part_results)])}
+        target_blob.patch()
+        stale_blobs = list(storage_client.list_blobs(bucket, prefix=part_prefix))
+    else:
+        #
+        # A previous run with more parts would leave blobs behind that the wildcard still matches:
+        #
+        keep = set(part_names)
+        stale_blobs = [blob for blob in storage_client.list_blobs(bucket, prefix=part_prefix)
+                       if blob.name not in keep]
+
+    for blob in stale_blobs:
+        blob.delete()
+
+    return bucket_parts_uri(target_tsv_bucket, target_tsv_file, do_compose, do_gzip)
+
+
 def csv_to_bq(schema, csv_uri, dataset_id, targ_table, do_batch):
     return csv_to_bq_write_depo(schema, csv_uri, dataset_id, targ_table,
                                 do_batch, bigquery.WriteDisposition.WRITE_TRUNCATE)
 
 
 def csv_to_bq_write_depo(schema, csv_uri, dataset_id, targ_table, do_batch, write_depo):
-    client = bigquery.Client()
+    client = bq_client()
 
     dataset_ref = client.dataset(dataset_id)
     job_config = bigquery.LoadJobConfig()
     if do_batch:
         job_config.priority = bigquery.QueryPriority.BATCH
 
-    schema_list = []
-    for mydict in schema:
-        schema_list.append(bigquery.SchemaField(mydict['name'], mydict['type'].upper(),
-                                                mode='NULLABLE', description=mydict['description']))
-
-    job_config.schema = schema_list
+    job_config.schema = _load_schema_fields(schema)
     job_config.skip_leading_rows = 1
     job_config.source_format = bigquery.SourceFormat.CSV
     if write_depo is not None:
@@ -891,6 +2471,41 @@ def csv_to_bq_write_depo(schema, csv_uri, dataset_id, targ_table, do_batch, writ
         csv_uri,
         dataset_ref.table(targ_table),
         job_config=job_config)  # API request
+    return _await_load_job(client, load_job, dataset_ref, targ_table)
+
+
+def _load_schema_fields(schema):
+    schema_list = []
+    for mydict in schema:
+        schema_list.append(bigquery.SchemaField(mydict['name'], mydict['type'].upper(),
+                                                mode='NULLABLE', description=mydict['description']))
+    return schema_list
+
+
+def parquet_to_bq(schema, parquet_uri, dataset_id, targ_table, do_batch):
+    """
+    Load a Parquet file written by the concat functions (see write_parts_to_parquet), with the
+    same typed schema list csv_to_bq takes
+    """
+    client = bq_client()
+
+    dataset_ref = client.dataset(dataset_id)
+    job_config = bigquery.LoadJobConfig()
+    if do_batch:
+        job_config.priority = bigquery.QueryPriority.BATCH
+    job_config.schema = _load_schema_fields(schema)
+    job_config.source_format = bigquery.SourceFormat.PARQUET
+    job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+
+    load_job = client.load_table_from_uri(
+        parquet_uri,
+        dataset_ref.table(targ_table),
+        job_config=job_config)  # API request
+    return _await_load_job(client, load_job, dataset_ref, targ_table)
+
+
+def _await_load_job(client, load_job, dataset_ref, targ_table):
+    count_event('bq_jobs')
     print('Starting job {}'.format(load_job.job_id))
 
     location = 'US'
@@ -904,6 +2519,7 @@ def csv_to_bq_write_depo(schema, csv_uri, dataset_id, targ_table, do_batch, writ
     print('Job {} is done'.format(load_job.job_id))
 
     load_job = client.get_job(load_job.job_id, location=location)
+    record_bq_job(load_job)
     if load_job.error_result is not None:
         print('Error result!! {}'.format(load_job.error_result))
         for err in load_job.errors:
@@ -976,9 +2592,392 @@ def concat_all_files(all_files, one_big_tsv, program_prefix, extra_cols, file_in
             if toss_zip and os.path.isfile(use_file_name):
                 os.remove(use_file_name)
 
+    count_event('bytes_written', os.path.getsize(one_big_tsv))
+    return
+
+
+def _uncompress_for_concat(filename):
+    """
+    Unzip or gunzip a file for concatenation. Returns the file to read, and if it needs to be tossed after.
+    A missing file is handed back as is, for the caller to skip.
+    """
+    if not os.path.isfile(filename):
+        return filename, False
+    if filename.endswith('.zip'):
+        dir_name = os.path.dirname(filename)
+        print("Unzipping {}".format(filename))
+        with zipfile.ZipFile(filename, "r") as zip_ref:
+            zip_ref.extractall(dir_name)
+        return filename[:-4], True
+    elif filename.endswith('.gz'):
+        use_file_name = filename[:-3]
+        print("Uncompressing {}".format(filename))
+        with gzip.open(filename, "rb") as gzip_in:
+            with open(use_file_name, "wb") as uncomp_out:
+                shutil.copyfileobj(gzip_in, uncomp_out)
+        return use_file_name, True
+    return filename, False
+
+
+_Projection = collections.namedtuple('_Projection', ['num_file_cols', 'keep_cols', 'check_index', 'drop_val'])
+
+
+def _column_projection(full_header, extra_cols, retain_cols, check_col, drop_val):
+    """
+    For a concat that keeps only some columns: the projection to hand to _concat_one_file, and the
+    header of the kept columns. Extra columns are always kept; rows with drop_val in check_col
+    (looked up in the full row) are skipped.
+    """
+    keep_cols = []
+    hdr_line = []
+    check_index = None
+    for i in range(len(full_header)):
+        if full_header[i] in retain_cols or full_header[i] in extra_cols:
+            keep_cols.append(i)
+            hdr_line.append(full_header[i])
+        if check_col is not None and full_header[i] == check_col:
+            print("check_col {} indx {}".format(check_col, i))
+            check_index = i
+    print("Keeping columns {}".format(str(keep_cols)))
+    return _Projection(len(full_header) - len(extra_cols), keep_cols, check_index, drop_val), hdr_line
+
+
+def _concat_one_file(filename, part_file, program_prefix, header_id, hdr_line, num_extra,
+                     file_info_func, split_more_func, toss_raw=False, with_stats=False, projection=None,
+                     check_header=False):
+    """
+    Pool worker for concat_all_files_parallel: the body rows of one file, with the file info
+    columns added, go into part_file. With toss_raw, the input file is deleted once it is read.
+    With check_header, the file's header must match hdr_line (less the extra columns).
+    With with_stats, the infer_schema_full_scan column stats of the rows are gathered on the way
+    out. With a projection (see _column_projection), only the kept columns are written, and lines
+    are only split as far as the last of them. Returns the part file (None if the input is missing)
+    and the stats (or None).
+    """
+    use_file_name, toss_zip = _uncompress_for_concat(filename)
+    if not os.path.isfile(use_file_name):
+        print('{} was not found'.format(use_file_name))
+        return None, None
+    try:
+        out_hdr = hdr_line
+        if split_more_func is not None:
+            # Lets a stateful splitter set itself up from the header in this process:
+            out_hdr = split_more_func(list(hdr_line), hdr_line, True)
+        stats = [['NA', 'NA', 0, 0] for _ in range(len(out_hdr))] if with_stats else None
+        file_info_list = file_info_func(use_file_name, program_prefix)
+        if len(file_info_list) < num_extra:
+            raise IndexError("File info for {} has {} values, but there are {} extra columns".format(
+                             use_file_name, len(file_info_list), num_extra))
+        file_info_list = file_info_list[:num_extra]
+        if projection is not None:
+            num_file_cols, keep_cols, check_index, drop_val = projection
+            full_info = [None] * num_file_cols + file_info_list
+            max_split = max([i for i in keep_cols + [check_index or 0] if i < num_file_cols] + [0]) + 1
+        with open(use_file_name, 'r') as readfile, open(part_file, 'w') as outfile:
+            out_rows = []
+            for line in readfile:
+                if check_header and not line.startswith('#'):
+                    check_header = False
+                    if line.rstrip('\n').split("\t") != hdr_line[:len(hdr_line) - num_extra]:
+                        raise ValueError("Header of {} does not match the header of the other files".format(
+                                         filename))
+                    continue
+                if line.startswith('#') or line.startswith(header_id):
+                    continue
+                if projection is None:
+                    split_line = line.rstrip('\n').split("\t") + file_info_list
+                else:
+                    full_line = line.rstrip('\n').split("\t", max_split)
+                    if check_index is not None:
+                        check_val = full_line[check_index] if check_index < num_file_cols else full_info[check_index]
+                        if check_val == drop_val:
+                            continue
+                    split_line = [full_line[i] if i < num_file_cols else full_info[i] for i in keep_cols]
+                if split_more_func is not None:
+                    split_line = split_more_func(split_line, hdr_line, False)
+                out_rows.append('\t'.join(split_line))
+                out_rows.append('\n')
+                if len(out_rows) >= 200000:
+                    outfile.writelines(out_rows)
+                    if with_stats:
+                        # The lone newline entries are skipped as blank lines:
+                        _column_stats_for_lines(out_rows, len(out_hdr), stats)
+                    out_rows.clear()
+            outfile.writelines(out_rows)
+            if with_stats:
+                _column_stats_for_lines(out_rows, len(out_hdr), stats)
+    finally:
+        if toss_zip and os.path.isfile(use_file_name):
+            os.remove(use_file_name)
+        if toss_raw and os.path.isfile(filename):
+            os.remove(filename)
+    return part_file, stats
+
+
+def _concat_header(filename, extra_cols):
+    """
+    Header for the concatenated file: the first non-comment line of filename, plus the extra columns.
+    None if the file is missing or has no such line.
+    """
+    hdr_line = None
+    use_file_name, toss_zip = _uncompress_for_concat(filename)
+    if not os.path.isfile(use_file_name):
+        print('{} was not found'.format(use_file_name))
+        return None
+    try:
+        with open(use_file_name, 'r') as readfile:
+            for line in readfile:
+                if not line.startswith('#'):
+                    hdr_line = line.rstrip('\n').split("\t") + list(extra_cols)
+                    break
+    finally:
+        if toss_zip and os.path.isfile(use_file_name):
+            os.remove(use_file_name)
+    return hdr_line
+
+
+def _glue_parts(one_big_tsv, hdr_line, split_more_func, done_parts, parquet_file=None):
+    """
+    Finish a parallel concat: glue the (part file, stats) results into one_big_tsv, or if a
+    parquet_file is given, write that instead (see write_parts_to_parquet)
+    """
+    out_hdr = hdr_line if split_more_func is None else split_more_func(list(hdr_line), hdr_line, True)
+    if parquet_file is not None:
+        write_parts_to_parquet(parquet_file, out_hdr, done_parts)
+        return
+    with open(one_big_tsv, 'w') as outfile:
+        outfile.write('\t'.join(out_hdr))
+        outfile.write('\n')
+        for part_file, _ in done_parts:
+            if part_file is None:
+                continue
+            with open(part_file, 'r') as readfile:
+                shutil.copyfileobj(readfile, outfile, 16 * 1024 * 1024)
+    count_event('bytes_written', os.path.getsize(one_big_tsv))
+
+
+_PARQUET_TYPES = {'integer': 'int64', 'float': 'float64', 'boolean': 'bool_', 'string': 'string'}
+
+
+def write_parts_to_parquet(parquet_file, out_hdr, done_parts, row_group_rows=1000000, compression='snappy'):
+    """
+    Write the part files of a parallel concat into one typed, compressed Parquet file, in part order.
+    The column types come from the stats the concat workers gathered, and the typed columns are
+    converted the way the stats judged them (see _arrow_column_as). Column names are made valid
+    for BQ as in infer_schema_full_scan. The stats go into a JSON file next to the Parquet file,
+    where build_schema_from_concat_stats picks them up instead of rescanning. Repeated ("[...]")
+    columns are kept as strings, as in the TSV.
+    """
+    if pyarrow is None:
+        raise Exception("pyarrow is needed to write {}".format(parquet_file))
+
+    stats = [['NA', 'NA', 0, 0] for _ in range(len(out_hdr))]
+    for _, part_stats in done_parts:
+        if part_stats is not None:
+            _merge_column_stats(stats, part_stats)
+    _finish_column_stats(stats)
+    field_names = _bq_field_names(out_hdr)
+    for col_stats in stats:
+        if col_stats[1] == 'repeated':
+            col_stats[0] = 'string'
+
+    # Everything is read as text, and the typed columns are converted afterwards:
+    read_options = pyarrow.csv.ReadOptions(column_names=field_names, block_size=64 * 1024 * 1024)
+    parse_options = pyarrow.csv.ParseOptions(delimiter='\t', quote_char=False)
+    convert_options = pyarrow.csv.ConvertOptions(column_types={name: pyarrow.string() for name in field_names},
+                                                 null_values=[''], strings_can_be_null=True)
+    arrow_schema = pyarrow.schema([(name, getattr(pyarrow, _PARQUET_TYPES[col_stats[0]])())
+                                   for name, col_stats in zip(field_names, stats)])
+
+    num_rows = 0
+    pending = []
+    pending_rows = 0
+    with pyarrow.parquet.ParquetWriter(parquet_file, arrow_schema, compression=compression) as writer:
+        for part_file, _ in done_parts:
+            if part_file is None or os.path.getsize(part_file) == 0:
+                continue
+            table = pyarrow.csv.read_csv(part_file, read_options=read_options, parse_options=parse_options,
+                                         convert_options=convert_options)
+            table = pyarrow.Table.from_arrays([_arrow_column_as(table.column(ii), col_stats[0])
+                                               for ii, col_stats in enumerate(stats)], schema=arrow_schema)
+            pending.append(table)
+            pending_rows += table.num_rows
+            if pending_rows >= row_group_rows:
+                writer.write_table(pyarrow.concat_tables(pending), row_group_size=row_group_rows)
+                num_rows += pending_rows
+                pending = []
+                pending_rows = 0
+        if pending:
+            writer.write_table(pyarrow.concat_tables(pending), row_group_size=row_group_rows)
+            num_rows += pending_rows
+
+    with open(concat_stats_file(parquet_file), 'w') as stats_out:
+        stats_out.write(json_dumps({'fields': field_names, 'stats': stats, 'rows': num_rows}))
+    print("Wrote {} rows to {}".format(num_rows, parquet_file))
+    count_event('bytes_written', os.path.getsize(parquet_file))
+
+
+def _arrow_column_as(column, col_type):
+    """
+    Convert a text column to col_type the way _column_stats_for_lines typed it: values are
+    stripped, blank ones are nulls, booleans match in any case, and numbers that Arrow won't parse
+    (e.g. '+5') go through the same numpy conversion the stats used. String columns are left as is.
+    """
+    if col_type == 'string':
+        return column
+    trimmed = pyarrow.compute.utf8_trim_whitespace(column)
+    trimmed = pyarrow.compute.if_else(pyarrow.compute.equal(trimmed, ''), None, trimmed)
+    if col_type == 'boolean':
+        return pyarrow.compute.equal(pyarrow.compute.utf8_lower(trimmed), 'true')
+    arrow_type = getattr(pyarrow, _PARQUET_TYPES[col_type])()
+    try:
+        return pyarrow.compute.cast(trimmed, arrow_type)
+    except pyarrow.ArrowInvalid:
+        values = np.array(trimmed.fill_null('0').to_pylist(), dtype=str).astype(arrow_type.to_pandas_dtype())
+        return pyarrow.array(values, mask=trimmed.is_null().to_numpy(zero_copy_only=False))
+
+
+def concat_stats_file(parquet_file):
+    return "{}.stats.json".format(parquet_file)
+
+
+def build_schema_from_concat_stats(parquet_file):
+    """
+    Drop-in for createSchemaP3.build_schema when the concat wrote parquet_file: the (name, type)
+    typing tuples come from the stats gathered during the concat, with no rescan of the data
+    """
+    with open(concat_stats_file(parquet_file), 'r') as stats_in:
+        concat_stats = json_loads(stats_in.read())
+    return [(name, col_stats[0]) for name, col_stats in zip(concat_stats['fields'], concat_stats['stats'])]
+
+
+def concat_all_files_parallel(all_files, one_big_tsv, program_prefix, extra_cols, file_info_func,
+                              split_more_func, num_procs=None, parquet_file=None,
+                              retain_cols=None, check_col=None, drop_val=None):
+    """
+    Concatenate all Files, using a process pool
+    Same output as concat_all_files, but each file is processed in a worker process (num_procs,
+    default all cores) into its own part file, and the parts are then glued together in file order.
+    file_info_func and split_more_func need to be picklable (i.e. module-level functions or objects).
+    If parquet_file is given, that is written instead of one_big_tsv (see write_parts_to_parquet).
+    If retain_cols is given, only those columns and the extra columns are kept, and rows holding
+    drop_val in check_col are dropped; split_more_func then sees the kept columns only.
+    THIS VERSION OF THE FUNCTION USES THE FIRST LINE OF THE FIRST FILE TO BUILD THE HEADER LINE!
+    """
+    print("building {}".format(one_big_tsv if parquet_file is None else parquet_file))
+    if not all_files:
+        return
+
+    # Like concat_all_files, missing files and files with only comments are passed over:
+    hdr_line = None
+    for filename in all_files:
+        hdr_line = _concat_header(filename, extra_cols)
+        if hdr_line is not None:
+            break
+    if hdr_line is None:
+        print("No header line found in any of the files")
+        return
+    header_id = hdr_line[0]
+    print("Header starts with {}".format(header_id))
+    projection = None
+    if retain_cols is not None:
+        projection, hdr_line = _column_projection(hdr_line, extra_cols, retain_cols, check_col, drop_val)
+
+    parts_dir = "{}.parts".format(one_big_tsv)
+    os.makedirs(parts_dir, exist_ok=True)
+    part_files = [os.path.join(parts_dir, "part-{:06d}.tsv".format(i)) for i in range(len(all_files))]
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_procs, **profiler_pool_kwargs()) as executor:
+            futures = [executor.submit(_concat_one_file, all_files[i], part_files[i], program_prefix,
+                                       header_id, hdr_line, len(extra_cols), file_info_func, split_more_func,
+                                       with_stats=parquet_file is not None, projection=projection)
+                       for i in range(len(all_files))]
+            done_parts = [future.result() for future in futures]
+
+        _glue_parts(one_big_tsv, hdr_line, split_more_func, done_parts, parquet_file)
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
     return
 
 
+def pull_and_concat_all_files(pull_list, local_files_dir, one_big_tsv, program_prefix, extra_cols, file_info_func,
+                              split_more_func, num_threads=10, num_procs=None, window=None, toss_raw=True,
+                              parquet_file=None):
+    """
+    download_from_gdc, build_file_list and concat_all_files_parallel as one pipeline: the bucket
+    puller hands each file to the concat pool as soon as it lands, so processing overlaps the
+    downloads. At most window files (default twice the pool size plus the download threads) are
+    on disk at once, since a download waits for a slot and a slot is given back when its file
+    has been concatenated (and, with toss_raw, deleted). The header is taken from the first file
+    to land, and every other file must have the same one. Parts are glued in pull list order, into
+    parquet_file instead of one_big_tsv if that is given. Returns the local file names, in pull
+    list order. A failed download or concat stops the downloads and is raised right away.
+    """
+    print("building {} from {} files in buckets".format(one_big_tsv if parquet_file is None else parquet_file,
+                                                        len(pull_list)))
+    if not pull_list:
+        return []
+
+    num_procs = num_procs if num_procs is not None else os.cpu_count()
+    window = window if window is not None else 2 * num_procs + num_threads
+    slots = threading.Semaphore(window)
+    done_queue = queue.Queue()
+    bp = BucketPuller(num_threads)
+    stop = bp.pull_into_queue(pull_list, local_files_dir, done_queue, slots)
+
+    parts_dir = "{}.parts".format(one_big_tsv)
+    os.makedirs(parts_dir, exist_ok=True)
+    local_files = {}
+    futures = {}
+    hdr_line = None
+
+    def concat_done(future):
+        slots.release()
+        if not future.cancelled() and future.exception() is not None:
+            stop.set()
+            done_queue.put((None, None, future.exception()))
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_procs, **profiler_pool_kwargs()) as executor:
+            while True:
+                index, full_file, error = done_queue.get()
+                if error is not None:
+                    stop.set()
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise error
+                if index is None:
+                    break
+                local_files[index] = full_file
+                if hdr_line is None:
+                    hdr_line = _concat_header(full_file, extra_cols)
+                    if hdr_line is None:
+                        # Nothing but comments, so no rows either:
+                        if toss_raw and os.path.isfile(full_file):
+                            os.remove(full_file)
+                        slots.release()
+                        continue
+                    print("Header starts with {}".format(hdr_line[0]))
+                part_file = os.path.join(parts_dir, "part-{:06d}.tsv".format(index))
+                future = executor.submit(_concat_one_file, full_file, part_file, program_prefix, hdr_line[0],
+                                         hdr_line, len(extra_cols), file_info_func, split_more_func, toss_raw,
+                                         with_stats=parquet_file is not None, check_header=True)
+                future.add_done_callback(concat_done)
+                futures[index] = future
+            done_parts = [futures[index].result() for index in sorted(futures)]
+
+        if hdr_line is None:
+            print("No header line found in any of the files")
+        else:
+            _glue_parts(one_big_tsv, hdr_line, split_more_func, done_parts, parquet_file)
+    finally:
+        stop.set()
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+    return [local_files[index] for index in sorted(local_files)]
+
+
 def build_combined_schema(scraped, augmented, typing_tups, holding_list, holding_dict):
     """
     Merge schema descriptions (if any) and ISB-added descriptions with inferred type data
@@ -1046,6 +3045,268 @@ def typing_tups_to_schema_list(typing_tups, holding_list):
 
     return True
 
+
+def _join_bq_type(type_a, type_b):
+    """
+    Type lattice used by createSchema: NA is below everything, integer widens to float, and any
+    other disagreement makes the column a string
+    """
+    if type_a == type_b or type_b == 'NA':
+        return type_a
+    if type_a == 'NA':
+        return type_b
+    if {type_a, type_b} == {'integer', 'float'}:
+        return 'float'
+    return 'string'
+
+
+_MODE_RANK = {'NA': 0, 'nullable': 1, 'repeated': 2}
+
+
+def _split_list_string(list_string):
+    """
+    Same token split as createSchema.splitListString, for "[...]" cells
+    """
+    if not list_string.startswith("u'"):
+        return list_string.split(',')
+    tokens = []
+    ii = 2
+    while ii < len(list_string):
+        jj = list_string.find("'", ii)
+        if jj > ii:
+            tokens.append(list_string[ii:jj])
+            ii = jj
+        ii = list_string.find("'", jj + 1)
+        if ii < 0:
+            ii = len(list_string)
+    return tokens
+
+
+def _type_of_values(values):
+    """
+    Lattice type of a numpy array of non-empty strings. The numeric checks are whole-array
+    conversions done in C, not a Python try/except per value.
+    """
+    if len(values) == 0:
+        return 'NA'
+    lowered = np.char.lower(values)
+    num_bool = int(np.count_nonzero((lowered == 'true') | (lowered == 'false')))
+    if num_bool == len(values):
+        return 'boolean'
+    if num_bool > 0:
+        return 'string'
+    for try_type, bq_type in ((np.int64, 'integer'), (np.float64, 'float')):
+        try:
+            values.astype(try_type)
+            return bq_type
+        except (ValueError, OverflowError):
+            pass
+    return 'string'
+
+
+def _column_stats_for_lines(lines, num_cols, stats):
+    """
+    Fold a block of TSV lines into the per-column [type, mode, null count, max length] stats
+    """
+    rows = [line.rstrip('\n').split('\t') for line in lines if line.strip('\n') != '']
+    for row in rows:
+        if len(row) != num_cols:
+            raise ValueError("Row has {} fields, expected {}: {}".format(len(row), num_cols, row[:4]))
+    if not rows:
+        return 0
+
+    for ii, column in enumerate(zip(*rows)):
+        col_stats = stats[ii]
+        values = np.char.strip(np.array(column, dtype=str))
+        lengths = np.char.str_len(values)
+        col_stats[3] = max(col_stats[3], int(lengths.max()))
+        is_empty = lengths == 0
+        col_stats[2] += int(np.count_nonzero(is_empty))
+        values = values[~is_empty]
+        if len(values) == 0:
+            continue
+        is_list = np.char.startswith(values, '[') & np.char.endswith(values, ']')
+        scalars = values[~is_list]
+        if len(scalars) > 0 and col_stats[1] == 'NA':
+            col_stats[1] = 'nullable'
+        col_type = _type_of_values(scalars)
+        if np.any(is_list):
+            tokens = []
+            for list_cell in values[is_list]:
+                cell_tokens = _split_list_string(str(list_cell)[1:-1])
+                if cell_tokens:
+                    col_stats[1] = 'repeated'
+                tokens.extend(tok.strip() for tok in cell_tokens if tok.strip() != '')
+            col_type = _join_bq_type(col_type, _type_of_values(np.array(tokens, dtype=str)))
+        col_stats[0] = _join_bq_type(col_stats[0], col_type)
+
+    return len(rows)
+
+
+def _infer_schema_range(tsv_file, start, end, num_cols, chunk_bytes):
+    """
+    Worker: stats for the rows in one line-aligned byte range of the file
+    """
+    stats = [['NA', 'NA', 0, 0] for _ in range(num_cols)]
+    num_rows = 0
+    with open(tsv_file, 'rb') as readfile:
+        readfile.seek(start)
+        if start == 0:
+            readfile.readline()
+        remaining = end - readfile.tell()
+        while remaining > 0:
+            block = readfile.readlines(min(remaining, chunk_bytes))
+            if not block:
+                break
+            # readlines() can run one line past the hint, and so past the end of our range:
+            lines = []
+            for line in block:
+                if remaining <= 0:
+                    break
+                lines.append(line.decode('utf-8'))
+                remaining -= len(line)
+            num_rows += _column_stats_for_lines(lines, num_cols, stats)
+    return stats, num_rows
+
+
+def infer_schema_full_scan(tsv_file, num_procs=None, chunk_bytes=64 * 1024 * 1024):
+    """
+    Type inference over every row of a TSV with a header line, instead of one row every nSkip
+    like createSchema. The file is cut into line-aligned ranges scanned in parallel, each in
+    blocks of whole columns. Returns the header names and, per column, [type, mode, null count,
+    max length], using createSchema's type and mode names. The names are made BQ-safe the way
+    createSchema does it.
+    """
+    if np is None:
+        raise Exception("numpy is needed for the full scan of {}".format(tsv_file))
+    if num_procs is None:
+        num_procs = os.cpu_count()
+
+    if tsv_file.endswith('.gz'):
+        with gzip.open(tsv_file, 'rt') as readfile:
+            field_names = readfile.readline().rstrip('\n').split('\t')
+            stats = [['NA', 'NA', 0, 0] for _ in range(len(field_names))]
+            num_rows = 0
+            while True:
+                block = readfile.readlines(chunk_bytes)
+                if not block:
+                    break
+                num_rows += _column_stats_for_lines(block, len(field_names), stats)
+    else:
+        header, ranges = _split_on_lines(tsv_file, num_procs)
+        field_names = header.decode('utf-8').rstrip('\n').split('\t')
+        num_cols = len(field_names)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_procs, **profiler_pool_kwargs()) as executor:
+            range_results = list(executor.map(_infer_schema_range, itertools.repeat(tsv_file),
+                                              [rng[0] for rng in ranges], [rng[1] for rng in ranges],
+                                              itertools.repeat(num_cols), itertools.repeat(chunk_bytes)))
+        stats = [['NA', 'NA', 0, 0] for _ in range(num_cols)]
+        num_rows = 0
+        for range_stats, range_rows in range_results:
+            num_rows += range_rows
+            _merge_column_stats(stats, range_stats)
+
+    print("Scanned {} rows of {} for schema".format(num_rows, tsv_file))
+    field_names = _bq_field_names(field_names)
+    _finish_column_stats(stats)
+    return field_names, stats
+
+
+_BQ_SPECIAL_CHARS = set(' -)(,:;.@#$^&*[]{}|/?')
+
+
+def _valid_bq_field_name(name):
+    """
+    createSchema's removeSpecialChars and createValidBQfieldName: runs of special characters become one
+    underscore (none leading or trailing), % becomes pct, and the result is cut to 128 characters
+    """
+    out_chars = []
+    for char in name:
+        if char in _BQ_SPECIAL_CHARS:
+            if out_chars and out_chars[-1] != '_':
+                out_chars.append('_')
+        elif char == '%':
+            out_chars.append('pct')
+        else:
+            out_chars.append(char)
+    field_name = ''.join(out_chars)
+    if field_name.endswith('_'):
+        field_name = field_name[:-1]
+    if len(field_name) > 128:
+        return _valid_bq_field_name(field_name[:128])
+    if field_name and not (field_name[0] == '_' or field_name[0].isascii() and field_name[0].isalpha()):
+        raise ValueError("Field name does not start with a letter or underscore: {}".format(field_name))
+    for char in field_name:
+        if not (char == '_' or char.isascii() and char.isalnum()):
+            raise ValueError("Invalid character {} in field name {}".format(repr(char), field_name))
+    return field_name
+
+
+def _bq_field_names(header_tokens):
+    """
+    BQ column names for the header tokens, made the way createSchema makes them: each is sanitized, and
+    a name that repeats one already seen (ignoring case) gets an X tacked on
+    """
+    field_names = []
+    lower_names = set()
+    for token in header_tokens:
+        field_name = _valid_bq_field_name(token.strip())
+        if field_name == '':
+            raise ValueError("Blank header token in {}".format(header_tokens))
+        if field_name.lower() in lower_names:
+            print("Repeated header token {}, using {}X".format(field_name, field_name))
+            field_name = field_name + 'X'
+        field_names.append(field_name)
+        lower_names.add(field_name.lower())
+    return field_names
+
+
+def _merge_column_stats(stats, more_stats):
+    for col_stats, more in zip(stats, more_stats):
+        col_stats[0] = _join_bq_type(col_stats[0], more[0])
+        col_stats[1] = max(col_stats[1], more[1], key=_MODE_RANK.get)
+        col_stats[2] += more[2]
+        col_stats[3] = max(col_stats[3], more[3])
+
+
+def _finish_column_stats(stats):
+    for col_stats in stats:
+        if col_stats[0] == 'NA':
+            col_stats[0] = 'string'
+        if col_stats[1] == 'NA':
+            col_stats[1] = 'nullable'
+
+
+def build_schema_full_scan(tsv_file, num_procs=None):
+    """
+    Drop-in for createSchemaP3.build_schema that scans every row: returns the (name, type) typing
+    tuples used by build_combined_schema
+    """
+    field_names, stats = infer_schema_full_scan(tsv_file, num_procs)
+    return [(name, col_stats[0]) for name, col_stats in zip(field_names, stats)]
+
+
+def typing_tups_for(params, tsv_file):
+    """
+    The typing tuples of tsv_file for build_combined_schema: from every row with SCHEMA_FULL_SCAN
+    (over SCHEMA_SCAN_PROCESSES processes), otherwise from one row every SCHEMA_SAMPLE_SKIPS rows
+    """
+    if 'SCHEMA_FULL_SCAN' in params and params['SCHEMA_FULL_SCAN']:
+        return build_schema_full_scan(tsv_file,
+                                      params['SCHEMA_SCAN_PROCESSES'] if 'SCHEMA_SCAN_PROCESSES' in params else None)
+    # createSchemaP3 sits next to the builders, which have it on the path:
+    from createSchemaP3 import build_schema
+    return build_schema(tsv_file, params['SCHEMA_SAMPLE_SKIPS'])
+
+
+def schema_scan_config(params):
+    """
+    The params that typing_tups_for depends on, for a step_cache config
+    """
+    return {'full_scan': params['SCHEMA_FULL_SCAN'] if 'SCHEMA_FULL_SCAN' in params else False,
+            'skips': params['SCHEMA_SAMPLE_SKIPS'] if 'SCHEMA_SAMPLE_SKIPS' in params else None}
+
+
 def update_schema(target_dataset, dest_table, schema_dict_loc):
     """
     Update the Schema of a Table
@@ -1069,7 +3330,7 @@ def update_schema_with_dict(target_dataset, dest_table, full_schema, project=Non
     Final derived table needs the schema descriptions to be installed.
     """
     try:
-        client = bigquery.Client() if project is None else bigquery.Client(project=project)
+        client = bq_client(project)
         table_ref = client.dataset(target_dataset).table(dest_table)
         table = client.get_table(table_ref)
         orig_schema = table.schema
@@ -1091,7 +3352,7 @@ def update_description(target_dataset, dest_table, desc):
     Update the Description of a Table¶
     Final derived table needs a description
     """
-    client = bigquery.Client()
+    client = bq_client()
     table_ref = client.dataset(target_dataset).table(dest_table)
     table = client.get_table(table_ref)
     table.description = desc
@@ -1102,7 +3363,7 @@ def update_status_tag(target_dataset, dest_table, status):
     """
     Update the status tag of a big query table once a new version of the table has been created
     """
-    client = bigquery.Client()
+    client = bq_client()
     table_ref = client.dataset(target_dataset).table(dest_table)
     table = client.get_table(table_ref)
     table.labels = {"status": status}
@@ -1113,7 +3374,7 @@ def bq_table_exists(target_dataset, dest_table):
     """
     Does table exist?
     """
-    client = bigquery.Client()
+    client = bq_client()
     table_ref = client.dataset(target_dataset).table(dest_table)
     try:
         client.get_table(table_ref)
@@ -1125,13 +3386,83 @@ def bq_table_is_empty(target_dataset, dest_table):
     """
     Is table empty?
     """
-    client = bigquery.Client()
+    client = bq_client()
     table_ref = client.dataset(target_dataset).table(dest_table)
     table = client.get_table(table_ref)
     return table.num_rows == 0
 
+def view_row_counts(project, dataset, view_ids, do_batch, max_views_per_query=100):
+    """
+    Row counts for views of a dataset, from UNION ALL queries of up to max_views_per_query views
+    each instead of one query per view. Returns None if a query failed.
+    """
+    counts = {}
+    for i in range(0, len(view_ids), max_views_per_query):
+        chunk = view_ids[i:i + max_views_per_query]
+        sql = '\nUNION ALL\n'.join(["SELECT '{0}' as view_id, COUNT(*) as count FROM `{1}.{2}.{0}`".format(
+                                        view_id, project, dataset) for view_id in chunk])
+        results = bq_harness_with_result(sql, do_batch)
+        if results is None:
+            return None
+        for row in results:
+            counts[row.view_id] = row.count
+    return counts
+
+def view_definition_hash(view_query):
+    """
+    Cache key for a view's row count
+    """
+    return hashlib.sha256(view_query.encode('utf-8')).hexdigest()
+
+def cached_view_row_counts(project, dataset, view_queries, do_batch, cache_file, max_views_per_query=100):
+    """
+    Row counts for views, given as a dict of view_id -> view_query. Counts are kept in a JSON cache
+    file keyed by the full view id and the hash of the view definition, so only new or redefined
+    views get counted. The cache cannot see changes to the tables under an unchanged view, so
+    delete the file when those are reloaded. Returns None if a query failed.
+    """
+    cache = {}
+    if os.path.isfile(cache_file):
+        with open(cache_file, 'r') as cache_fh:
+            cache = json_loads(cache_fh.read())
+
+    counts = {}
+    need_count = []
+    for view_id, view_query in view_queries.items():
+        cached = cache.get('{}.{}.{}'.format(project, dataset, view_id))
+        if cached is not None and cached['hash'] == view_definition_hash(view_query):
+            counts[view_id] = cached['count']
+        else:
+            need_count.append(view_id)
+
+    if need_count:
+        new_counts = view_row_counts(project, dataset, need_count, do_batch, max_views_per_query)
+        if new_counts is None:
+            return None
+        for view_id, count in new_counts.items():
+            counts[view_id] = count
+            cache['{}.{}.{}'.format(project, dataset, view_id)] = {
+                'hash': view_definition_hash(view_queries[view_id]),
+                'count': count
+            }
+        tmp_file = '{}.tmp'.format(cache_file)
+        with open(tmp_file, 'w') as cache_fh:
+            cache_fh.write(json_dumps(cache, indent=1, sort_keys=True))
+        os.replace(tmp_file, cache_file)
+
+    return counts
+
+def query_bytes_estimate(sql, client=None):
+    """
+    Bytes a query would scan, from a dry run. Dry runs are free and do not touch the data.
+    """
+    client = bq_client() if client is None else client
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    query_job = client.query(sql, location='US', job_config=job_config)
+    return query_job.total_bytes_processed
+
 def delete_table_bq_job(target_dataset, delete_table):
-    client = bigquery.Client()
+    client = bq_client()
     table_ref = client.dataset(target_dataset).table(delete_table)
     try:
         client.delete_table(table_ref)
@@ -1208,7 +3539,7 @@ def transfer_schema(target_dataset, dest_table, source_dataset, source_table):
 
     """
 
-    client = bigquery.Client()
+    client = bq_client()
     src_table_ref = client.dataset(source_dataset).table(source_table)
     trg_table_ref = client.dataset(target_dataset).table(dest_table)
     src_table = client.get_table(src_table_ref)
@@ -1227,7 +3558,7 @@ def list_schema(source_dataset, source_table):
     List schema
     """
 
-    client = bigquery.Client()
+    client = bq_client()
     src_table_ref = client.dataset(source_dataset).table(source_table)
     src_table = client.get_table(src_table_ref)
     src_schema = src_table.schema
@@ -1326,7 +3657,7 @@ def install_labels_and_desc(dataset, table_name, file_tag, project=None):
         with open("{}_friendly.txt".format(file_tag), mode='r') as friendly_file:
             friendly = friendly_file.read()
 
-        client = bigquery.Client() if project is None else bigquery.Client(project=project)
+        client = bq_client(project)
         table_ref = client.dataset(dataset).table(table_name)
         table = client.get_table(table_ref)
 
@@ -1357,6 +3688,130 @@ def install_labels_and_desc(dataset, table_name, file_tag, project=None):
 
     return True
 
+'''
+----------------------------------------------------------------------------------------------
+Read the files written by generate_table_detail_files for a table into a desired metadata state
+for sync_table_metadata
+'''
+
+def table_state_from_files(file_tag):
+
+    with open("{}_desc.txt".format(file_tag), mode='r') as desc_file:
+        desc = desc_file.read()
+
+    with open("{}_labels.json".format(file_tag), mode='r') as label_file:
+        labels = json_loads(label_file.read())
+
+    with open("{}_friendly.txt".format(file_tag), mode='r') as friendly_file:
+        friendly = friendly_file.read()
+
+    state = {'description': desc, 'labels': labels, 'friendly_name': friendly}
+
+    schema_file = "{}_schema.json".format(file_tag)
+    if os.path.isfile(schema_file):
+        with open(schema_file, mode='r') as schema_hold_dict:
+            full_schema_list = json_loads(schema_hold_dict.read())
+        state['field_descriptions'] = {entry['name']: entry['description'] for entry in full_schema_list}
+
+    return state
+
+'''
+----------------------------------------------------------------------------------------------
+Work out which metadata fields of a table differ from the desired state, and set them on the
+table object. The desired state is a dict with any of:
+    description, friendly_name: strings
+    labels: the complete label set; labels not listed are removed
+    add_labels: labels to set, leaving the others alone (e.g. {"status": "current"})
+    field_descriptions: column name -> description, for the columns to change
+Returns the list of table properties to send to update_table.
+'''
+
+def table_metadata_diff(table, desired):
+
+    changed = []
+    if 'description' in desired and table.description != desired['description']:
+        table.description = desired['description']
+        changed.append('description')
+
+    if 'friendly_name' in desired and table.friendly_name != desired['friendly_name']:
+        table.friendly_name = desired['friendly_name']
+        changed.append('friendly_name')
+
+    #
+    # Label updates are additive; setting a label to None is what removes it:
+    #
+
+    current_labels = table.labels if table.labels is not None else {}
+    label_updates = {}
+    if 'labels' in desired:
+        for label in current_labels:
+            if label not in desired['labels']:
+                label_updates[label] = None
+        for label, value in desired['labels'].items():
+            if current_labels.get(label) != value:
+                label_updates[label] = value
+    if 'add_labels' in desired:
+        for label, value in desired['add_labels'].items():
+            if current_labels.get(label) != value:
+                label_updates[label] = value
+    if label_updates:
+        table.labels = label_updates
+        changed.append('labels')
+
+    if 'field_descriptions' in desired:
+        field_descs = desired['field_descriptions']
+        new_schema = []
+        schema_changed = False
+        for old_sf in table.schema:
+            if old_sf.name in field_descs and old_sf.description != field_descs[old_sf.name]:
+                new_schema.append(bigquery.SchemaField(old_sf.name, old_sf.field_type, mode=old_sf.mode,
+                                                       description=field_descs[old_sf.name],
+                                                       fields=old_sf.fields))
+                schema_changed = True
+            else:
+                new_schema.append(old_sf)
+        if schema_changed:
+            table.schema = new_schema
+            changed.append('schema')
+
+    return changed
+
+'''
+----------------------------------------------------------------------------------------------
+Bring the metadata of many tables to a desired state. desired_states maps "dataset.table" (or
+"project.dataset.table") to a state as described for table_metadata_diff. The current tables are
+fetched concurrently, and only tables with differences get an update_table call, which sends just
+the changed fields. All calls share one client. Returns a dict of table -> changed fields, or None
+if any table failed.
+'''
+
+def sync_table_metadata(desired_states, project=None, num_workers=8):
+
+    client = bq_client(project)
+    table_ids = list(desired_states.keys())
+
+    def sync_one(table_id):
+        table = client.get_table(table_id)
+        changed = table_metadata_diff(table, desired_states[table_id])
+        if changed:
+            client.update_table(table, changed)
+        return changed
+
+    results = {}
+    failed = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        future_to_table = {executor.submit(sync_one, table_id): table_id for table_id in table_ids}
+        for future in concurrent.futures.as_completed(future_to_table):
+            table_id = future_to_table[future]
+            try:
+                results[table_id] = future.result()
+                print("{}: {}".format(table_id, ', '.join(results[table_id]) if results[table_id] else 'no changes'))
+            except Exception as ex:
+                print("{}: {}".format(table_id, ex))
+                failed = True
+
+    return None if failed else results
+
 '''
 ----------------------------------------------------------------------------------------------
 Take the BQ Ecosystem json file for a dataset and break out the pieces into chunks that will
@@ -1392,7 +3847,7 @@ def install_dataset_desc(dataset_id, file_tag, project=None):
         with open("{}_desc.txt".format(file_tag), mode='r') as desc_file:
             desc = desc_file.read()
 
-        client = bigquery.Client() if project is None else bigquery.Client(project=project)
+        client = bq_client(project)
         dataset = client.get_dataset(dataset_id)  # Make an API request.
         dataset.description = desc
         client.update_dataset(dataset, ["description"])
@@ -1415,7 +3870,7 @@ def create_bq_dataset(dataset_id, file_tag, project=None, make_public=False):
         with open("{}_desc.txt".format(file_tag), mode='r') as desc_file:
             desc = desc_file.read()
 
-        client = bigquery.Client() if project is None else bigquery.Client(project=project)
+        client = bq_client(project)
 
         full_dataset_id = "{}.{}".format(client.project, dataset_id)
 
@@ -1469,15 +3924,16 @@ def publish_table(source_table, target_table):
         trg_dset = trg_toks[1]
         trg_tab = trg_toks[2]
 
-        src_client = bigquery.Client(src_proj)
+        src_client = bq_client(src_proj)
         job = src_client.copy_table(source_table, target_table)
         job.result()
+        record_bq_job(job)
 
         src_table_ref = src_client.dataset(src_dset).table(src_tab)
         s_table = src_client.get_table(src_table_ref)
         src_friendly = s_table.friendly_name
 
-        trg_client = bigquery.Client(trg_proj)
+        trg_client = bq_client(trg_proj)
         trg_table_ref = trg_client.dataset(trg_dset).table(trg_tab)
         t_table = src_client.get_table(trg_table_ref)
         t_table.friendly_name = src_friendly
@@ -1518,4 +3974,133 @@ def compare_two_tables_sql(old_table, new_table):
             EXCEPT DISTINCT
             SELECT * from `{0}`
         )
-    '''.format(old_table, new_table)
\ No newline at end of file
+    '''.format(old_table, new_table)
+
+
+def _fingerprint_select_sql(table, columns, label, bucket_expr=None):
+    """
+    One row of (label, row count, whole-row fingerprint, per-column fingerprints) for a table, or
+    one such row per bucket if bucket_expr is given. A SUM of FARM_FINGERPRINTs does not depend
+    on row order, so equal tables give equal fingerprints. It has to be a SUM: with BIT_XOR, any two
+    identical rows cancel out, and tables that differ only in duplicated rows would compare equal.
+    BIGNUMERIC holds the sum of even billions of 64-bit fingerprints without overflow.
+    """
+    col_fps = ''.join([",\n               {0} AS fp_{1}".format(_fingerprint_sum_sql("t.`{}`".format(col)), num)
+                       for num, col in enumerate(columns)])
+    bucket_select = '{} AS bucket,'.format(bucket_expr) if bucket_expr is not None else 'NULL AS bucket,'
+    group_by = 'GROUP BY bucket' if bucket_expr is not None else ''
+    return '''
+        SELECT '{0}' AS which, {1}
+               COUNT(*) AS row_count,
+               {5} AS row_fp{2}
+        FROM `{3}` AS t
+        {4}
+    '''.format(label, bucket_select, col_fps, table, group_by, _fingerprint_sum_sql('t'))
+
+
+def _fingerprint_sum_sql(value):
+    return 'SUM(CAST(FARM_FINGERPRINT(TO_JSON_STRING({})) AS BIGNUMERIC))'.format(value)
+
+
+def _bucket_expr(bucket_key, num_buckets):
+    return 'MOD(ABS(FARM_FINGERPRINT(TO_JSON_STRING(t.`{0}`))), {1})'.format(bucket_key, num_buckets)
+
+
+def table_fingerprints_sql(old_table, new_table, columns, bucket_key=None, num_buckets=None):
+    """
+    SQL for the fingerprints of both tables in a single job
+    """
+    bucket_expr = _bucket_expr(bucket_key, num_buckets) if bucket_key is not None else None
+    return '''
+        {0}
+        UNION ALL
+        {1}
+    '''.format(_fingerprint_select_sql(old_table, columns, 'old', bucket_expr),
+               _fingerprint_select_sql(new_table, columns, 'new', bucket_expr))
+
+
+def compare_buckets_sql(old_table, new_table, bucket_key, num_buckets, buckets):
+    """
+    Row-level symmetric difference like compare_two_tables_sql, restricted to the given key buckets
+    """
+    where = 'WHERE {} IN ({})'.format(_bucket_expr(bucket_key, num_buckets), ', '.join(str(b) for b in buckets))
+    return '''
+        SELECT COUNT(*) AS diff_rows FROM (
+            (
+                SELECT * FROM `{0}` AS t {2}
+                EXCEPT DISTINCT
+                SELECT * FROM `{1}` AS t {2}
+            )
+            UNION ALL
+            (
+                SELECT * FROM `{1}` AS t {2}
+                EXCEPT DISTINCT
+                SELECT * FROM `{0}` AS t {2}
+            )
+        )
+    '''.format(old_table, new_table, where)
+
+
+def compare_two_tables_summary(old_table, new_table, do_batch, bucket_key=None, num_buckets=1024,
+                               max_drill_buckets=64):
+    """
+    Cheap alternative to compare_two_tables. First compares row counts and order-independent
+    row and column fingerprints of the two tables in one aggregate scan. If they differ and a
+    bucket_key is given, it fingerprints buckets of that key, and then runs the row-level diff only
+    on the mismatching buckets (if there are no more than max_drill_buckets of them). Returns a
+    summary dict, or None if a query failed.
+    """
+    client = bq_client()
+    old_columns = [field.name for field in client.get_table(old_table).schema]
+    new_columns = [field.name for field in client.get_table(new_table).schema]
+
+    summary = {
+        'same': False,
+        'schema_same': old_columns == new_columns,
+        'old_rows': None,
+        'new_rows': None,
+        'changed_columns': [],
+        'mismatched_buckets': None,
+        'diff_rows': None
+    }
+
+    if old_columns != new_columns:
+        print('Schemas differ: only in old {}, only in new {}'.format(
+            sorted(set(old_columns) - set(new_columns)), sorted(set(new_columns) - set(old_columns))))
+        return summary
+
+    results = bq_harness_with_result(table_fingerprints_sql(old_table, new_table, old_columns), do_batch)
+    if results is None:
+        return None
+    by_table = {row.which: row for row in results}
+    old_fp, new_fp = by_table['old'], by_table['new']
+    summary['old_rows'] = old_fp.row_count
+    summary['new_rows'] = new_fp.row_count
+    summary['changed_columns'] = [col for num, col in enumerate(old_columns)
+                                  if old_fp['fp_{}'.format(num)] != new_fp['fp_{}'.format(num)]]
+    if old_fp.row_count == new_fp.row_count and old_fp.row_fp == new_fp.row_fp:
+        summary['same'] = True
+        summary['diff_rows'] = 0
+        return summary
+
+    if bucket_key is None:
+        return summary
+
+    results = bq_harness_with_result(table_fingerprints_sql(old_table, new_table, [], bucket_key, num_buckets),
+                                     do_batch)
+    if results is None:
+        return None
+    bucket_fps = {}
+    for row in results:
+        bucket_fps.setdefault(row.bucket, {})[row.which] = (row.row_count, row.row_fp)
+    mismatched = sorted(bucket for bucket, fps in bucket_fps.items() if fps.get('old') != fps.get('new'))
+    summary['mismatched_buckets'] = mismatched
+
+    if 0 < len(mismatched) <= max_drill_buckets:
+        results = bq_harness_with_result(compare_buckets_sql(old_table, new_table, bucket_key,
+                                                             num_buckets, mismatched), do_batch)
+        if results is None:
+            return None
+        summary['diff_rows'] = next(iter(results)).diff_rows
+
+    return summary
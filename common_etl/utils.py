@@ -30,6 +30,9 @@ import yaml
 from google.api_core.exceptions import NotFound
 from google.cloud import bigquery, storage, exceptions
 
+from common_etl.support import bq_client, gcs_client, count_event, timed_step, \
+    instrument_steps, record_bq_job, bq_dry_run_enabled, preflight_query, step_cache, upload_to_bucket_in_parts
+
 
 #       GETTERS - YAML CONFIG
 
@@ -761,6 +764,7 @@ def create_mapping_dict(endpoint):
 
     # retrieve mappings json object
     res = requests.get(endpoint + '/_mapping')
+    count_event('api_calls')
     field_mappings = res.json()['_mapping']
 
     for field in field_mappings:
@@ -791,7 +795,7 @@ def create_schema_dict(api_params, bq_params, is_webapp=False):
     :return: flattened schema dict in format:
         {full field name: {name: 'name', type: 'field_type', description: 'description'}}
     """
-    client = bigquery.Client()
+    client = bq_client()
     bq_table = client.get_table(get_working_table_id(bq_params))
 
     schema_list = []
@@ -852,6 +856,7 @@ def get_graphql_api_response(api_params, query, fail_on_error=True):
 
     req_body = {'query': query}
     api_res = requests.post(endpoint, headers=headers, json=req_body)
+    count_event('api_calls')
     tries = 0
 
     while not api_res.ok and tries < max_retries:
@@ -860,6 +865,7 @@ def get_graphql_api_response(api_params, query, fail_on_error=True):
         time.sleep(3)
 
         api_res = requests.post(endpoint, headers=headers, json=req_body)
+        count_event('api_calls')
 
         tries += 1
 
@@ -950,7 +956,7 @@ def copy_bq_table(bq_params, src_table, dest_table, replace_table=False):
     :param src_table: Table to copy
     :param dest_table: Table to be created
     """
-    client = bigquery.Client()
+    client = bq_client()
 
     job_config = bigquery.CopyJobConfig()
 
@@ -972,7 +978,7 @@ def create_and_load_table(bq_params, jsonl_file, schema, table_id):
     :param schema: list of SchemaFields representing desired BQ table schema
     :param table_id: id of table to create
     """
-    client = bigquery.Client()
+    client = bq_client()
     job_config = bigquery.LoadJobConfig()
     job_config.schema = schema
     job_config.source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
@@ -982,6 +988,7 @@ def create_and_load_table(bq_params, jsonl_file, schema, table_id):
 
     try:
         load_job = client.load_table_from_uri(gs_uri, table_id, job_config=job_config)
+        count_event('bq_jobs')
         console_out(' - Inserting into {0}... ', (table_id,), end="")
         await_insert_job(bq_params, client, table_id, load_job)
     except TypeError as err:
@@ -996,7 +1003,7 @@ def create_and_load_tsv_table(bq_params, tsv_file, schema, table_id, null_marker
     :param schema: list of SchemaFields representing desired BQ table schema
     :param table_id: id of table to create
     """
-    client = bigquery.Client()
+    client = bq_client()
     job_config = bigquery.LoadJobConfig()
     job_config.schema = schema
     job_config.source_format = bigquery.SourceFormat.CSV
@@ -1009,6 +1016,7 @@ def create_and_load_tsv_table(bq_params, tsv_file, schema, table_id, null_marker
 
     try:
         load_job = client.load_table_from_uri(gs_uri, table_id, job_config=job_config)
+        count_event('bq_jobs')
 
         console_out(' - Inserting into {0}... ', (table_id,), end="")
         await_insert_job(bq_params, client, table_id, load_job)
@@ -1021,7 +1029,7 @@ def delete_bq_table(table_id):
 
     :param table_id: table id in standard SQL format
     """
-    client = bigquery.Client()
+    client = bq_client()
     client.delete_table(table_id, not_found_ok=True)
 
     console_out("deleted table: {0}", (table_id,))
@@ -1033,7 +1041,7 @@ def exists_bq_table(table_id):
     :param table_id: table id in standard SQL format
     :return: True if exists, False otherwise
     """
-    client = bigquery.Client()
+    client = bq_client()
 
     try:
         client.get_table(table_id)
@@ -1049,12 +1057,17 @@ def load_table_from_query(bq_params, table_id, query):
     :param table_id: table id in standard SQL format
     :param query: query which returns data to populate a new BQ table.
     """
-    client = bigquery.Client()
+    client = bq_client()
     job_config = bigquery.QueryJobConfig(destination=table_id)
     job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
 
+    if bq_dry_run_enabled():
+        preflight_query(query, table_id, client)
+        return
+
     try:
         query_job = client.query(query, job_config=job_config)
+        count_event('bq_jobs')
         console_out(' - Inserting into {0}... ', (table_id,), end="")
         await_insert_job(bq_params, client, table_id, query_job)
     except TypeError as err:
@@ -1070,7 +1083,7 @@ def get_bq_table_obj(table_id):
     if not exists_bq_table(table_id):
         return None
 
-    client = bigquery.Client()
+    client = bq_client()
     return client.get_table(table_id)
 
 
@@ -1080,9 +1093,15 @@ def get_query_results(query):
     :param query: query string
     :return: result object
     """
-    client = bigquery.Client()
+    client = bq_client()
+    # The results are needed, so a dry run only logs the estimate before running it:
+    if bq_dry_run_enabled():
+        preflight_query(query, client=client)
     query_job = client.query(query)
-    return query_job.result()
+    count_event('bq_jobs')
+    results = query_job.result()
+    record_bq_job(query_job)
+    return results
 
 
 def await_insert_job(bq_params, client, table_id, bq_job):
@@ -1111,6 +1130,7 @@ def await_insert_job(bq_params, client, table_id, bq_job):
             time.sleep(2)
 
     bq_job = client.get_job(bq_job.job_id, location=location)
+    record_bq_job(bq_job, table_id)
 
     if bq_job.error_result is not None:
         has_fatal_error(
@@ -1140,6 +1160,7 @@ def await_job(bq_params, client, bq_job):
             time.sleep(2)
 
     bq_job = client.get_job(bq_job.job_id, location=location)
+    record_bq_job(bq_job)
 
     if bq_job.error_result is not None:
         err_res = bq_job.error_result
@@ -1266,7 +1287,7 @@ def update_table_metadata(table_id, metadata):
     :param table_id: table id in standard SQL format
     :param metadata: metadata containing new field and table attributes
     """
-    client = bigquery.Client()
+    client = bq_client()
     table = get_bq_table_obj(table_id)
 
     table.labels = metadata['labels']
@@ -1288,7 +1309,7 @@ def update_friendly_name(bq_params, table_id, custom_name=None):
     onto the existing friendly name. If custom_name is specified, this behavior is
     overridden, and the table's friendly name is replaced entirely.
     """
-    client = bigquery.Client()
+    client = bq_client()
     table = get_bq_table_obj(table_id)
 
     if custom_name:
@@ -1308,7 +1329,7 @@ def update_schema(table_id, new_descriptions):
     :param table_id: table id in standard SQL format
     :param new_descriptions: dict of field names and new description strings
     """
-    client = bigquery.Client()
+    client = bq_client()
     table = get_bq_table_obj(table_id)
 
     new_schema = []
@@ -1343,7 +1364,7 @@ def upload_file_to_bucket(project, bucket, blob_dir, fp):
     :return:
     """
     try:
-        client = storage.Client(project=project)
+        client = gcs_client(project)
         bucket = client.get_bucket(bucket)
         blob = bucket.blob(blob_dir)
 
@@ -1354,16 +1375,25 @@ def upload_file_to_bucket(project, bucket, blob_dir, fp):
 
 def upload_to_bucket(bq_params, scratch_fp):
     """Uploads file to a google storage bucket (location specified in yaml config).
+    If UPLOAD_PARTS is set in the yaml config, the file is pushed up as that many
+    concurrent pieces, which are then composed back into the same blob.
 
     :param bq_params: bq param object from yaml config
     :param scratch_fp: name of file to upload to bucket
     """
 
     try:
-        storage_client = storage.Client(project="")
-
         jsonl_output_file = scratch_fp.split('/')[-1]
         blob_name = "{}/{}".format(bq_params['WORKING_BUCKET_DIR'], jsonl_output_file)
+
+        if 'UPLOAD_PARTS' in bq_params and bq_params['UPLOAD_PARTS']:
+            gs_uri = upload_to_bucket_in_parts(bq_params['WORKING_BUCKET'], blob_name, scratch_fp,
+                                               bq_params['UPLOAD_PARTS'], has_header=False)
+            if gs_uri is None:
+                has_fatal_error("Failed to upload {} to bucket.".format(scratch_fp))
+            return
+
+        storage_client = gcs_client("")
         bucket = storage_client.bucket(bq_params['WORKING_BUCKET'])
         blob = bucket.blob(blob_name)
 
@@ -1373,7 +1403,7 @@ def upload_to_bucket(bq_params, scratch_fp):
 
 
 def download_from_bucket(bq_params, filename):
-    storage_client = storage.Client(project="")
+    storage_client = gcs_client("")
     blob_name = "{}/{}".format(bq_params['WORKING_BUCKET_DIR'], filename)
     bucket = storage_client.bucket(bq_params['WORKING_BUCKET'])
     blob = bucket.blob(blob_name)
@@ -1383,6 +1413,19 @@ def download_from_bucket(bq_params, filename):
         blob.download_to_file(file_obj)
 
 
+def bucket_file_fingerprint(bq_params, filename):
+    """Identify the version of a file that download_from_bucket would fetch, e.g. for a step_cache config.
+
+    :param bq_params: bq param object from yaml config
+    :param filename: name of file in the working bucket dir
+    :return: the blob's generation and crc32c, or None if there is no such blob
+    """
+    storage_client = gcs_client("")
+    blob_name = "{}/{}".format(bq_params['WORKING_BUCKET_DIR'], filename)
+    blob = storage_client.bucket(bq_params['WORKING_BUCKET']).get_blob(blob_name)
+    return None if blob is None else "{}:{}".format(blob.generation, blob.crc32c)
+
+
 #       ANALYZE DATA
 
 
@@ -54,6 +54,10 @@ python3 -m pip install PyYaml
 python3 -m pip install gitpython
 # used by build_schema:
 python3 -m pip install python-dateutil
+# used by build_schema_full_scan:
+python3 -m pip install numpy
+# used when a concat writes Parquet (ONE_BIG_PARQUET):
+python3 -m pip install pyarrow
 deactivate
 
 # Make a place for schemas to be placed: